@@ -6,6 +6,8 @@ from app.api.conversation.router import router as conv_router
 from app.api.message.router import router as message_router
 from app.api.msg_socket.router import router as msg_socket_router
 from app.api.sync_socket.router import router as sync_router
+from app.api.mux_socket.router import router as mux_router
+from app.api.metrics.router import router as metrics_router
 
 
 router = APIRouter()
@@ -16,3 +18,5 @@ router.include_router(router=conv_router, prefix="/conversations")
 router.include_router(router=message_router, prefix="/messages")
 router.include_router(router=msg_socket_router, prefix="/message/scoket")
 router.include_router(router=sync_router, prefix="/sync")
+router.include_router(router=mux_router, prefix="/socket")
+router.include_router(router=metrics_router, prefix="/metrics")
@@ -1,14 +1,16 @@
 from bson import ObjectId
+from bson.errors import InvalidId
 from typing import Optional, Dict, List, Any
 from datetime import datetime
 import logging
 from fastapi import APIRouter, Depends, status, HTTPException, Query
 from fastapi.responses import JSONResponse
 
-from app.core.schemas import UserOut, Message, ConversationResponse
+from app.core.schemas import UserOut, Message, ConversationResponse, ResumeResponse
 from app.core.db import AsyncDatabase, get_async_database
 from app.deps import get_user_from_access_token_http
-from app.api.sync_socket.router import connections
+from app.core.contacts import contact_index
+from app.core.presence import presence
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -87,6 +89,59 @@ async def retrive_conversation(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@router.get("/resume")
+async def resume_conversation(
+    conversation_id: str = Query(..., description="conversation to catch up on"),
+    after_seq: int = Query(
+        0, ge=0, description="sequence number of the last message the client has"
+    ),
+    limit: int = Query(
+        100, ge=1, le=500, description="number of messages to retrieve (1-500)"
+    ),
+    user: UserOut = Depends(get_user_from_access_token_http),
+    db: AsyncDatabase = Depends(get_async_database),
+):
+    """
+    Return the messages of a conversation after the given sequence number.
+
+    Clients call this when they see a gap in the `seq` of received messages
+    or after reconnecting, and keep paging while `has_more` is true.
+    """
+    try:
+        conv_id = ObjectId(conversation_id)
+    except InvalidId:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid conversation id"
+        )
+
+    conversation = await db.conversation.find_one(
+        {"_id": conv_id, "participants": user.id},
+        projection={"last_seq": 1, "receipts": 1},
+    )
+    if not conversation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found"
+        )
+
+    # served by the (conversation_id, seq) index
+    cursor = (
+        db.message.find(
+            {"conversation_id": conversation["_id"], "seq": {"$gt": after_seq}}
+        )
+        .sort("seq", 1)
+        .limit(limit + 1)
+    )
+    documents = await cursor.to_list(length=limit + 1)
+
+    return ResumeResponse(
+        conversation_id=conversation["_id"],
+        last_seq=conversation.get("last_seq", 0),
+        receipts=conversation.get("receipts", {}),
+        messages=[Message(**document) for document in documents[:limit]],
+        has_more=len(documents) > limit,
+    )
+
+
 @router.get("/list-conversations")
 async def list_conversations(
     user: UserOut = Depends(get_user_from_access_token_http),
@@ -138,23 +193,11 @@ async def get_online_status_for_active_conversations(
     user: UserOut = Depends(get_user_from_access_token_http),
     db: AsyncDatabase = Depends(get_async_database),
 ):
-    pipeline = [
-        {"$match": {"participants": {"$all": [user.id]}}},
-        {"$project": {"_id": 0, "participants": 1}},
-    ]
-
     try:
-        cursor = db.conversation.aggregate(pipeline=pipeline)
+        friends_id = await contact_index.get_contacts(db, user.id)
 
-        friends_id: set[str] = set()
-        async for document in cursor:
-            friends_id.update(
-                str(id) for id in document["participants"] if id != user.id
-            )
-
-        online_friends = [
-            id for id in friends_id if connections.is_online(ObjectId(id))
-        ]
+        # one pipelined round trip for all of them
+        online_friends = [str(id) for id in await presence.is_online_many(friends_id)]
 
         return JSONResponse(
             content={"online_friends": online_friends}, status_code=status.HTTP_200_OK
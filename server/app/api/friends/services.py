@@ -5,6 +5,7 @@ from typing import Optional, List, Dict, Any, Tuple
 from fastapi import HTTPException, status
 from app.core.schemas import Friends, Friends_Status, UserOut
 from app.core.db import AsyncDatabase
+from app.core.contacts import contact_index
 from app.api.user.services import get_full_user
 from app.utils import create_presigned_download_url
 
@@ -78,6 +79,7 @@ async def create_friends(
 
     friend1 = await db.friends.insert_one(friend_for_1.model_dump(exclude={"id"}))
     friend2 = await db.friends.insert_one(friend_for_2.model_dump(exclude={"id"}))
+    await contact_index.add_contacts(user1_id, user2_id)
 
     return friend1.inserted_id, friend2.inserted_id
 
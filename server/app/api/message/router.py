@@ -23,6 +23,7 @@ from app.core.schemas import (
     UserAuthOut,
 )
 from app.deps import get_verified_user
+from app.api.msg_socket.services import reserve_sequence
 
 from .services import get_or_create_conversation
 
@@ -156,8 +157,27 @@ async def handle_media_message(
         attachment=attachment,
     )
 
+    # Reserve the message's place in the conversation
+    message.seq = await reserve_sequence(
+        db, message.conversation_id, last_message_date=message.sending_time
+    )
+    if message.seq is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
     # Store the message instance to database collection
     message_response = await db.message.insert_one(message.model_dump(exclude={"id"}))
+    if settings.MESSAGE_DELIVERY_MODE == "deliver_first":
+        # The seq came from the Redis counter, move the conversation like the
+        # write-behind buffer does for chat messages
+        await db.conversation.update_one(
+            {"_id": message.conversation_id},
+            {
+                "$max": {
+                    "last_seq": message.seq,
+                    "last_message_date": message.sending_time,
+                }
+            },
+        )
     await asyncio.to_thread(
         process_media_message.delay(str(message_response.inserted_id))
     )
@@ -1,7 +1,9 @@
 from bson import ObjectId
 from fastapi import WebSocketException, status
+from app.core.contacts import contact_index
 from app.core.db import AsyncDatabase
 from app.core.schemas import Conversation
+from app.api.msg_socket.services import participant_cache
 
 
 async def get_or_create_conversation(
@@ -30,6 +32,10 @@ async def get_or_create_conversation(
         conversation_resp = await db.conversation.insert_one(
             conv_data.model_dump(exclude={"id"})
         )
+        await participant_cache.set(
+            conversation_resp.inserted_id, conv_data.participants
+        )
+        await contact_index.add_contacts(user_id, friend_id)
 
         # Return the conversation Id
         return str(conversation_resp)
@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Request, status
+from fastapi.responses import JSONResponse
+
+from app.core.contacts import contact_index
+from app.core.message_broker import consumer_registry, get_publisher
+from app.core.metrics import stage_metrics
+from app.api.msg_socket.router import connections as msg_connections
+from app.api.sync_socket.router import connections as sync_connections
+from app.api.msg_socket.services import (
+    participant_cache,
+    sequence_counter,
+    submission_dedup,
+)
+from app.api.msg_socket.write_behind import message_buffer
+from app.api.sync_socket.status_buffer import status_aggregator
+
+router = APIRouter()
+
+
+@router.get("/")
+async def get_metrics(request: Request):
+    return {
+        "sockets": {
+            "message": msg_connections.stats(),
+            "sync": sync_connections.stats(),
+        },
+        "conversation_cache": participant_cache.stats(),
+        "message_write_behind": message_buffer.stats(),
+        "sequence_counter": sequence_counter.stats(),
+        "message_status": status_aggregator.stats(),
+        "message_dedup": submission_dedup.stats(),
+        "contact_index": contact_index.stats(),
+        "publisher": get_publisher(request.state.queue_connection).stats(),
+        "consumers": consumer_registry.health(),
+        "latency": stage_metrics.snapshot(),
+    }
+
+
+@router.get("/consumers")
+async def get_consumer_health():
+    """State of every background consumer, 503 unless all of them are running."""
+    return JSONResponse(
+        content=consumer_registry.health(),
+        status_code=(
+            status.HTTP_200_OK
+            if consumer_registry.healthy()
+            else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+    )
@@ -1,4 +1,5 @@
-from typing import Dict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 from bson import ObjectId
 from fastapi import (
     APIRouter,
@@ -18,32 +19,22 @@ from app.core.schemas import (
     PacketType,
 )
 from app.core.db import AsyncDatabase, get_async_database_from_socket
-from .services import get_user_form_conversation
+from app.core.connections import ConnectionManager, Session
+from app.core.config import settings
+from app.core.contacts import contact_index
+from app.core.metrics import stage_metrics
+from app.core.codec import HEARTBEATS, PONG, Frame, decode_frame, receive_frame
+from .services import (
+    get_user_form_conversation,
+    participant_cache,
+    reserve_sequence,
+    submission_dedup,
+)
+from .write_behind import message_buffer
 
 
 router = APIRouter()
-
-
-class ConnectionManager:
-    def __init__(self) -> None:
-        self.active_connection: Dict[ObjectId, WebSocket] = {}
-
-    async def connect(self, user_id: ObjectId, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connection[user_id] = websocket
-
-    def disconnect(self, user_id: ObjectId):
-        if user_id in self.active_connection:
-            del self.active_connection[user_id]
-
-    def is_online(self, user_id: ObjectId):
-        return user_id in self.active_connection
-
-    async def send_personal_message(self, user_id: ObjectId, message: MessagePacket):
-        await self.active_connection[user_id].send_text(message.model_dump_json())
-
-
-connections = ConnectionManager()
+connections = ConnectionManager(channel="message")
 
 
 @router.websocket("/")
@@ -52,61 +43,102 @@ async def messages_socket(
     user: UserAuthOut = Depends(get_user_from_access_token_ws),
     db: AsyncDatabase = Depends(get_async_database_from_socket),
 ):
-    await connections.connect(user.id, websocket)
+    session = await connections.connect(user.id, websocket)
 
     try:
         while True:
-            data = await websocket.receive_text()
-            packet: MessagePacket = MessagePacket.model_validate_json(data)
-
-            if packet.type == PacketType.ping:
-                await connections.send_personal_message(
-                    user_id=user.id, message=MessagePacket(type=PacketType.pong)
-                )
-            elif packet.type == PacketType.message and packet.data:
-                await handle_recieved_message(
-                    user.id, MessageData.model_validate(packet.data.model_dump()), db
-                )
+            data = await receive_frame(websocket)
+            session.touch()
+
+            # heartbeats are answered without parsing them
+            if data in HEARTBEATS:
+                session.send(PONG, connections.channel)
+                continue
+
+            with stage_metrics.time("chat.validate"):
+                packet: MessagePacket = decode_frame(MessagePacket, data)
+
+            await handle_packet(session, packet, db)
 
     except WebSocketDisconnect:
-        connections.disconnect(user.id)
+        pass
+    finally:
+        await connections.disconnect(session)
     return
 
 
+async def handle_packet(session: Session, packet: MessagePacket, db: AsyncDatabase):
+    """Handle a packet received on the message channel of a session."""
+    if packet.type == PacketType.ping:
+        # Reply only to the session that sent the ping
+        session.send(PONG, connections.channel)
+    elif packet.type == PacketType.message and packet.data:
+        with stage_metrics.time("chat.total"):
+            await handle_recieved_message(
+                session.user_id,
+                MessageData.model_validate(packet.data.model_dump()),
+                db,
+            )
+    elif packet.type == PacketType.message_batch and packet.data:
+        await handle_recieved_message_batch(
+            session.user_id,
+            [MessageData.model_validate(d.model_dump()) for d in packet.data],
+            db,
+        )
+
+
 async def handle_recieved_message(
     user_id: ObjectId, data: MessageData, db: AsyncDatabase
 ):
-    # when user start new conversation and don't have the conversation id
-    if not data.conversation_id:
-        if not data.receiver_id:
-            raise WebSocketException(code=status.WS_1003_UNSUPPORTED_DATA)
+    # a retried submission is acked with the stored message, not stored again
+    if data.temp_id:
+        with stage_metrics.time("chat.dedup"):
+            (stored,) = await submission_dedup.claim(user_id, [data.temp_id])
+        if stored is not None:
+            if stored != submission_dedup.PENDING:
+                await connections.deliver_frame([user_id], stored)
+            return
 
-        # check if the users are friend or not
-        friend = await db.friends.find_one(
-            {"user_id": user_id, "friend_id": ObjectId(data.receiver_id)}
+    try:
+        message_data, participant_id = await store_message(user_id, data, db)
+    except BaseException:
+        if data.temp_id:
+            await submission_dedup.release(user_id, [data.temp_id])
+        raise
+
+    # serialize once, the same frame goes to the reciever and back to the sender
+    frame = Frame.from_model(MessagePacket(type=PacketType.message, data=message_data))
+    if data.temp_id:
+        await submission_dedup.complete(user_id, {data.temp_id: frame.text})
+
+    # send the message on whichever node the users are connected
+    with stage_metrics.time("chat.deliver"):
+        await connections.deliver_frame(
+            [participant_id, message_data.sender_id], frame, store_offline=True
         )
 
-        if not friend:
-            raise WebSocketException(
-                code=status.WS_1003_UNSUPPORTED_DATA, reason="Invalid reciever id"
-            )
+    if settings.MESSAGE_DELIVERY_MODE == "deliver_first":
+        # storing the message is left to the write-behind buffer
+        await message_buffer.add(message_data)
 
-        # check if conversations between the user exist
-        conversation = await db.conversation.find_one(
-            {"participants": {"$all": [user_id, ObjectId(data.receiver_id)]}}
-        )
 
-        if conversation:
-            # add the conversation id to the message data
-            data.conversation_id = conversation["_id"]
+async def store_message(
+    user_id: ObjectId, data: MessageData, db: AsyncDatabase
+) -> Tuple[Message, ObjectId]:
+    """
+    Create the message, reserve its sequence number and store it.
 
-        else:
-            # create a new conversation document
-            conv_data = Conversation(participants=[user_id, ObjectId(data.receiver_id)])
-            conversation_resp = await db.conversation.insert_one(
-                conv_data.model_dump(exclude={"id"})
-            )
-            data.conversation_id = str(conversation_resp.inserted_id)
+    In deliver_first mode the message only gets its id here, it is stored by
+    the write-behind buffer once delivered.
+
+    Returns:
+        Tuple[Message, ObjectId]: The message and the other participant.
+    """
+    # when user start new conversation and don't have the conversation id
+    if not data.conversation_id:
+        data.conversation_id = await resolve_conversation_id(
+            user_id, data.receiver_id, db
+        )
 
     # create a Message instance
     message_data = Message(
@@ -118,53 +150,233 @@ async def handle_recieved_message(
     )
 
     # get the other participants
-    participant_id = await get_user_form_conversation(
-        db, conv_id=message_data.conversation_id, user_id=message_data.sender_id
-    )
+    with stage_metrics.time("chat.conversation_lookup"):
+        participant_id = await get_user_form_conversation(
+            db, conv_id=message_data.conversation_id, user_id=message_data.sender_id
+        )
+
+    # reserve the next sequence number, this also moves last_message_date
+    with stage_metrics.time("chat.allocate_seq"):
+        message_data.seq = await reserve_sequence(
+            db,
+            message_data.conversation_id,
+            last_message_date=message_data.sending_time,
+        )
+    if message_data.seq is None:
+        raise WebSocketException(
+            code=status.WS_1007_INVALID_FRAME_PAYLOAD_DATA,
+            reason="Invalid conversation id",
+        )
+
+    if settings.MESSAGE_DELIVERY_MODE == "deliver_first":
+        message_data.id = ObjectId()
+        return message_data, participant_id
 
     # store the message document and add the id to the Message instance
-    response = await db.message.insert_one(
-        message_data.model_dump(exclude={"id", "temp_id"})
-    )
+    with stage_metrics.time("chat.insert"):
+        response = await db.message.insert_one(
+            message_data.model_dump(exclude={"id", "temp_id"})
+        )
     message_data.id = response.inserted_id
+    return message_data, participant_id
+
+
+async def resolve_conversation_id(
+    user_id: ObjectId, receiver_id: Optional[str], db: AsyncDatabase
+) -> ObjectId:
+    """
+    Get the conversation between the user and a friend, creating it if needed.
+    """
+    if not receiver_id:
+        raise WebSocketException(code=status.WS_1003_UNSUPPORTED_DATA)
 
-    data_packet = MessagePacket(type=PacketType.message, data=message_data)
+    # check if the users are friend or not
+    with stage_metrics.time("chat.friend_check"):
+        friend = await db.friends.find_one(
+            {"user_id": user_id, "friend_id": ObjectId(receiver_id)}
+        )
 
-    # check the online status of the reciever
-    if connections.is_online(participant_id):
-        # send the message to the user reciever
-        await connections.send_personal_message(
-            user_id=participant_id, message=data_packet
+    if not friend:
+        raise WebSocketException(
+            code=status.WS_1003_UNSUPPORTED_DATA, reason="Invalid reciever id"
         )
 
-    # updating the last_message_date and pushing the new message id to unseen_message_id
-    await db.conversation.find_one_and_update(
-        {"_id": message_data.conversation_id},
-        {
-            "$set": {"last_message_date": message_data.sending_time},
-        },
+    # check if conversations between the user exist
+    with stage_metrics.time("chat.conversation_resolve"):
+        conversation = await db.conversation.find_one(
+            {"participants": {"$all": [user_id, ObjectId(receiver_id)]}}
+        )
+
+    if conversation:
+        return conversation["_id"]
+
+    # create a new conversation document
+    conv_data = Conversation(participants=[user_id, ObjectId(receiver_id)])
+    conversation_resp = await db.conversation.insert_one(
+        conv_data.model_dump(exclude={"id"})
     )
+    await participant_cache.set(conversation_resp.inserted_id, conv_data.participants)
+    await contact_index.add_contacts(user_id, ObjectId(receiver_id))
+    return conversation_resp.inserted_id
+
 
-    # sending the message back to sender with other information
-    await connections.send_personal_message(
-        user_id=message_data.sender_id, message=data_packet
+async def handle_recieved_message_batch(
+    user_id: ObjectId, items: List[MessageData], db: AsyncDatabase
+):
+    """
+    Store a backlog of messages sent by a reconnecting client.
+
+    Items whose temp_id was already accepted are acked with the stored
+    message, the rest are stored together by `store_message_batch`. Each
+    stored message is still delivered on its own, so the sender gets a
+    per-item ack carrying its temp_id.
+    """
+    if not items:
+        return
+
+    # skip (and ack) the items that are retries of accepted submissions
+    with_temp_id = [data for data in items if data.temp_id]
+    stored_frames = await submission_dedup.claim(
+        user_id, [data.temp_id for data in with_temp_id]
     )
+    duplicates = {
+        id(data): stored
+        for data, stored in zip(with_temp_id, stored_frames)
+        if stored is not None
+    }
+
+    fresh: List[MessageData] = []
+    for data in items:
+        stored = duplicates.get(id(data))
+        if stored is None:
+            fresh.append(data)
+        elif stored != submission_dedup.PENDING:
+            await connections.deliver_frame([user_id], stored)
+
+    claimed = [data.temp_id for data in fresh if data.temp_id]
+    try:
+        stored_messages = await store_message_batch(user_id, fresh, db)
+    except BaseException:
+        await submission_dedup.release(user_id, claimed)
+        raise
+
+    frames = [
+        Frame.from_model(MessagePacket(type=PacketType.message, data=message))
+        for message, _ in stored_messages
+    ]
+    if claimed:
+        await submission_dedup.complete(
+            user_id,
+            {
+                message.temp_id: frame.text
+                for (message, _), frame in zip(stored_messages, frames)
+                if message.temp_id
+            },
+        )
+
+    # per-item acks to the sender and delivery to the reciever
+    for (message, participant_id), frame in zip(stored_messages, frames):
+        await connections.deliver_frame(
+            [participant_id, user_id], frame, store_offline=True
+        )
+        if settings.MESSAGE_DELIVERY_MODE == "deliver_first":
+            await message_buffer.add(message)
+
+
+async def store_message_batch(
+    user_id: ObjectId, items: List[MessageData], db: AsyncDatabase
+) -> List[Tuple[Message, ObjectId]]:
+    """
+    Create and store the messages of a batch.
+
+    Conversations are resolved once per receiver/conversation, every
+    conversation reserves the sequence numbers of its messages (and moves
+    last_message_date) in a single update, and all messages are inserted with
+    one insert_many (left to the write-behind buffer in deliver_first mode).
+
+    Returns:
+        List[Tuple[Message, ObjectId]]: Each message with the other participant.
+    """
+    if not items:
+        return []
+
+    # resolve the conversation of every item, once per receiver
+    conversation_by_receiver: Dict[str, ObjectId] = {}
+    for data in items:
+        if data.conversation_id:
+            continue
+        if data.receiver_id not in conversation_by_receiver:
+            conversation_by_receiver[data.receiver_id] = await resolve_conversation_id(
+                user_id, data.receiver_id, db
+            )
+        data.conversation_id = conversation_by_receiver[data.receiver_id]
+
+    messages = [
+        Message(
+            sender_id=user_id,
+            conversation_id=ObjectId(data.conversation_id),
+            receiver_id=ObjectId(data.receiver_id),
+            message=data.message,
+            temp_id=data.temp_id,
+        )
+        for data in items
+    ]
+
+    # get the other participant of every conversation in the batch
+    participants: Dict[ObjectId, ObjectId] = {}
+    for message in messages:
+        if message.conversation_id not in participants:
+            participants[message.conversation_id] = await get_user_form_conversation(
+                db, conv_id=message.conversation_id, user_id=user_id
+            )
+
+    # reserve a range of sequence numbers per conversation
+    by_conversation: Dict[ObjectId, List[Message]] = {}
+    for message in messages:
+        by_conversation.setdefault(message.conversation_id, []).append(message)
+
+    for conv_id, conv_messages in by_conversation.items():
+        first_seq = await reserve_sequence(
+            db,
+            conv_id,
+            count=len(conv_messages),
+            last_message_date=max(message.sending_time for message in conv_messages),
+        )
+        if first_seq is None:
+            raise WebSocketException(
+                code=status.WS_1007_INVALID_FRAME_PAYLOAD_DATA,
+                reason="Invalid conversation id",
+            )
+        for offset, message in enumerate(conv_messages):
+            message.seq = first_seq + offset
+
+    if settings.MESSAGE_DELIVERY_MODE == "deliver_first":
+        for message in messages:
+            message.id = ObjectId()
+    else:
+        # store all message documents in one round trip
+        response = await db.message.insert_many(
+            [message.model_dump(exclude={"id", "temp_id"}) for message in messages]
+        )
+        for message, inserted_id in zip(messages, response.inserted_ids):
+            message.id = inserted_id
+
+    return [(message, participants[message.conversation_id]) for message in messages]
 
 
-async def send_message(user_id: ObjectId, message_data: Message):
+async def send_message(user_ids: List[ObjectId], message_data: Message):
     """
-    Send message to a userId if online
+    Send message to list of user IDs on whichever node they are connected
 
     Args:
-        user_id : User Id (ObjectId)
+        user_ids : List of IDs to send the message to.
         message_data : The message to send.
     """
 
     try:
-        if connections.is_online(user_id):
-            data_packet = MessagePacket(type=PacketType.message, data=message_data)
+        data_packet = MessagePacket(type=PacketType.message, data=message_data)
 
-            await connections.send_personal_message(user_id, data_packet)
+        await connections.deliver(user_ids, data_packet, store_offline=True)
     except Exception as e:
         print(e)
 
@@ -1,28 +1,243 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
 from bson import ObjectId
 from fastapi import WebSocketException, status
+from pymongo import ReturnDocument
+import redis.asyncio as redis
+from app.core.cache import LRUCache
+from app.core.config import settings
+from app.core.contacts import contact_index
 from app.core.db import AsyncDatabase
 from app.core.schemas import Conversation
 
+logger = logging.getLogger(__name__)
+
+
+class ConversationParticipantCache:
+    """
+    Participants of a conversation keyed by conversation ID.
+
+    Participants never change once a conversation is created, so entries are
+    never invalidated. An in-process LRU sits in front of an optional Redis
+    tier shared by all nodes (CONVERSATION_CACHE_REDIS).
+
+    Until `bind` is called (e.g. in tests) only the local tier is used.
+    """
+
+    def __init__(self, maxsize: int, use_redis: bool) -> None:
+        self.local: LRUCache[List[ObjectId]] = LRUCache(maxsize=maxsize)
+        self.use_redis = use_redis
+        self.redis: Optional[redis.Redis] = None
+        self.redis_hits = 0
+
+    def bind(self, redis: redis.Redis):
+        if self.use_redis:
+            self.redis = redis
+
+    @staticmethod
+    def _key(conv_id: ObjectId) -> str:
+        return f"conv:participants:{conv_id}"
+
+    async def get(self, conv_id: ObjectId) -> Optional[List[ObjectId]]:
+        participants = self.local.get(conv_id)
+        if participants is not None or not self.redis:
+            return participants
+
+        try:
+            value = await self.redis.get(self._key(conv_id))
+        except Exception as e:
+            logger.error(f"Error reading conversation cache: {e}")
+            return None
+
+        if value is None:
+            return None
+
+        self.redis_hits += 1
+        participants = [ObjectId(id) for id in value.split(",")]
+        self.local.set(conv_id, participants)
+        return participants
+
+    async def set(self, conv_id: ObjectId, participants: List[ObjectId]):
+        self.local.set(conv_id, participants)
+
+        if self.redis:
+            try:
+                await self.redis.set(
+                    self._key(conv_id), ",".join(str(id) for id in participants)
+                )
+            except Exception as e:
+                logger.error(f"Error writing conversation cache: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.local.stats(), "redis_hits": self.redis_hits}
+
+
+participant_cache = ConversationParticipantCache(
+    maxsize=settings.CONVERSATION_CACHE_SIZE,
+    use_redis=settings.CONVERSATION_CACHE_REDIS,
+)
+
+
+class SubmissionDedup:
+    """
+    Messages already accepted from a client, keyed by (sender_id, temp_id).
+
+    A sender claims its temp_id before the message is stored. Retries of a
+    claimed temp_id (e.g. resent after a socket drop) get back the frame of
+    the stored message instead of creating a duplicate. Claims live in Redis
+    so retries landing on another node are caught too: a pending claim
+    expires after `claim_ttl_seconds` (so a node dying mid-store does not
+    block retries for long), a completed one after `window_seconds`.
+    Completed entries are also kept in an in-process LRU. A temp_id repeated
+    within one claim counts as a retry of its first use.
+
+    If Redis is unavailable submissions are accepted (fail open). Until
+    `bind` is called (e.g. in tests) only the local LRU is used.
+    """
+
+    PENDING = ""  # claimed, the first attempt has not finished yet
+
+    def __init__(
+        self, maxsize: int, window_seconds: int, claim_ttl_seconds: int
+    ) -> None:
+        self.local: LRUCache[str] = LRUCache(maxsize=maxsize)
+        self.redis: Optional[redis.Redis] = None
+        self.window_seconds = window_seconds
+        self.claim_ttl_seconds = claim_ttl_seconds
+        self.duplicates = 0
+
+    def bind(self, redis: redis.Redis):
+        self.redis = redis
+
+    @staticmethod
+    def _key(sender_id: ObjectId, temp_id: str) -> str:
+        return f"dedup:message:{sender_id}:{temp_id}"
+
+    async def claim(
+        self, sender_id: ObjectId, temp_ids: List[str]
+    ) -> List[Optional[str]]:
+        """
+        Claim the temp_ids of new submissions.
+
+        Returns:
+            List[Optional[str]]: Per temp_id, None if the caller claimed it and
+                must store the message, otherwise the frame of the stored
+                message (PENDING while the first attempt is still in flight).
+        """
+        results: List[Optional[str]] = []
+        seen = set()
+        for temp_id in temp_ids:
+            frame = self.local.get((sender_id, temp_id))
+            if frame is None and temp_id in seen:
+                frame = self.PENDING
+            results.append(frame)
+            seen.add(temp_id)
+        missing = [i for i, frame in enumerate(results) if frame is None]
+
+        if missing and self.redis:
+            keys = [self._key(sender_id, temp_ids[i]) for i in missing]
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        pipe.set(key, self.PENDING, nx=True, ex=self.claim_ttl_seconds)
+                    claimed = await pipe.execute()
+
+                    taken = [key for key, ok in zip(keys, claimed) if not ok]
+                    for key in taken:
+                        pipe.get(key)
+                    frames = iter(await pipe.execute() if taken else [])
+            except Exception as e:
+                logger.error(f"Error claiming message temp ids: {e}")
+                return results
+
+            for i, ok in zip(missing, claimed):
+                if not ok:
+                    # None here means the claim expired meanwhile, accept it
+                    results[i] = next(frames)
+
+        self.duplicates += sum(frame is not None for frame in results)
+        return results
+
+    async def complete(self, sender_id: ObjectId, frames: Dict[str, str]):
+        """Store the frames of messages accepted under the given temp_ids."""
+        for temp_id, frame in frames.items():
+            self.local.set((sender_id, temp_id), frame)
+
+        if not self.redis or not frames:
+            return
+
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for temp_id, frame in frames.items():
+                    pipe.set(
+                        self._key(sender_id, temp_id), frame, ex=self.window_seconds
+                    )
+                await pipe.execute()
+        except Exception as e:
+            # Rather a duplicate on retry than retries dropped as pending
+            logger.error(f"Error storing accepted messages: {e}")
+            await self.release(sender_id, list(frames))
+
+    async def release(self, sender_id: ObjectId, temp_ids: List[str]):
+        """Drop the claims of submissions that failed so they can be retried."""
+        if not self.redis or not temp_ids:
+            return
+
+        try:
+            await self.redis.delete(
+                *(self._key(sender_id, temp_id) for temp_id in temp_ids)
+            )
+        except Exception as e:
+            logger.error(f"Error releasing message temp ids: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.local.stats(), "duplicates": self.duplicates}
+
+
+submission_dedup = SubmissionDedup(
+    maxsize=settings.MESSAGE_DEDUP_CACHE_SIZE,
+    window_seconds=settings.MESSAGE_DEDUP_WINDOW_SECONDS,
+    claim_ttl_seconds=settings.MESSAGE_DEDUP_CLAIM_TTL_SECONDS,
+)
+
+
+async def get_conversation_participants(
+    db: AsyncDatabase, conv_id: ObjectId
+) -> Optional[List[ObjectId]]:
+    participants = await participant_cache.get(conv_id)
+    if participants is not None:
+        return participants
+
+    conversation = await db.conversation.find_one(
+        {"_id": conv_id}, projection={"participants": 1}
+    )
+    if not conversation:
+        return None
+
+    await participant_cache.set(conv_id, conversation["participants"])
+    return conversation["participants"]
+
 
 async def get_user_form_conversation(
     db: AsyncDatabase, conv_id: ObjectId, user_id: ObjectId
 ):
     try:
-        conversation = await db.conversation.find_one({"_id": conv_id})
+        participants = await get_conversation_participants(db, conv_id)
 
-        if not conversation:
+        if not participants:
             raise WebSocketException(
                 code=status.WS_1007_INVALID_FRAME_PAYLOAD_DATA,
                 reason="Invalid conversation id",
             )
 
-        if user_id not in conversation["participants"]:
+        if user_id not in participants:
             raise WebSocketException(
                 code=status.WS_1007_INVALID_FRAME_PAYLOAD_DATA,
                 reason="User not a participant in the conversation",
             )
 
-        return next(id for id in conversation["participants"] if id != user_id)
+        return next(id for id in participants if id != user_id)
 
     except Exception as e:
         print(e)
@@ -31,6 +246,149 @@ async def get_user_form_conversation(
         )
 
 
+async def allocate_sequence(
+    db: AsyncDatabase,
+    conv_id: ObjectId,
+    count: int = 1,
+    last_message_date: Optional[datetime] = None,
+) -> Optional[int]:
+    """
+    Atomically reserve `count` sequence numbers of a conversation.
+
+    Args:
+        db: Async database connection
+        conv_id: Conversation the messages belong to
+        count: Number of messages that need a sequence number
+        last_message_date: Sending time of the newest message, moved forward
+            in the same update
+
+    Returns:
+        Optional[int]: First sequence number of the reserved range, None if
+            the conversation does not exist.
+    """
+    update: Dict[str, Any] = {"$inc": {"last_seq": count}}
+    if last_message_date:
+        update["$max"] = {"last_message_date": last_message_date}
+
+    conversation = await db.conversation.find_one_and_update(
+        {"_id": conv_id},
+        update,
+        projection={"last_seq": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not conversation:
+        return None
+
+    return conversation["last_seq"] - count + 1
+
+
+class SequenceCounter:
+    """
+    Sequence numbers of conversations reserved in Redis, for deliver_first.
+
+    Each conversation has a hash `seq:{conv_id}` with the `last_seq` of the
+    conversation when the counter was created (`base`) and the number of
+    sequence numbers reserved since (`n`). Reserving is one HINCRBY, so
+    delivery does not wait for a Mongo write; the write-behind buffer moves
+    the conversation's last_seq and last_message_date when it stores the
+    messages. A counter that is missing or expired is seeded again from
+    last_seq, whichever node sets the base first wins.
+
+    Until `bind` is called (e.g. in tests) numbers are reserved in Mongo
+    with `allocate_sequence`.
+    """
+
+    def __init__(self, ttl_seconds: int) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.redis: Optional[redis.Redis] = None
+        self.seeded = 0
+
+    def bind(self, redis: redis.Redis):
+        self.redis = redis
+
+    @staticmethod
+    def _key(conv_id: ObjectId) -> str:
+        return f"seq:{conv_id}"
+
+    async def allocate(
+        self,
+        db: AsyncDatabase,
+        conv_id: ObjectId,
+        count: int = 1,
+        last_message_date: Optional[datetime] = None,
+    ) -> Optional[int]:
+        """
+        Reserve `count` sequence numbers of a conversation.
+
+        Returns:
+            Optional[int]: First sequence number of the reserved range, None if
+                the conversation does not exist.
+        """
+        if not self.redis:
+            return await allocate_sequence(db, conv_id, count, last_message_date)
+
+        key = self._key(conv_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hincrby(key, "n", count)
+            pipe.hget(key, "base")
+            pipe.expire(key, self.ttl_seconds)
+            reserved, base, _ = await pipe.execute()
+
+        if base is None:
+            conversation = await db.conversation.find_one(
+                {"_id": conv_id}, projection={"last_seq": 1}
+            )
+            if not conversation:
+                await self.redis.delete(key)
+                return None
+
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hsetnx(key, "base", conversation.get("last_seq", 0))
+                pipe.hget(key, "base")
+                _, base = await pipe.execute()
+            self.seeded += 1
+
+        return int(base) + reserved - count + 1
+
+    async def last(self, conv_id: ObjectId) -> Optional[int]:
+        """
+        Newest sequence number reserved in a conversation, None if the counter
+        is not bound, missing or unreachable (last_seq is current then).
+        """
+        if not self.redis:
+            return None
+
+        try:
+            base, reserved = await self.redis.hmget(self._key(conv_id), "base", "n")
+        except Exception as e:
+            logger.error(f"Error reading the sequence counter of {conv_id}: {e}")
+            return None
+        if base is None:
+            return None
+        return int(base) + int(reserved or 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"seeded": self.seeded}
+
+
+sequence_counter = SequenceCounter(ttl_seconds=settings.SEQUENCE_COUNTER_TTL_SECONDS)
+
+
+async def reserve_sequence(
+    db: AsyncDatabase,
+    conv_id: ObjectId,
+    count: int = 1,
+    last_message_date: Optional[datetime] = None,
+) -> Optional[int]:
+    """
+    Reserve sequence numbers in Mongo, or in Redis in deliver_first mode so
+    delivery does not wait for a Mongo write.
+    """
+    if settings.MESSAGE_DELIVERY_MODE == "deliver_first":
+        return await sequence_counter.allocate(db, conv_id, count, last_message_date)
+    return await allocate_sequence(db, conv_id, count, last_message_date)
+
+
 async def get_or_create_conversation(
     db: AsyncDatabase, user_id: ObjectId, friend_id: ObjectId
 ):
@@ -57,6 +415,10 @@ async def get_or_create_conversation(
         conversation_resp = await db.conversation.insert_one(
             conv_data.model_dump(exclude={"id"})
         )
+        await participant_cache.set(
+            conversation_resp.inserted_id, conv_data.participants
+        )
+        await contact_index.add_contacts(user_id, friend_id)
 
         # Return the conversation Id
         return str(conversation_resp)
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from app.core.config import settings
+from app.core.db import AsyncDatabase
+from app.core.schemas import Message
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class MessageWriteBuffer:
+    """
+    Write-behind buffer used by the deliver-first chat mode.
+
+    Messages get their ObjectId on the server and are delivered before they
+    are stored; this buffer then persists them in batches of up to
+    `batch_size` messages or every `flush_interval` seconds with one
+    insert_many. Their sequence numbers were reserved in Redis, so the same
+    flush moves the last_seq and last_message_date of their conversations.
+
+    The buffer is bounded: once `max_size` messages are waiting, `add` waits
+    for the writer to catch up. Failed batches are retried with backoff and
+    whatever is still buffered is flushed when the app shuts down.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        batch_size: int,
+        flush_interval: float,
+        max_retries: int,
+    ) -> None:
+        self.queue: asyncio.Queue[Message] = asyncio.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.db: Optional[AsyncDatabase] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch: List[Message] = []
+        self.flushed = 0
+        self.retries = 0
+        self.lost = 0
+
+    def start(self, db: AsyncDatabase):
+        self.db = db
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer and flush everything that is still buffered."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        # The batch being written when the writer was cancelled may be partially
+        # stored, duplicates are ignored when it is written again
+        batch, self._batch = self._batch, []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+        for start in range(0, len(batch), self.batch_size):
+            await self._flush(batch[start : start + self.batch_size])
+
+    async def add(self, message: Message):
+        await self.queue.put(message)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            self._batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+
+            while len(self._batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(self.queue.get(), timeout)
+                except TimeoutError:
+                    break
+                self._batch.append(message)
+
+            await self._flush(self._batch)
+            self._batch = []
+
+    async def _flush(self, batch: List[Message]):
+        if not batch:
+            return
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                rejected = await self._write(batch)
+                self.flushed += len(batch) - rejected
+                return
+            except PyMongoError as e:
+                logger.error(f"Write-behind flush failed (attempt {attempt + 1}): {e}")
+                self.retries += 1
+                await asyncio.sleep(min(2**attempt * 0.1, 5))
+
+        self.lost += len(batch)
+        logger.critical(
+            f"Dropping {len(batch)} messages after {self.max_retries} retries: "
+            f"{[str(message.id) for message in batch]}"
+        )
+
+    async def _write(self, batch: List[Message]) -> int:
+        """Store the batch and return how many messages could not be stored."""
+        if self.db is None:
+            raise RuntimeError("Write-behind buffer is not started")
+
+        documents = [
+            {**message.model_dump(exclude={"id", "temp_id"}), "_id": message.id}
+            for message in batch
+        ]
+        rejected = 0
+        try:
+            await self.db.message.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            # A duplicate _id is a message stored by an earlier attempt, any
+            # other duplicate key is another message holding its seq
+            duplicates = [documents[error["index"]] for error in errors]
+            stored = await self._stored_ids(errors, duplicates)
+            lost = [str(doc["_id"]) for doc in duplicates if doc["_id"] not in stored]
+            if lost:
+                rejected = len(lost)
+                self.lost += rejected
+                logger.critical(
+                    f"Dropping {rejected} messages with a taken seq: {lost}"
+                )
+
+        # conversation -> (newest seq, newest sending time) in the batch
+        latest: Dict[ObjectId, Tuple[int, datetime]] = {}
+        for message in batch:
+            seq, sending_time = latest.get(
+                message.conversation_id, (0, message.sending_time)
+            )
+            latest[message.conversation_id] = (
+                max(seq, message.seq or 0),
+                max(sending_time, message.sending_time),
+            )
+        await self.db.conversation.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": conv_id},
+                    {"$max": {"last_seq": seq, "last_message_date": sending_time}},
+                )
+                for conv_id, (seq, sending_time) in latest.items()
+            ],
+            ordered=False,
+        )
+        return rejected
+
+    async def _stored_ids(
+        self, errors: List[Dict[str, Any]], duplicates: List[Dict[str, Any]]
+    ) -> Set[ObjectId]:
+        stored = {
+            doc["_id"]
+            for error, doc in zip(errors, duplicates)
+            if error.get("keyPattern") == {"_id": 1}
+        }
+        # Servers that do not report the key pattern are asked directly
+        unknown = [
+            doc["_id"]
+            for error, doc in zip(errors, duplicates)
+            if "keyPattern" not in error
+        ]
+        if unknown and self.db is not None:
+            cursor = self.db.message.find({"_id": {"$in": unknown}}, {"_id": 1})
+            stored.update(doc["_id"] for doc in await cursor.to_list(length=None))
+        return stored
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": self.queue.qsize() + len(self._batch),
+            "flushed": self.flushed,
+            "retries": self.retries,
+            "lost": self.lost,
+        }
+
+
+message_buffer = MessageWriteBuffer(
+    max_size=settings.WRITE_BEHIND_MAX_SIZE,
+    batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL,
+    max_retries=settings.WRITE_BEHIND_MAX_RETRIES,
+)
@@ -0,0 +1,73 @@
+import logging
+from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
+
+from app.core.schemas import MessagePacket, MuxPacket, SyncPacket, UserAuthOut
+from app.core.codec import MUX_HEARTBEATS, PONG, decode_frame, receive_frame
+from app.core.connections import open_session
+from app.core.db import AsyncDatabase, get_async_database_from_socket
+from app.core.message_broker import AbstractRobustConnection, get_rabbit_connection
+from app.deps import get_user_from_access_token_ws
+from app.api.msg_socket.router import (
+    connections as msg_connections,
+    handle_packet as handle_message_packet,
+)
+from app.api.sync_socket.router import (
+    connections as sync_connections,
+    handle_packet as handle_sync_packet,
+)
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+
+@router.websocket("/")
+async def multiplexed_socket(
+    websocket: WebSocket,
+    user: UserAuthOut = Depends(get_user_from_access_token_ws),
+    db: AsyncDatabase = Depends(get_async_database_from_socket),
+    queue_connection: AbstractRobustConnection = Depends(get_rabbit_connection),
+):
+    """
+    One socket carrying both the message and the sync channel.
+
+    Every frame is a MuxPacket, {"channel": "message" | "sync", "packet": ...},
+    where the packet is what the dedicated socket of that channel would carry.
+    The single session is registered with both connection managers, so the
+    client needs one auth, one socket and one heartbeat instead of two.
+    """
+    session = await open_session(user.id, websocket, multiplexed=True)
+    await msg_connections.add_session(session)
+    await sync_connections.add_session(session, queue_connection)
+
+    try:
+        while True:
+            data = await receive_frame(websocket)
+            session.touch()
+
+            # one heartbeat for the whole socket, answered without parsing it
+            channel = MUX_HEARTBEATS.get(data)
+            if channel:
+                session.send(PONG, channel)
+                continue
+
+            mux: MuxPacket = decode_frame(MuxPacket, data)
+
+            if mux.channel == msg_connections.channel:
+                await handle_message_packet(
+                    session, MessagePacket.model_validate(mux.packet), db
+                )
+            else:
+                await handle_sync_packet(
+                    session,
+                    SyncPacket.model_validate(mux.packet),
+                    db,
+                    queue_connection,
+                )
+
+    except WebSocketDisconnect as e:
+        logger.error(f"User disconnected: {e}")
+    finally:
+        session.close()
+        await msg_connections.remove_session(session)
+        await sync_connections.remove_session(session, queue_connection)
+    return
@@ -1,16 +1,16 @@
+import asyncio
 from datetime import datetime
 from bson import ObjectId
 import logging
-from typing import Literal, List, Dict, Annotated, Optional
+from typing import Dict, Literal, List, Annotated, Optional
 from fastapi import APIRouter, Depends, Query, WebSocket, WebSocketDisconnect, Path
-from pymongo import UpdateOne
 from app.core.schemas import (
     SyncSocketMessage,
     SyncPacket,
     PacketType,
     SyncMessageType,
     MessageStatusUpdate,
-    Message_Status,
+    MessageWatermark,
     UserAuthOut,
     WebRTCOffer,
     WebRTCAnswer,
@@ -21,13 +21,16 @@ from app.core.schemas import (
 )
 from app.deps import get_user_from_access_token_ws, get_user_from_access_token_http
 from app.core.config import settings
+from app.core.codec import HEARTBEATS, PONG, decode_frame, receive_frame
+from app.core.connections import ConnectionManager, Session, open_session
+from app.core.presence import presence
 from app.core.db import (
     AsyncDatabase,
     get_async_database_from_socket,
     get_async_database,
 )
 from app.core.message_broker import (
-    publish_message,
+    publish_message_nowait,
     AbstractRobustConnection,
     get_rabbit_connection,
 )
@@ -37,42 +40,112 @@ from .services import (
     process_call_end,
     get_call_record,
     list_call_record,
+    advance_watermark,
 )
 from .schemas import OnlineStatus
+from .status_buffer import status_aggregator
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Messages worth replaying to a user that was offline, calls and presence are not
+OFFLINE_MESSAGE_TYPES = {
+    SyncMessageType.message_status,
+    SyncMessageType.message_watermark,
+    SyncMessageType.friend_update,
+    SyncMessageType.friend_request,
+    SyncMessageType.add_friend,
+    SyncMessageType.profile_media,
+}
 
-# TODO:This way of handling websocket objects will fail if a user connect from two different devices
-class ConnectionManager:
-    def __init__(self) -> None:
-        self.active_connection: Dict[ObjectId, WebSocket] = {}
+
+class SyncConnectionManager(ConnectionManager):
+    """
+    Connection registry that also announces online/offline transitions.
+
+    Going offline is debounced: it is announced only if the user is still
+    offline, on every node, after PRESENCE_OFFLINE_GRACE_SECONDS. A user that
+    reconnects within the grace period never appears offline, so flapping
+    mobile links and reconnect storms during deploys publish nothing.
+
+    On shutdown `flush_offline` announces the pending transitions right away,
+    so users whose last session closed with the node don't stay online.
+    """
+
+    def __init__(self, channel: str) -> None:
+        super().__init__(channel)
+        self.pending_offline: Dict[ObjectId, asyncio.Task] = {}
 
     async def connect(
         self,
         user_id: ObjectId,
         websocket: WebSocket,
         connection: AbstractRobustConnection,
+    ) -> Session:
+        session = await open_session(user_id, websocket)
+        await self.add_session(session, connection)
+        return session
+
+    async def disconnect(
+        self, session: Session, connection: AbstractRobustConnection
+    ) -> bool:
+        session.close()
+        return await self.remove_session(session, connection)
+
+    async def add_session(self, session: Session, connection: AbstractRobustConnection):
+        was_online = self.is_online(session.user_id)
+        await super().add_session(session)
+        await presence.add(session)
+
+        # Only the first device of a user changes the online status
+        if not was_online:
+            pending = self.pending_offline.pop(session.user_id, None)
+            if pending:
+                # Back within the grace period, nobody saw the user go offline
+                pending.cancel()
+            else:
+                await notify_online_status(connection, session.user_id, "online")
+
+    async def remove_session(
+        self, session: Session, connection: AbstractRobustConnection
+    ) -> bool:
+        last_session = await super().remove_session(session)
+        await presence.remove(session)
+
+        # The user stays online while any other device is connected
+        if last_session and session.user_id not in self.pending_offline:
+            self.pending_offline[session.user_id] = asyncio.create_task(
+                self._notify_offline_later(session.user_id, connection)
+            )
+        return last_session
+
+    async def _notify_offline_later(
+        self, user_id: ObjectId, connection: AbstractRobustConnection
     ):
-        await websocket.accept()
-        self.active_connection[user_id] = websocket
-        await notify_online_status(connection, user_id, "online")
+        await asyncio.sleep(settings.PRESENCE_OFFLINE_GRACE_SECONDS)
+        self.pending_offline.pop(user_id, None)
 
-    async def disconnect(self, user_id: ObjectId, connection: AbstractRobustConnection):
-        if user_id in self.active_connection:
-            del self.active_connection[user_id]
-            await notify_online_status(connection, user_id, "offline")
+        # The user may have come back on another node meanwhile
+        if await presence.is_online(user_id):
+            return
+        await notify_online_status(connection, user_id, "offline")
 
-    def is_online(self, user_id: ObjectId):
-        return user_id in self.active_connection
+    async def flush_offline(self, connection: AbstractRobustConnection):
+        """Announce the users still in their grace period that are offline now."""
+        pending, self.pending_offline = self.pending_offline, {}
+        for task in pending.values():
+            task.cancel()
+        await asyncio.gather(*pending.values(), return_exceptions=True)
+        if not pending:
+            return
 
-    async def send_personal_message(self, user_id: ObjectId, message: SyncPacket):
-        if self.active_connection[user_id]:
-            await self.active_connection[user_id].send_text(message.model_dump_json())
+        online = set(await presence.is_online_many(pending))
+        for user_id in pending:
+            if user_id not in online:
+                await notify_online_status(connection, user_id, "offline")
 
 
-connections = ConnectionManager()
+connections = SyncConnectionManager(channel="sync")
 
 
 @router.websocket("/")
@@ -82,27 +155,43 @@ async def websocket_endpoint(
     db: AsyncDatabase = Depends(get_async_database_from_socket),
     queue_connection: AbstractRobustConnection = Depends(get_rabbit_connection),
 ):
-    await connections.connect(user.id, websocket, queue_connection)
+    session = await connections.connect(user.id, websocket, queue_connection)
 
     try:
         while True:
-            data = await websocket.receive_text()
-            packet: SyncPacket = SyncPacket.model_validate_json(data)
-            if packet.type == PacketType.ping:
-                await connections.send_personal_message(
-                    user_id=user.id, message=SyncPacket(type=PacketType.pong)
-                )
-            elif packet.type == PacketType.message and packet.data:
-                await handle_recieved_message(
-                    db, user_id=user.id, message=packet.data, queue=queue_connection
-                )
+            data = await receive_frame(websocket)
+            session.touch()
+
+            # heartbeats are answered without parsing them
+            if data in HEARTBEATS:
+                session.send(PONG, connections.channel)
+                continue
+
+            packet: SyncPacket = decode_frame(SyncPacket, data)
+            await handle_packet(session, packet, db, queue_connection)
 
     except WebSocketDisconnect as e:
         logger.error(f"User disconnected: {e}")
-        await connections.disconnect(user.id, queue_connection)
+    finally:
+        await connections.disconnect(session, queue_connection)
     return
 
 
+async def handle_packet(
+    session: Session,
+    packet: SyncPacket,
+    db: AsyncDatabase,
+    queue: AbstractRobustConnection,
+):
+    """Handle a packet received on the sync channel of a session."""
+    if packet.type == PacketType.ping:
+        session.send(PONG, connections.channel)
+    elif packet.type == PacketType.message and packet.data:
+        await handle_recieved_message(
+            db, user_id=session.user_id, message=packet.data, queue=queue
+        )
+
+
 async def handle_recieved_message(
     db: AsyncDatabase,
     user_id: ObjectId,
@@ -115,53 +204,32 @@ async def handle_recieved_message(
             msg: MessageStatusUpdate = MessageStatusUpdate.model_validate(
                 message.model_dump()
             )
-            message_status = msg.status.value
 
-            # Determine the correct field to update in the database
-            time_field = (
-                "seen_time"
-                if message_status == Message_Status.seen
-                else "received_time"
-            )
-            # Prepare bulk update operations for each message in the update list
-            updates = [
-                UpdateOne(
-                    {
-                        "_id": ObjectId(obj.message_id),
-                        time_field: None,
-                        "sender_id": {"$ne": user_id},
-                    },
-                    {
-                        "$set": {
-                            "status": message_status,
-                            time_field: obj.timestamp,
-                        }
-                    },
-                )
-                for obj in msg.data
-            ]
-
-            if updates:
-                await db.message.bulk_write(updates)
-
-                # Publish the updated messages to the queue for further processing
-                await publish_message(
-                    connection=queue,
-                    exchange_name=settings.EXCHANGES.sync_message.value,
-                    topic=settings.TOPICS.message_status_update.value,
-                    data=msg,
-                )
+            # Stored and published together with the acks of other sockets
+            status_aggregator.add(user_id, msg)
         except Exception as e:
             logger.critical(e)
 
+    elif message.type == SyncMessageType.message_watermark:
+        watermark: MessageWatermark = message
+        watermark.user_id = user_id
+
+        # One conversation update however many messages it covers
+        recipients = await advance_watermark(
+            user_id=user_id, watermark=watermark, db=db
+        )
+        if recipients:
+            # The other devices of the user follow along as well
+            await send_message(user_ids=[*recipients, user_id], message_data=watermark)
+
     # Handle WebRTC "offer" message (incoming call offer)
     elif message.type == "offer":
         offer: WebRTCOffer = message
 
         # Set default call status
         call_status = CallStatus.CALLING
-        # If receiver is online, mark the call as ringing
-        if connections.is_online(ObjectId(offer.receiver_id)):
+        # If receiver is online on any node, mark the call as ringing
+        if await presence.is_online(ObjectId(offer.receiver_id)):
             call_status = CallStatus.RINGING
 
         # Create the call record and get the initial status update
@@ -217,21 +285,24 @@ async def handle_recieved_message(
 
 async def send_message(user_ids: List[ObjectId], message_data: SyncSocketMessage):
     """
-    Send message to list of users IDs if online
+    Send message to list of users IDs on whichever node they are connected,
+    users that are offline get it on reconnect if it is worth replaying
 
     Args:
         user_ids : List of IDs to send the message to.
         message_data : The message to send.
     """
 
-    for user_id in user_ids:
-        try:
-            if connections.is_online(user_id):
-                data_packet = SyncPacket(type=PacketType.message, data=message_data)
+    try:
+        data_packet = SyncPacket(type=PacketType.message, data=message_data)
 
-                await connections.send_personal_message(user_id, data_packet)
-        except Exception as e:
-            logger.error(f"Error sending message to user {user_id}: {e}")
+        await connections.deliver(
+            user_ids,
+            data_packet,
+            store_offline=message_data.type in OFFLINE_MESSAGE_TYPES,
+        )
+    except Exception as e:
+        logger.error(f"Error sending message to users {user_ids}: {e}")
 
 
 async def notify_online_status(
@@ -240,11 +311,13 @@ async def notify_online_status(
     is_online: Literal["online", "offline"],
 ):
     data = OnlineStatus(user_id=str(user_id), status=is_online)
-    await publish_message(
+    # Confirmed in the background, connecting sockets don't wait for the broker
+    publish_message_nowait(
         connection=connection,
         exchange_name=settings.EXCHANGES.sync_message.value,
         topic=settings.TOPICS.online_status.value,
         data=data,
+        persistent=True,
     )
 
 
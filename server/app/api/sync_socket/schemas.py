@@ -1,6 +1,9 @@
-from pydantic import BaseModel
+import time
+from pydantic import BaseModel, Field
 
 
 class OnlineStatus(BaseModel):
     user_id: str
     status: str
+    # when the status changed, the newest change of a user wins
+    timestamp: float = Field(default_factory=time.time)
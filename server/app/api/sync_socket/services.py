@@ -1,8 +1,9 @@
-from typing import Optional, List
+from typing import Any, Dict, Optional, List
 from bson import ObjectId
 import logging
 from datetime import datetime
 from pymongo import ReturnDocument
+from app.core.config import settings
 from app.core.db import AsyncDatabase
 from app.core.schemas import (
     CallRecord,
@@ -14,7 +15,10 @@ from app.core.schemas import (
     WebRTCAnswer,
     CallEndedPayLoad,
     CallStatusUpdate,
+    Message_Status,
+    MessageWatermark,
 )
+from app.api.msg_socket.services import sequence_counter
 
 logger = logging.getLogger()
 
@@ -325,3 +329,48 @@ async def list_call_record(
     call_records = [CallRecord.model_validate(data) for data in raw_record]
 
     return call_records
+
+
+async def advance_watermark(
+    user_id: ObjectId, watermark: MessageWatermark, db: AsyncDatabase
+) -> Optional[List[ObjectId]]:
+    """
+    Move the receipt of a participant forward to the watermark.
+
+    Watermarks only move forward and never past the newest message, seeing
+    a message implies receiving it. Older or repeated watermarks are no-ops.
+    In deliver_first mode the newest message is read from the sequence
+    counter, the conversation's last_seq lags it until the messages are stored.
+
+    Returns:
+    Optional[List[ObjectId]]: The other participants to notify, None if the
+    watermark did not advance or the user is not part of the conversation.
+    """
+    fields = ["received_seq"]
+    if watermark.status == Message_Status.seen:
+        fields.insert(0, "seen_seq")
+
+    query: Dict[str, Any] = {"_id": watermark.conversation_id, "participants": user_id}
+    newest = None
+    if settings.MESSAGE_DELIVERY_MODE == "deliver_first":
+        newest = await sequence_counter.last(watermark.conversation_id)
+    if newest is None:
+        query["last_seq"] = {"$gte": watermark.seq}
+    elif watermark.seq > newest:
+        return None
+
+    receipt = f"receipts.{user_id}"
+    previous = await db.conversation.find_one_and_update(
+        query,
+        {"$max": {f"{receipt}.{field}": watermark.seq for field in fields}},
+        projection={"participants": 1, receipt: 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if not previous:
+        return None
+
+    previous_seq = previous.get("receipts", {}).get(str(user_id), {}).get(fields[0], 0)
+    if previous_seq >= watermark.seq:
+        return None
+
+    return [id for id in previous["participants"] if id != user_id]
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from aio_pika.abc import AbstractRobustConnection
+
+from app.core.config import settings
+from app.core.db import AsyncDatabase
+from app.core.message_broker import publish_message
+from app.core.metrics import stage_metrics
+from app.core.schemas import (
+    Message_Status,
+    MessageEvent,
+    MessageStatusBatch,
+    MessageStatusUpdate,
+)
+
+logger = logging.getLogger(__name__)
+
+# Received is applied before seen, so a message acked twice in one window
+# ends up seen
+STATUS_ORDER = (Message_Status.recieved, Message_Status.seen)
+
+
+class MessageStatusAggregator:
+    """
+    Collects per-message status updates from every sync socket.
+
+    Updates are buffered for `flush_interval` seconds or until `max_events`
+    are waiting, then stored with one bulk_write and announced with one
+    publish of a MessageStatusBatch, which the consumer groups by sender.
+    Repeated acks of the same message and status within a window are
+    written once.
+
+    Whatever is still buffered is flushed when the app shuts down.
+    """
+
+    def __init__(self, flush_interval: float, max_events: int) -> None:
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.db: Optional[AsyncDatabase] = None
+        self.connection: Optional[AbstractRobustConnection] = None
+        # status -> message ID -> (acking user, timestamp)
+        self.pending: Dict[
+            Message_Status, Dict[ObjectId, Tuple[ObjectId, datetime]]
+        ] = {}
+        self.size = 0
+        self._timer: Optional[asyncio.Task] = None
+        self._flushes: set[asyncio.Task] = set()
+        self.packets = 0
+        self.events = 0
+        self.batched = 0
+        self.flushes = 0
+        self.max_batch = 0
+        self.failed = 0
+        self.unannounced = 0
+
+    def start(self, db: AsyncDatabase, connection: AbstractRobustConnection):
+        self.db = db
+        self.connection = connection
+
+    async def stop(self):
+        """Flush everything that is still buffered."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        self._flush_now()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def add(self, user_id: ObjectId, update: MessageStatusUpdate):
+        self.packets += 1
+        events = self.pending.setdefault(update.status, {})
+        for event in update.data:
+            self.events += 1
+            message_id = ObjectId(event.message_id)
+            if message_id not in events:
+                events[message_id] = (user_id, event.timestamp)
+                self.size += 1
+
+        if self.size >= self.max_events:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._flush_now()
+        elif self._timer is None and self.size:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        self._flush_now()
+
+    def _flush_now(self):
+        if not self.size:
+            return
+
+        pending, self.pending, self.size = self.pending, {}, 0
+        task = asyncio.create_task(self.flush(pending))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(
+        self, pending: Dict[Message_Status, Dict[ObjectId, Tuple[ObjectId, datetime]]]
+    ):
+        if self.db is None or self.connection is None:
+            raise RuntimeError("Message status aggregator is not started")
+
+        updates: List[UpdateOne] = []
+        batch = MessageStatusBatch(updates=[])
+        for status in STATUS_ORDER:
+            events = pending.get(status)
+            if not events:
+                continue
+
+            time_field = (
+                "seen_time" if status == Message_Status.seen else "received_time"
+            )
+            updates.extend(
+                UpdateOne(
+                    {
+                        "_id": message_id,
+                        time_field: None,
+                        "sender_id": {"$ne": user_id},
+                    },
+                    {"$set": {"status": status.value, time_field: timestamp}},
+                )
+                for message_id, (user_id, timestamp) in events.items()
+            )
+            batch.updates.append(
+                MessageStatusUpdate(
+                    status=status,
+                    data=[
+                        MessageEvent(message_id=str(message_id), timestamp=timestamp)
+                        for message_id, (_, timestamp) in events.items()
+                    ],
+                )
+            )
+
+        self.flushes += 1
+        self.batched += len(updates)
+        self.max_batch = max(self.max_batch, len(updates))
+        try:
+            with stage_metrics.time("status.flush"):
+                await self.db.message.bulk_write(updates)
+                # Stored already, a lost announcement only delays the senders'
+                # ticks until they resync
+                if not await publish_message(
+                    connection=self.connection,
+                    exchange_name=settings.EXCHANGES.sync_message.value,
+                    topic=settings.TOPICS.message_status_update.value,
+                    data=batch,
+                    persistent=True,
+                ):
+                    self.unannounced += len(updates)
+        except PyMongoError as e:
+            self.failed += len(updates)
+            logger.error(f"Failed to store {len(updates)} message status updates: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": self.size,
+            "packets": self.packets,
+            "events": self.events,
+            "flushes": self.flushes,
+            "mean_batch": (
+                round(self.batched / self.flushes, 2) if self.flushes else 0.0
+            ),
+            "max_batch": self.max_batch,
+            # one bulk_write and one publish per packet before batching
+            "round_trips_saved": 2 * max(self.packets - self.flushes, 0),
+            "failed": self.failed,
+            "unannounced": self.unannounced,
+        }
+
+
+status_aggregator = MessageStatusAggregator(
+    flush_interval=settings.STATUS_FLUSH_INTERVAL,
+    max_events=settings.STATUS_BATCH_SIZE,
+)
@@ -1,16 +1,23 @@
-import json
-from typing import List
+import asyncio
+from typing import Dict, List, Literal, Optional, Tuple
 import logging
 from bson import ObjectId
 from aio_pika.abc import AbstractIncomingMessage
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from app.core.config import settings
+from app.core.contacts import contact_index
 from app.core.db import AsyncDatabase
+from app.core.metrics import stage_metrics
 from app.core.schemas import (
     OnlineStatusMessage,
+    OnlineStatusBatch,
     ProfileMediaUpdate,
     MessageNoAlias,
     Message,
 )
 from app.api.sync_socket.router import send_message as send_sync_message
+from app.api.sync_socket.schemas import OnlineStatus
 from app.api.msg_socket.router import send_message
 from app.api.msg_socket.services import get_user_form_conversation
 
@@ -18,27 +25,149 @@ from app.api.msg_socket.services import get_user_form_conversation
 logger = logging.getLogger(__name__)
 
 
-async def distribute_online_status_update(
-    message: AbstractIncomingMessage, db: AsyncDatabase
-) -> None:
-    data = json.loads(message.body.decode("utf-8"))
-    user_id = data["user_id"]
-    user_list: List[ObjectId] = []
+class OnlineStatusBatcher:
+    """
+    Coalesces online status changes per recipient.
+
+    Changes are collected for `flush_interval` seconds (the newest status of
+    a user wins), then the contacts of all changed users are read from the
+    contact index in one round trip and every recipient gets one packet with all the changes
+    relevant to them. Recipients with the same set of changes share one
+    serialized frame.
+
+    Nodes consuming the shared queue flush on their own timers, so the
+    timestamp of the newest change of every user is kept in Redis and a node
+    holding an older change drops it. Until `bind` is called only the changes
+    buffered on this node are compared.
+    """
+
+    LATEST_KEY = "online-status:latest"
+
+    def __init__(self, flush_interval: float) -> None:
+        self.flush_interval = flush_interval
+        # user id -> (status, timestamp of the change)
+        self.pending: Dict[str, Tuple[Literal["online", "offline"], float]] = {}
+        self.redis: Optional[Redis] = None
+        self._db: Optional[AsyncDatabase] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def bind(self, redis: Redis):
+        self.redis = redis
+
+    async def add(
+        self,
+        db: AsyncDatabase,
+        user_id: str,
+        status: Literal["online", "offline"],
+        timestamp: float,
+    ):
+        if self.redis:
+            try:
+                await self.redis.zadd(self.LATEST_KEY, {user_id: timestamp}, gt=True)
+            except RedisError as e:
+                logger.error(f"Error recording online status of {user_id}: {e}")
+
+        current = self.pending.get(user_id)
+        if current is None or current[1] <= timestamp:
+            self.pending[user_id] = (status, timestamp)
+
+        self._db = db
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later(db))
+
+    async def _flush_later(self, db: AsyncDatabase):
+        await asyncio.sleep(self.flush_interval)
+        changes, self.pending = self.pending, {}
+        self._flush_task = None
+
+        try:
+            await self.flush(db, changes)
+        except Exception as e:
+            logger.error(f"Error distributing online status changes: {e}")
+
+    async def stop(self):
+        """Distribute the changes that are still buffered."""
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+
+        changes, self.pending = self.pending, {}
+        if changes and self._db is not None:
+            await self.flush(self._db, changes)
+
+    async def _drop_superseded(
+        self, changes: Dict[str, Tuple[Literal["online", "offline"], float]]
+    ) -> Dict[str, Tuple[Literal["online", "offline"], float]]:
+        if not self.redis:
+            return changes
+
+        user_ids = list(changes)
+        try:
+            latest = await self.redis.zmscore(self.LATEST_KEY, user_ids)
+        except RedisError as e:
+            logger.error(f"Error reading the latest online status changes: {e}")
+            return changes
 
-    # Retrive the conversations with the user
-    async for document in db.conversation.find(
-        {"participants": {"$all": [ObjectId(user_id)]}}
+        return {
+            user_id: change
+            for user_id, change, newest in zip(user_ids, changes.values(), latest)
+            if newest is None or change[1] >= newest
+        }
+
+    async def flush(
+        self,
+        db: AsyncDatabase,
+        changes: Dict[str, Tuple[Literal["online", "offline"], float]],
     ):
-        # Add the firend id to the list
-        user_list.extend(
-            ObjectId(userid)
-            for userid in document["participants"]
-            if str(userid) != user_id
+        changes = await self._drop_superseded(changes)
+        if not changes:
+            return
+
+        contacts = await contact_index.get_contacts_many(
+            db, [ObjectId(user_id) for user_id in changes]
         )
 
-    # Prepare the date and sending it to the list of user
-    msg_data = OnlineStatusMessage(user_id=user_id, status=data["status"])
-    await send_sync_message(user_ids=user_list, message_data=msg_data)
+        # recipient -> {changed user: status}
+        per_recipient: Dict[ObjectId, Dict[str, Literal["online", "offline"]]] = {}
+        for changed_id, recipient_ids in contacts.items():
+            status, _ = changes[str(changed_id)]
+            for recipient_id in recipient_ids:
+                per_recipient.setdefault(recipient_id, {})[str(changed_id)] = status
+
+        # recipients that get exactly the same changes share a frame
+        groups: Dict[Tuple[Tuple[str, str], ...], List[ObjectId]] = {}
+        for recipient_id, statuses in per_recipient.items():
+            groups.setdefault(tuple(sorted(statuses.items())), []).append(recipient_id)
+
+        for statuses, recipient_ids in groups.items():
+            updates = [
+                OnlineStatusMessage(user_id=user_id, status=status)
+                for user_id, status in statuses
+            ]
+            await send_sync_message(
+                user_ids=recipient_ids,
+                message_data=(
+                    updates[0] if len(updates) == 1 else OnlineStatusBatch(data=updates)
+                ),
+            )
+
+
+online_status_batcher = OnlineStatusBatcher(
+    flush_interval=settings.PRESENCE_FLUSH_INTERVAL
+)
+
+
+async def distribute_online_status_update(
+    message: AbstractIncomingMessage, db: AsyncDatabase
+) -> None:
+    data = OnlineStatus.model_validate_json(message.body)
+    await online_status_batcher.add(
+        db,
+        user_id=data.user_id,
+        status=data.status,  # type: ignore
+        timestamp=data.timestamp,
+    )
 
 
 async def send_profilemedia_update_confirmation(
@@ -53,17 +182,19 @@ async def send_profilemedia_update_confirmation(
 async def _distribute_published_messages(
     data: AbstractIncomingMessage, db: AsyncDatabase
 ):
-    decoded_data = data.body.decode("utf-8")
-    message_alias = MessageNoAlias.model_validate_json(decoded_data)
-    message = Message.model_validate(message_alias.model_dump(by_alias=True))
-
-    # Send the message back to sender with all data
-    await send_message(user_id=message.sender_id, message_data=message)
+    with stage_metrics.time("published.validate"):
+        decoded_data = data.body.decode("utf-8")
+        message_alias = MessageNoAlias.model_validate_json(decoded_data)
+        message = Message.model_validate(message_alias.model_dump(by_alias=True))
 
     # Getting the receiver's ID
-    receiver_id = await get_user_form_conversation(
-        db, message.conversation_id, message.sender_id
-    )
+    with stage_metrics.time("published.conversation_lookup"):
+        receiver_id = await get_user_form_conversation(
+            db, message.conversation_id, message.sender_id
+        )
 
-    # Sending the message to receiver
-    await send_message(user_id=receiver_id, message_data=message)
+    # Send the message to the receiver and back to sender with all data
+    with stage_metrics.time("published.deliver"):
+        await send_message(
+            user_ids=[message.sender_id, receiver_id], message_data=message
+        )
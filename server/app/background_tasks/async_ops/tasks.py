@@ -1,13 +1,19 @@
+from typing import Dict, List, Tuple, Union
 from bson import ObjectId
 import logging
+from pydantic import TypeAdapter
 from aio_pika.abc import AbstractIncomingMessage
 from pymongo.errors import PyMongoError
 from app.core.config import settings
-from app.api.sync_socket.router import send_message as send_sync_message
+from app.api.sync_socket.router import (
+    send_message as send_sync_message,
+    connections as sync_connections,
+)
 from app.core.schemas import (
     MessageEvent,
     FriendUpdateMessage,
     MessageStatusUpdate,
+    MessageStatusBatch,
     Message,
     FriendRequestDB,
     UserBrief,
@@ -15,12 +21,22 @@ from app.core.schemas import (
     SyncMessageType,
     BrodcastMessage,
     Message_Status,
+    DeliveryEnvelope,
+    SyncPacket,
+    PacketType,
 )
 from app.core.db import (
     AsyncDatabase,
     create_async_client,
 )
-from app.core.message_broker import rabbit_consumer
+from app.core.contacts import contact_index
+from app.core.message_broker import (
+    body_field,
+    rabbit_batch_consumer,
+    rabbit_consumer,
+)
+from app.core.metrics import stage_metrics
+from app.core.routing import node_router
 from app.api.user.services import get_full_user
 from .services import (
     distribute_online_status_update,
@@ -30,6 +46,11 @@ from .services import (
 
 logger = logging.getLogger(__name__)
 
+# Status updates are published in batches, single updates are still accepted
+STATUS_PAYLOAD: TypeAdapter[Union[MessageStatusBatch, MessageStatusUpdate]] = (
+    TypeAdapter(Union[MessageStatusBatch, MessageStatusUpdate])
+)
+
 
 # async def watch_user_updates():
 #     client = create_async_client()
@@ -66,6 +87,9 @@ logger = logging.getLogger(__name__)
 @rabbit_consumer(
     topic_name=settings.TOPICS.online_status.value,
     exchange_name=settings.EXCHANGES.sync_message.value,
+    queue_name=settings.QUEUES.online_status.value,
+    # no ordering key, the batcher keeps the newest change of a user
+    concurrency=settings.CONSUMER_CONCURRENCY,
 )
 async def handle_online_status_update(
     message: AbstractIncomingMessage, db: AsyncDatabase
@@ -73,61 +97,78 @@ async def handle_online_status_update(
     await distribute_online_status_update(message=message, db=db)
 
 
-@rabbit_consumer(
+@rabbit_batch_consumer(
     topic_name=settings.TOPICS.message_status_update.value,
     exchange_name=settings.EXCHANGES.sync_message.value,
+    queue_name=settings.QUEUES.message_status_update.value,
+    max_batch_size=settings.CONSUMER_BATCH_SIZE,
+    max_wait=settings.CONSUMER_BATCH_WAIT,
 )
 async def process_message_status_updates(
-    message: AbstractIncomingMessage, db: AsyncDatabase
-):
+    messages: List[AbstractIncomingMessage], db: AsyncDatabase
+) -> List[AbstractIncomingMessage]:
     """
     Processes message status updates and forwards them to relevant senders.
 
     This function:
-    1. Decodes incoming message status updates
-    2. Queries affected messages from database
-    3. Groups messages by sender
-    4. Forwards status updates to each sender
+    1. Decodes the incoming status updates (single updates or batches of them)
+    2. Queries all affected messages of every event in one query
+    3. Groups messages by sender and status
+    4. Forwards one status update per sender and status
 
     Args:
-        message: Incoming RabbitMQ message containing status update payload
+        messages: Incoming RabbitMQ messages containing status update payloads
         db: Async database connection
-    """
-    try:
-        try:
-            decoded_data = message.body.decode("utf-8")
-            payload: MessageStatusUpdate = MessageStatusUpdate.model_validate_json(
-                decoded_data
-            )
-
-            message_ids = [ObjectId(data.message_id) for data in payload.data]
-
-        except (UnicodeDecodeError, ValueError) as e:
-            logger.error(f"Failed to decode or validate message payload: {e}")
-            return
-        state = (
-            "received_time"
-            if payload.status == Message_Status.recieved.value
-            else "seen_time"
-        )
 
+    Returns:
+        The messages to retry, all of them if the database query failed.
+        Invalid payloads are dropped.
+    """
+    updates: List[MessageStatusUpdate] = []
+    valid: List[AbstractIncomingMessage] = []
+    with stage_metrics.time("status.validate"):
+        for message in messages:
+            try:
+                payload = STATUS_PAYLOAD.validate_json(message.body)
+            except (UnicodeDecodeError, ValueError) as e:
+                logger.error(f"Failed to decode or validate message payload: {e}")
+                continue
+
+            valid.append(message)
+            if isinstance(payload, MessageStatusUpdate):
+                updates.append(payload)
+            else:
+                updates.extend(payload.updates)
+
+    message_ids = list(
+        {ObjectId(data.message_id) for update in updates for data in update.data}
+    )
+    if not message_ids:
+        return []
+
+    # (sender, status) -> message ID -> event, the same ack may arrive twice
+    sender_data: Dict[Tuple[ObjectId, Message_Status], Dict[str, MessageEvent]] = {}
+    with stage_metrics.time("status.lookup"):
         try:
             cursor = db.message.find(
                 {"_id": {"$in": message_ids}},
-                projection={"sender_id": 1, state: 1},
+                projection={"sender_id": 1, "received_time": 1, "seen_time": 1},
             )
+            db_messages = {db_message["_id"]: db_message async for db_message in cursor}
         except PyMongoError as e:
             logger.error(f"Database query failed: {e}")
-            return
-
-        sender_data: dict[str, list[dict[str, any]]] = {}
-        try:
-            async for db_message in cursor:
-                sender_id = db_message["sender_id"]
+            return valid
 
-                # Initialize sender list if not exists
-                if sender_id not in sender_data:
-                    sender_data[sender_id] = []
+        for update in updates:
+            state = (
+                "received_time"
+                if update.status == Message_Status.recieved
+                else "seen_time"
+            )
+            for data in update.data:
+                db_message = db_messages.get(ObjectId(data.message_id))
+                if db_message is None:
+                    continue
 
                 # Skip messages without timestamp
                 if db_message[state] is None:
@@ -135,48 +176,43 @@ async def process_message_status_updates(
                     continue
 
                 # Add message data to sender's list
-                sender_data[sender_id].append(
-                    {"timestamp": db_message[state], "message_id": db_message["_id"]}
+                key = (db_message["sender_id"], update.status)
+                sender_data.setdefault(key, {})[data.message_id] = MessageEvent(
+                    message_id=str(db_message["_id"]),
+                    timestamp=db_message[state],
                 )
 
-        except PyMongoError as e:
-            logger.error(f"Error iterating database cursor: {e}")
-            return
-
-        # send the data to the sender
-        for sender_id, data in sender_data.items():
+    # send the data to the sender
+    with stage_metrics.time("status.deliver"):
+        for (sender_id, status), events in sender_data.items():
             try:
-                data = [
-                    MessageEvent(
-                        message_id=str(msg["message_id"]), timestamp=msg["timestamp"]
-                    )
-                    for msg in data
-                ]
                 await send_sync_message(
                     user_ids=[sender_id],
-                    message_data=MessageStatusUpdate(data=data, status=payload.status),
+                    message_data=MessageStatusUpdate(
+                        data=list(events.values()), status=status
+                    ),
                 )
 
             except Exception as e:
                 logger.error(f"Failed to send status update to sender {sender_id}: {e}")
 
-    except Exception as e:
-        logger.error(
-            f"Unexpected error in process_message_status_updates: {e}", exc_info=True
-        )
-    finally:
-        # retry won't happen
-        message.ack()
+    # Undelivered updates are not retried, the sender resyncs on reconnect
+    return []
 
 
 @rabbit_consumer(
     topic_name=settings.TOPICS.message.value,
     exchange_name=settings.EXCHANGES.sync_message.value,
+    queue_name=settings.QUEUES.message.value,
+    concurrency=settings.CONSUMER_CONCURRENCY,
+    # messages of a conversation are delivered in order
+    ordering_key=body_field("conversation_id"),
 )
 async def distribute_published_messages(
     message: AbstractIncomingMessage, db: AsyncDatabase
 ):
-    await _distribute_published_messages(data=message, db=db)
+    with stage_metrics.time("published.total"):
+        await _distribute_published_messages(data=message, db=db)
 
 
 async def watch_friend_requests():
@@ -213,10 +249,10 @@ async def watch_friend_requests():
                         created_time=friend_request.created_at,
                     )
 
-                    # Send the status update to the message sender
-                    await send_sync_message(
-                        user_ids=[friend_request.receiver_id],
-                        message_data=message,
+                    # Every node watches the stream, so only deliver to local sockets
+                    await sync_connections.send_personal_message(
+                        user_id=friend_request.receiver_id,
+                        message=SyncPacket(type=PacketType.message, data=message),
                     )
 
                 except Exception as e:
@@ -228,6 +264,7 @@ async def watch_friend_requests():
 @rabbit_consumer(
     topic_name=settings.TOPICS.media_update.value,
     exchange_name=settings.EXCHANGES.task_updates.value,
+    queue_name=settings.QUEUES.media_update.value,
 )
 async def profile_media_update_confirmation(
     message: AbstractIncomingMessage,
@@ -238,12 +275,27 @@ async def profile_media_update_confirmation(
 @rabbit_consumer(
     topic_name=settings.TOPICS.chat_broadcast_selected.value,
     exchange_name=settings.EXCHANGES.sync_message.value,
+    queue_name=settings.QUEUES.chat_broadcast_selected.value,
+    concurrency=settings.CONSUMER_CONCURRENCY,
 )
-async def send_message_to_users(
-    message: AbstractIncomingMessage,
-):
+async def send_message_to_users(message: AbstractIncomingMessage, db: AsyncDatabase):
     decoded_data = message.body.decode("utf-8")
     logger.info(f"{decoded_data=}")
     payload: BrodcastMessage = BrodcastMessage.model_validate_json(decoded_data)
 
-    await send_sync_message(user_ids=payload.ids, message_data=payload.data)
+    user_ids = payload.ids or await contact_index.get_contacts(db, payload.data.id)
+    await send_sync_message(user_ids=user_ids, message_data=payload.data)
+
+
+@rabbit_consumer(
+    topic_name=settings.NODE_ID,
+    exchange_name=settings.EXCHANGES.node_delivery.value,
+)
+async def deliver_routed_frames(
+    message: AbstractIncomingMessage,
+):
+    """
+    Writes frames that other nodes routed to this node to the local sockets.
+    """
+    envelope = DeliveryEnvelope.model_validate_json(message.body)
+    await node_router.deliver_envelope(envelope)
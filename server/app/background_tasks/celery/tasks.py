@@ -18,7 +18,6 @@ from app.core.schemas import (
 from app.utils import get_file_extension
 from botocore.exceptions import ClientError, NoCredentialsError  # type: ignore
 
-from .utils import list_friends_id
 from .services import process_image_to_aspect, send_otp_email
 
 celery_app = create_celery_client()
@@ -177,8 +176,6 @@ def process_profile_media(file_id: str, user_id: str, media_type: str):
                 return_document=ReturnDocument.BEFORE,
             )
 
-            friends_list = list_friends_id(user_id=ObjectId(user_id), db=db)
-
         user_profile: UserProfile = UserProfile.model_validate(user_profile_response)
 
         message = ProfileMediaUpdate(
@@ -200,9 +197,9 @@ def process_profile_media(file_id: str, user_id: str, media_type: str):
                 data=data,
             )
 
-            # Send the updated user data to all friends
+            # Send the updated user data to all contacts, resolved by the consumer
             data = FriendUpdateMessage(**{"id": ObjectId(user_id), media_type: new_key})
-            payload = BrodcastMessage(ids=friends_list, data=data)
+            payload = BrodcastMessage(data=data)
 
             publish_bloking_message(
                 connection=queue,
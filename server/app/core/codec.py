@@ -0,0 +1,158 @@
+import json
+from enum import Enum
+from typing import Any, Dict, List, Optional, Type, TypeVar, Union
+import msgpack  # type: ignore
+from pydantic import BaseModel
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+M = TypeVar("M", bound=BaseModel)
+
+MSGPACK_MAP_OF_TWO = b"\x82"
+
+
+class WireFormat(str, Enum):
+    """Socket subprotocols, JSON text frames unless the client asks for msgpack."""
+
+    json = "bridge.json"
+    msgpack = "bridge.msgpack"
+
+
+class Frame:
+    """
+    A serialized packet, shared by every session it is sent to.
+
+    A frame built with `from_model` keeps the packet and encodes it the first
+    time a session needs an encoding: the JSON text with pydantic, the
+    MessagePack bytes from `model_dump(mode="json")`, so binary sessions never
+    pay for the JSON text. When the text exists already (or the frame came in
+    as text, e.g. from another node) the MessagePack bytes are derived from
+    it, which is the cheaper way then. Each encoding is built once and reused.
+    """
+
+    __slots__ = ("_text", "_model", "_packed", "_channels")
+
+    def __init__(self, text: Optional[str] = None) -> None:
+        self._text = text
+        self._model: Optional[BaseModel] = None
+        self._packed: Optional[bytes] = None
+        self._channels: Optional[Dict[str, "ChannelFrame"]] = None
+
+    @classmethod
+    def from_model(cls, model: BaseModel) -> "Frame":
+        frame = cls()
+        frame._model = model
+        return frame
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            if self._model is None:
+                raise ValueError("Frame has neither text nor packet")
+            self._text = self._model.model_dump_json()
+        return self._text
+
+    def on_channel(self, channel: str) -> "ChannelFrame":
+        """The frame wrapped for multiplexed sessions, built once per channel."""
+        if self._channels is None:
+            self._channels = {}
+        if channel not in self._channels:
+            self._channels[channel] = ChannelFrame(channel, self)
+        return self._channels[channel]
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            if self._text is None and self._model is not None:
+                data = self._model.model_dump(mode="json")
+            else:
+                data = json.loads(self.text)
+            self._packed = msgpack.packb(data)
+        return self._packed
+
+
+class ChannelFrame(Frame):
+    """
+    A frame wrapped for a multiplexed socket: {"channel": ..., "packet": ...}.
+
+    Both encodings are built by concatenation around the inner frame when
+    first needed, so the packet itself is never serialized again.
+    """
+
+    __slots__ = ("channel", "inner")
+
+    def __init__(self, channel: str, inner: Frame) -> None:
+        super().__init__()
+        self.channel = channel
+        self.inner = inner
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = f'{{"channel":"{self.channel}","packet":{self.inner.text}}}'
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            self._packed = (
+                MSGPACK_MAP_OF_TWO
+                + msgpack.packb("channel")
+                + msgpack.packb(self.channel)
+                + msgpack.packb("packet")
+                + self.inner.packed
+            )
+        return self._packed
+
+
+def _encodings(packet: Dict[str, Any]) -> List[Union[str, bytes]]:
+    return [
+        json.dumps(packet, separators=(",", ":")),
+        json.dumps(packet),
+        msgpack.packb(packet),
+    ]
+
+
+_PINGS: List[Dict[str, Any]] = [{"type": "ping"}, {"type": "ping", "data": None}]
+
+# Exact encodings of a ping as clients send them, matched without parsing
+HEARTBEATS = frozenset(encoding for ping in _PINGS for encoding in _encodings(ping))
+MUX_HEARTBEATS: Dict[Union[str, bytes], str] = {
+    encoding: channel
+    for channel in ("message", "sync")
+    for ping in _PINGS
+    for encoding in _encodings({"channel": channel, "packet": ping})
+}
+
+# Same bytes as MessagePacket/SyncPacket(type=pong), encoded once per process
+PONG = Frame(json.dumps({"type": "pong", "data": None}, separators=(",", ":")))
+
+
+def negotiate_wire_format(websocket: WebSocket) -> Optional[WireFormat]:
+    """
+    Pick the subprotocol to accept from the ones offered by the client.
+
+    Returns None when the client did not offer any of ours, the socket is then
+    accepted without a subprotocol and speaks JSON.
+    """
+    offered = websocket.scope.get("subprotocols", [])
+    for wire_format in (WireFormat.msgpack, WireFormat.json):
+        if wire_format.value in offered:
+            return wire_format
+    return None
+
+
+async def receive_frame(websocket: WebSocket) -> Union[str, bytes]:
+    """Receive a text or binary frame, raising WebSocketDisconnect on close."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+
+    text = message.get("text")
+    return text if text is not None else message["bytes"]
+
+
+def decode_frame(model: Type[M], data: Union[str, bytes]) -> M:
+    """Validate a received frame, binary frames are MessagePack."""
+    if isinstance(data, str):
+        return model.model_validate_json(data)
+    return model.model_validate(msgpack.unpackb(data))
@@ -0,0 +1,433 @@
+import time
+import uuid
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Union
+from bson import ObjectId
+from fastapi import status
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+from starlette.websockets import WebSocket
+
+from app.core.config import settings, SlowConsumerPolicy
+from app.core.codec import Frame, WireFormat, negotiate_wire_format
+from app.core.routing import node_router
+from app.core.inbox import offline_inbox
+from app.core.presence import presence
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    A single live WebSocket of a user (one per device/tab).
+
+    Outgoing frames are put on a bounded queue that a dedicated writer task
+    drains, so a slow client never blocks the code that fans a packet out.
+    When the queue reaches its high-water mark the slow consumer policy
+    decides whether the oldest frame, the new frame or the session is dropped.
+
+    Sessions that negotiated the msgpack subprotocol get binary frames.
+    A multiplexed session is registered with several connection managers at
+    once and every frame is wrapped with the channel it was sent on.
+    """
+
+    def __init__(
+        self,
+        user_id: ObjectId,
+        websocket: WebSocket,
+        wire_format: WireFormat = WireFormat.json,
+        max_queue_size: int = settings.WS_SEND_QUEUE_SIZE,
+        policy: SlowConsumerPolicy = settings.WS_SLOW_CONSUMER_POLICY,
+        multiplexed: bool = False,
+    ) -> None:
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.websocket = websocket
+        self.wire_format = wire_format
+        self.multiplexed = multiplexed
+        self.policy = policy
+        self.queue: asyncio.Queue[Frame] = asyncio.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self.evicted = False
+        self.expired = False
+        self.closed = asyncio.Event()
+        self.last_seen = time.monotonic()
+        self._writer = asyncio.create_task(self._write_loop())
+        # close tasks of evicted or expired sessions, kept until they finish
+        self._closing: set[asyncio.Task] = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def send(self, frame: Frame, channel: Optional[str] = None):
+        """Queue a frame for the writer task without waiting for the socket."""
+        if self.evicted or self.expired:
+            return
+
+        if self.multiplexed and channel:
+            frame = frame.on_channel(channel)
+
+        if self.queue.full():
+            if self.policy == "drop_newest":
+                self.dropped += 1
+                return
+
+            if self.policy == "drop_oldest":
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            else:
+                self.evict()
+                return
+
+        self.queue.put_nowait(frame)
+
+    async def send_wait(self, frame: Frame, channel: Optional[str] = None) -> bool:
+        """
+        Queue a frame, waiting for room instead of applying the policy.
+
+        Returns:
+            bool: False if the session was closed before the frame was queued.
+        """
+        if self.closed.is_set():
+            return False
+
+        if self.multiplexed and channel:
+            frame = frame.on_channel(channel)
+
+        if not self.queue.full():
+            self.queue.put_nowait(frame)
+            return True
+
+        put = asyncio.create_task(self.queue.put(frame))
+        closed = asyncio.create_task(self.closed.wait())
+        try:
+            await asyncio.wait([put, closed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            put.cancel()
+            closed.cancel()
+        return put.done() and not put.cancelled()
+
+    def evict(self):
+        """Close a session that can't keep up with its outbound traffic."""
+        if self.evicted:
+            return
+
+        logger.warning(
+            f"Evicting slow session {self.id} of user {self.user_id} "
+            f"({self.queue_depth} frames queued)"
+        )
+        self.evicted = True
+        self.closed.set()
+        self.dropped += self.queue_depth
+        self._writer.cancel()
+        self._close_later(code=status.WS_1013_TRY_AGAIN_LATER)
+
+    def touch(self):
+        """Record that the client sent something, heartbeats included."""
+        self.last_seen = time.monotonic()
+
+    def expire(self):
+        """Close a session that went silent, e.g. a dropped mobile link."""
+        if self.expired or self.evicted:
+            return
+
+        logger.info(f"Closing idle session {self.id} of user {self.user_id}")
+        self.expired = True
+        self.closed.set()
+        self._writer.cancel()
+        self._close_later(code=status.WS_1001_GOING_AWAY)
+
+    def close(self):
+        self.closed.set()
+        self._writer.cancel()
+
+    def _close_later(self, code: int):
+        task = asyncio.create_task(self._close(code=code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception as e:
+            logger.debug(f"Error closing session {self.id}: {e}")
+
+    async def _write_loop(self):
+        while True:
+            frame = await self.queue.get()
+            try:
+                if self.wire_format == WireFormat.msgpack:
+                    await self.websocket.send_bytes(frame.packed)
+                else:
+                    await self.websocket.send_text(frame.text)
+            except Exception as e:
+                # The receive loop of the socket will clean the session up
+                logger.error(f"Error writing to session {self.id}: {e}")
+                return
+            finally:
+                self.queue.task_done()
+
+
+async def open_session(
+    user_id: ObjectId, websocket: WebSocket, multiplexed: bool = False
+) -> Session:
+    """Accept a socket with the negotiated subprotocol and start its writer."""
+    wire_format = negotiate_wire_format(websocket)
+    await websocket.accept(subprotocol=wire_format.value if wire_format else None)
+    return Session(
+        user_id=user_id,
+        websocket=websocket,
+        wire_format=wire_format or WireFormat.json,
+        multiplexed=multiplexed,
+    )
+
+
+class ConnectionManager:
+    """
+    Registry of live sessions keyed by user ID.
+
+    Every user can hold any number of sessions, stored as a dict keyed by
+    session ID so adding and removing a session is O(1). Packets addressed to a
+    user are queued on all of their sessions, each drained by its own writer.
+
+    The manager registers itself with the node router under `channel`, so
+    users that are connected to other nodes are reached through `deliver`.
+    """
+
+    def __init__(self, channel: str) -> None:
+        self.channel = channel
+        self.active_connection: Dict[ObjectId, Dict[str, Session]] = {}
+        # Totals of sessions that are already gone
+        self.dropped_frames = 0
+        self.evicted_sessions = 0
+        self.expired_sessions = 0
+        node_router.register_manager(self)
+
+    async def connect(self, user_id: ObjectId, websocket: WebSocket) -> Session:
+        session = await open_session(user_id, websocket)
+        await self.add_session(session)
+        return session
+
+    async def disconnect(self, session: Session) -> bool:
+        """
+        Close a session and remove it from the registry.
+
+        Returns:
+            bool: True if it was the last session of the user.
+        """
+        session.close()
+        return await self.remove_session(session)
+
+    async def add_session(self, session: Session):
+        """Register an accepted session, it may also belong to other managers."""
+        user_id = session.user_id
+        if user_id not in self.active_connection:
+            self.active_connection[user_id] = {}
+            try:
+                await node_router.add_route(self.channel, user_id)
+            except RedisError as e:
+                # Other nodes can't reach the user until the next refresh
+                logger.error(f"Error adding route of user {user_id}: {e}")
+
+        self.active_connection[user_id][session.id] = session
+
+        # Replay what was sent while the user was offline
+        try:
+            frames = await offline_inbox.drain(self.channel, user_id)
+        except RedisError as e:
+            logger.error(f"Error draining inbox of user {user_id}: {e}")
+            frames = []
+        for replayed, frame in enumerate(frames):
+            if not await session.send_wait(Frame(frame), self.channel):
+                # Evicted or gone, the client resyncs what it missed
+                logger.warning(
+                    f"Session {session.id} closed after replaying "
+                    f"{replayed} of {len(frames)} offline frames"
+                )
+                break
+
+    async def remove_session(self, session: Session) -> bool:
+        """
+        Remove a session from the registry without closing it.
+
+        Returns:
+            bool: True if it was the last session of the user.
+        """
+        self.dropped_frames += session.dropped
+        self.evicted_sessions += session.evicted
+        self.expired_sessions += session.expired
+
+        sessions = self.active_connection.get(session.user_id)
+        if not sessions or sessions.pop(session.id, None) is None:
+            return False
+
+        if not sessions:
+            del self.active_connection[session.user_id]
+            try:
+                await node_router.remove_route(self.channel, session.user_id)
+            except RedisError as e:
+                # The route expires once this node stops refreshing it
+                logger.error(f"Error removing route of user {session.user_id}: {e}")
+            return True
+        return False
+
+    def is_online(self, user_id: ObjectId) -> bool:
+        return user_id in self.active_connection
+
+    def get_sessions(self, user_id: ObjectId) -> List[Session]:
+        return list(self.active_connection.get(user_id, {}).values())
+
+    async def send_frame(self, user_ids: Iterable[ObjectId], frame: Frame):
+        """Queue an already serialized frame on every session of the given users."""
+        for user_id in user_ids:
+            for session in self.get_sessions(user_id):
+                session.send(frame, self.channel)
+
+    async def send_text(self, user_ids: Iterable[ObjectId], data: str):
+        await self.send_frame(user_ids, Frame(data))
+
+    def stats(self) -> Dict[str, Any]:
+        """Outbound queue metrics of the sessions held by this manager."""
+        sessions = [
+            session
+            for user_sessions in self.active_connection.values()
+            for session in user_sessions.values()
+        ]
+        depths = [session.queue_depth for session in sessions]
+
+        return {
+            "users": len(self.active_connection),
+            "sessions": len(sessions),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped_frames": self.dropped_frames
+            + sum(session.dropped for session in sessions),
+            "evicted_sessions": self.evicted_sessions
+            + sum(session.evicted for session in sessions),
+            "expired_sessions": self.expired_sessions
+            + sum(session.expired for session in sessions),
+        }
+
+    async def send_personal_message(self, user_id: ObjectId, message: BaseModel):
+        await self.send_frame([user_id], Frame.from_model(message))
+
+    async def deliver(
+        self,
+        user_ids: Iterable[ObjectId],
+        message: BaseModel,
+        store_offline: bool = False,
+    ):
+        """
+        Send a packet to the given users wherever they are connected.
+
+        The packet is serialized once and the same frame is queued on every
+        recipient session, no matter how many users it is addressed to.
+        """
+        await self.deliver_frame(user_ids, Frame.from_model(message), store_offline)
+
+    async def deliver_frame(
+        self,
+        user_ids: Iterable[ObjectId],
+        frame: Union[str, Frame],
+        store_offline: bool = False,
+    ):
+        """
+        Send an already serialized frame to the given users.
+
+        Sessions on this node are written directly, other nodes receive the
+        frame through their node queue. With `store_offline` the frame is kept
+        in the offline inbox of users that are not connected anywhere, or
+        whose node did not take the frame.
+        """
+        user_ids = list(user_ids)
+        if isinstance(frame, str):
+            frame = Frame(frame)
+
+        local_user_ids = [uid for uid in user_ids if self.is_online(uid)]
+        if local_user_ids:
+            await self.send_frame(local_user_ids, frame)
+
+        try:
+            nodes = await node_router.lookup(self.channel, user_ids)
+        except RedisError as e:
+            # Users on other nodes catch up from the inbox when they reconnect
+            logger.error(f"Error looking up routes, delivering locally: {e}")
+            nodes = {}
+        # Every forward waits for its confirm, so the nodes are sent to at once
+        remote = [
+            (node_id, node_user_ids)
+            for node_id, node_user_ids in nodes.items()
+            if node_id != settings.NODE_ID
+        ]
+        forwarded = await asyncio.gather(
+            *(
+                node_router.forward(
+                    self.channel, node_id, node_user_ids, frame.text, store_offline
+                )
+                for node_id, node_user_ids in remote
+            )
+        )
+        reached = set()
+        for (_, node_user_ids), ok in zip(remote, forwarded):
+            if ok:
+                reached.update(node_user_ids)
+
+        if store_offline:
+            offline_user_ids = [
+                uid
+                for uid in user_ids
+                if uid not in reached and not self.is_online(uid)
+            ]
+            if offline_user_ids:
+                try:
+                    await offline_inbox.append(
+                        self.channel, offline_user_ids, frame.text
+                    )
+                except RedisError as e:
+                    logger.error(f"Error storing frame for offline users: {e}")
+
+
+async def refresh_sessions(interval: float = settings.PRESENCE_REFRESH_SECONDS):
+    """
+    Heartbeat of this node, runs as a background task.
+
+    Extends the presence of the sessions that are still alive and the routes
+    of the users connected here, so both drop out soon after a node crash.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for refresh in (presence.refresh, node_router.refresh):
+            try:
+                await refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing sessions: {e}")
+
+
+async def reap_idle_sessions(
+    timeout: float = settings.WS_IDLE_TIMEOUT_SECONDS,
+    interval: float = settings.WS_REAPER_INTERVAL_SECONDS,
+):
+    """
+    Close the sessions of every connection manager that stayed silent too long.
+
+    Clients ping well within the timeout, so an idle session is a socket
+    whose peer vanished without a close frame. Closing it makes its receive
+    loop end and clean the session up as usual.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        deadline = time.monotonic() - timeout
+
+        # A multiplexed session is held by several managers, check it once
+        sessions = {
+            session.id: session
+            for manager in list(node_router.managers.values())
+            for user_sessions in list(manager.active_connection.values())
+            for session in user_sessions.values()
+        }
+        for session in sessions.values():
+            if session.last_seen < deadline:
+                session.expire()
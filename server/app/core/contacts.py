@@ -0,0 +1,145 @@
+import logging
+from typing import Dict, Iterable, List, Optional, Set
+from bson import ObjectId
+from redis.asyncio import Redis
+
+from app.core.config import settings
+from app.core.db import AsyncDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class ContactIndex:
+    """
+    Everyone a user has a conversation or a friendship with, per user.
+
+    Every user has a Redis set `contacts:{user_id}` that is updated in both
+    directions when a conversation or a friendship is created, so resolving
+    whom to notify about a user is a single SMEMBERS instead of a scan of
+    their conversations.
+
+    Sets are built from Mongo on first use and marked complete with a
+    sentinel member. Contacts added to a set that was never built leave the
+    sentinel out, so such a partial set is rebuilt on the next read. Sets
+    expire after CONTACTS_TTL_SECONDS to pick up anything changed behind the
+    index's back.
+
+    Until `bind` is called (e.g. in tests) contacts are read from Mongo.
+    """
+
+    COMPLETE = ""
+
+    def __init__(self, ttl_seconds: int) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.redis: Optional[Redis] = None
+        self.rebuilds = 0
+
+    def bind(self, redis: Redis):
+        self.redis = redis
+
+    @staticmethod
+    def _key(user_id: ObjectId) -> str:
+        return f"contacts:{user_id}"
+
+    async def add_contacts(self, user_id: ObjectId, contact_id: ObjectId):
+        """Record that two users now know each other."""
+        if not self.redis:
+            return
+
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.sadd(self._key(user_id), str(contact_id))
+                pipe.sadd(self._key(contact_id), str(user_id))
+                await pipe.execute()
+        except Exception as e:
+            # The sets are rebuilt from Mongo when they expire
+            logger.error(f"Error updating contact index: {e}")
+
+    async def get_contacts(
+        self, db: AsyncDatabase, user_id: ObjectId
+    ) -> List[ObjectId]:
+        return (await self.get_contacts_many(db, [user_id]))[user_id]
+
+    async def get_contacts_many(
+        self, db: AsyncDatabase, user_ids: Iterable[ObjectId]
+    ) -> Dict[ObjectId, List[ObjectId]]:
+        """
+        Contacts of several users with one pipelined read.
+
+        Returns:
+            Dict[ObjectId, List[ObjectId]]: user ID -> IDs of their contacts.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+
+        if not self.redis:
+            return await self._load(db, user_ids)
+
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    pipe.smembers(self._key(user_id))
+                member_sets = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error reading contact index: {e}")
+            return await self._load(db, user_ids)
+
+        contacts: Dict[ObjectId, List[ObjectId]] = {}
+        missing: List[ObjectId] = []
+        for user_id, members in zip(user_ids, member_sets):
+            if self.COMPLETE not in members:
+                missing.append(user_id)
+                continue
+            contacts[user_id] = [ObjectId(id) for id in members if id != self.COMPLETE]
+
+        if missing:
+            loaded = await self._load(db, missing)
+            await self._store(loaded)
+            contacts.update(loaded)
+
+        return contacts
+
+    async def _load(
+        self, db: AsyncDatabase, user_ids: List[ObjectId]
+    ) -> Dict[ObjectId, List[ObjectId]]:
+        """Build the contact sets of the given users from Mongo."""
+        self.rebuilds += len(user_ids)
+        contacts: Dict[ObjectId, Set[ObjectId]] = {
+            user_id: set() for user_id in user_ids
+        }
+
+        async for document in db.conversation.find(
+            {"participants": {"$in": user_ids}}, projection={"participants": 1}
+        ):
+            participants = document["participants"]
+            for user_id in participants:
+                if user_id in contacts:
+                    contacts[user_id].update(id for id in participants if id != user_id)
+
+        async for document in db.friends.find(
+            {"user_id": {"$in": user_ids}}, projection={"user_id": 1, "friend_id": 1}
+        ):
+            contacts[document["user_id"]].add(document["friend_id"])
+
+        return {user_id: list(ids) for user_id, ids in contacts.items()}
+
+    async def _store(self, contacts: Dict[ObjectId, List[ObjectId]]):
+        if not self.redis:
+            return
+
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id, ids in contacts.items():
+                    key = self._key(user_id)
+                    pipe.sadd(key, self.COMPLETE, *(str(id) for id in ids))
+                    pipe.expire(key, self.ttl_seconds)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error writing contact index: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {"rebuilds": self.rebuilds}
+
+
+contact_index = ContactIndex(ttl_seconds=settings.CONTACTS_TTL_SECONDS)
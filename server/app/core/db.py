@@ -45,6 +45,15 @@ class AsyncDatabase(BaseDatabase):
     async def initialize_indexes(self):
         await self.user_profile.create_index("user_id", unique=True)
 
+    async def initialize_message_indexes(self):
+        # Resumable sync reads messages by (conversation_id, seq); unique so a
+        # sequence number can never be stored twice
+        await self.message.create_index(
+            [("conversation_id", 1), ("seq", 1)],
+            unique=True,
+            partialFilterExpression={"seq": {"$exists": True}},
+        )
+
 
 class SyncDatabase(BaseDatabase):
     def __init__(self, client: MongoClient, db_name: str):
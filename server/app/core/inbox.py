@@ -0,0 +1,94 @@
+import time
+import logging
+from typing import Iterable, List, Optional
+from bson import ObjectId
+from redis.asyncio import Redis
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineInbox:
+    """
+    Frames addressed to users that are not connected anywhere.
+
+    Every user has one Redis stream per channel, capped by INBOX_MAX_LENGTH
+    entries and INBOX_MAX_AGE_SECONDS. When the user connects again the stream
+    is drained and replayed on the new socket, so reconnecting clients catch
+    up without querying Mongo.
+
+    Drained frames are kept in a replay stream for INBOX_REPLAY_GRACE_SECONDS,
+    so the other devices of a user that connect at about the same time get
+    them too (a device reconnecting within that window gets them twice).
+
+    Until `bind` is called (e.g. in tests) nothing is stored.
+    """
+
+    def __init__(
+        self, max_length: int, max_age_seconds: int, replay_grace_seconds: int
+    ) -> None:
+        self.max_length = max_length
+        self.max_age_seconds = max_age_seconds
+        self.replay_grace_seconds = replay_grace_seconds
+        self.redis: Optional[Redis] = None
+
+    def bind(self, redis: Redis):
+        self.redis = redis
+
+    @staticmethod
+    def _key(channel: str, user_id: ObjectId) -> str:
+        return f"inbox:{channel}:{user_id}"
+
+    @staticmethod
+    def _replay_key(channel: str, user_id: ObjectId) -> str:
+        return f"inbox-replay:{channel}:{user_id}"
+
+    def _min_id(self) -> str:
+        return f"{int((time.time() - self.max_age_seconds) * 1000)}-0"
+
+    async def append(self, channel: str, user_ids: Iterable[ObjectId], frame: str):
+        if not self.redis:
+            return
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                key = self._key(channel, user_id)
+                pipe.xadd(
+                    key, {"frame": frame}, maxlen=self.max_length, approximate=True
+                )
+                pipe.xtrim(key, minid=self._min_id(), approximate=True)
+                pipe.expire(key, self.max_age_seconds)
+            await pipe.execute()
+
+    async def drain(self, channel: str, user_id: ObjectId) -> List[str]:
+        """
+        Remove and return the frames stored for a user, oldest first, after
+        the frames replayed to their other devices within the grace period.
+        """
+        if not self.redis:
+            return []
+
+        key = self._key(channel, user_id)
+        replay_key = self._replay_key(channel, user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xrange(replay_key)
+            pipe.xrange(key, min=self._min_id())
+            pipe.delete(key)
+            replayed, entries, _ = await pipe.execute()
+
+        if entries:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for _, fields in entries:
+                    pipe.xadd(replay_key, fields)
+                pipe.expire(replay_key, self.replay_grace_seconds)
+                await pipe.execute()
+
+        return [fields["frame"] for _, fields in replayed + entries]
+
+
+offline_inbox = OfflineInbox(
+    max_length=settings.INBOX_MAX_LENGTH,
+    max_age_seconds=settings.INBOX_MAX_AGE_SECONDS,
+    replay_grace_seconds=settings.INBOX_REPLAY_GRACE_SECONDS,
+)
@@ -1,24 +1,40 @@
 import asyncio
+import contextlib
 import json
 import logging
-from functools import wraps
-from typing import Awaitable, Callable, Dict
+from functools import update_wrapper
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from weakref import WeakKeyDictionary
 from pydantic import BaseModel
 
-from aio_pika import Message, connect_robust
+from aio_pika import DeliveryMode, Message, connect_robust
 from aio_pika.abc import (
     AbstractChannel,
     AbstractExchange,
+    AbstractIncomingMessage,
     AbstractQueue,
     AbstractRobustConnection,
     ExchangeType,
 )
-from aio_pika.exceptions import AMQPConnectionError
+from aio_pika.exceptions import AMQPError
+from aiormq.abc import DeliveredMessage
+from aiormq.exceptions import ChannelInvalidStateError
 from fastapi import WebSocket
 from pika import BlockingConnection, URLParameters  # type: ignore
 from pika.exceptions import UnroutableError  # type: ignore
 
 from app.core.config import settings
+from app.core.metrics import stage_metrics
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +70,11 @@ async def create_rabbit_exchanges(connection: AbstractRobustConnection):
             type=ExchangeType.TOPIC,
             durable=True,
         )
+        await channel.declare_exchange(
+            name=settings.EXCHANGES.node_delivery.value,
+            type=ExchangeType.DIRECT,
+            durable=True,
+        )
 
         logger.info("Exchange created successfully")
     except Exception as e:
@@ -63,25 +84,214 @@ async def create_rabbit_exchanges(connection: AbstractRobustConnection):
             await channel.close()
 
 
+class PublishReturned(Exception):
+    """The broker could not route a mandatory message to any queue."""
+
+
+class Publisher:
+    """
+    Long-lived publisher channels of one connection.
+
+    `channels` channels are opened on first use and shared round-robin by
+    every caller. aiormq serializes the frames of concurrent publishes on a
+    channel, so socket handlers never wait for a channel to be free. Exchange
+    handles are looked up once per channel and cached. A channel that was
+    closed (e.g. by a broker error) is reopened on its next use.
+
+    With `confirms` every publish waits for the broker ack. Acks of
+    concurrent publishes are pipelined on the channels (up to `max_in_flight`
+    unconfirmed messages), so waiting costs one round trip per message, not
+    one per message in the queue. Nacked or interrupted publishes are
+    retried `retries` times. `submit` returns a future resolved with the ack
+    for callers that should not wait for it.
+
+    A `mandatory` message that no queue is bound for is returned by the
+    broker (before its ack) and raises PublishReturned; it is not retried.
+    """
+
+    def __init__(
+        self,
+        connection: AbstractRobustConnection,
+        channels: int,
+        confirms: bool,
+        max_in_flight: int,
+        retries: int,
+    ) -> None:
+        self.connection = connection
+        self.confirms = confirms
+        self.retries = retries
+        self.channels: List[Optional[AbstractChannel]] = [None] * channels
+        self.exchanges: List[Dict[str, AbstractExchange]] = [
+            {} for _ in range(channels)
+        ]
+        self._next = 0
+        self._lock = asyncio.Lock()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._submitted: set[asyncio.Task] = set()
+        self.in_flight = 0
+        self.published = 0
+        self.retried = 0
+        self.failed = 0
+        self.returned = 0
+        self.opened = 0
+
+    async def _channel(self) -> Tuple[int, AbstractChannel]:
+        slot = self._next
+        self._next = (slot + 1) % len(self.channels)
+
+        channel = self.channels[slot]
+        if channel is None or channel.is_closed:
+            async with self._lock:
+                channel = self.channels[slot]
+                if channel is None or channel.is_closed:
+                    channel = self.channels[slot] = await self.connection.channel(
+                        publisher_confirms=self.confirms
+                    )
+                    self.exchanges[slot] = {}
+                    self.opened += 1
+        return slot, channel
+
+    async def _exchange(self, exchange_name: str) -> AbstractExchange:
+        slot, channel = await self._channel()
+
+        exchange = self.exchanges[slot].get(exchange_name)
+        if exchange is None:
+            exchange = await channel.get_exchange(name=exchange_name)
+            self.exchanges[slot][exchange_name] = exchange
+        return exchange
+
+    async def publish(
+        self,
+        exchange_name: str,
+        topic: str,
+        body: bytes,
+        persistent: bool = False,
+        mandatory: bool = False,
+    ):
+        """Publish, returns once the broker confirmed the message."""
+        message = Message(
+            body=body,
+            delivery_mode=(
+                DeliveryMode.PERSISTENT if persistent else DeliveryMode.NOT_PERSISTENT
+            ),
+        )
+
+        attempt = 0
+        while True:
+            async with self._in_flight:
+                self.in_flight += 1
+                try:
+                    exchange = await self._exchange(exchange_name)
+                    with stage_metrics.time("broker.publish"):
+                        result = await exchange.publish(
+                            message, routing_key=topic, mandatory=mandatory
+                        )
+                    if mandatory and isinstance(result, DeliveredMessage):
+                        self.returned += 1
+                        raise PublishReturned(f"No queue for {topic}")
+                    self.published += 1
+                    return
+                except (AMQPError, ChannelInvalidStateError) as e:
+                    # Nacked, or the channel went away before the ack
+                    if attempt >= self.retries:
+                        self.failed += 1
+                        raise
+                    attempt += 1
+                    self.retried += 1
+                    logger.warning(f"Retrying publish to {topic} ({attempt}): {e}")
+                finally:
+                    self.in_flight -= 1
+
+    def submit(
+        self, exchange_name: str, topic: str, body: bytes, persistent: bool = False
+    ) -> "asyncio.Future[None]":
+        """Publish in the background, the returned future resolves on the ack."""
+        task = asyncio.create_task(self.publish(exchange_name, topic, body, persistent))
+        self._submitted.add(task)
+        task.add_done_callback(self._submitted_done)
+        return task
+
+    def _submitted_done(self, task: asyncio.Task):
+        self._submitted.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Failed to publish message: {task.exception()}")
+
+    async def close(self):
+        """Wait for submitted publishes to be confirmed and close the channels."""
+        await asyncio.gather(*self._submitted, return_exceptions=True)
+
+        for channel in self.channels:
+            if channel is not None and not channel.is_closed:
+                await channel.close()
+        self.channels = [None] * len(self.channels)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "confirms": self.confirms,
+            "channels": sum(
+                channel is not None and not channel.is_closed
+                for channel in self.channels
+            ),
+            "channels_opened": self.opened,
+            "in_flight": self.in_flight,
+            "published": self.published,
+            "retried": self.retried,
+            "failed": self.failed,
+            "returned": self.returned,
+        }
+
+
+# One publisher per connection, dropped together with the connection
+publishers: "WeakKeyDictionary[AbstractRobustConnection, Publisher]" = (
+    WeakKeyDictionary()
+)
+
+
+def get_publisher(connection: AbstractRobustConnection) -> Publisher:
+    publisher = publishers.get(connection)
+    if publisher is None:
+        publisher = publishers[connection] = Publisher(
+            connection,
+            channels=settings.PUBLISHER_CHANNELS,
+            confirms=settings.PUBLISHER_CONFIRMS,
+            max_in_flight=settings.PUBLISHER_MAX_IN_FLIGHT,
+            retries=settings.PUBLISHER_RETRIES,
+        )
+    return publisher
+
+
 async def publish_message(
     connection: AbstractRobustConnection,
     exchange_name: str,
     topic: str,
     data: BaseModel,
-):
-    channel: AbstractChannel = await connection.channel()
+    persistent: bool = False,
+) -> bool:
+    """Publish and wait for the broker confirm, returns False if it failed."""
     try:
-        exchange: AbstractExchange = await channel.get_exchange(name=exchange_name)
-
-        await exchange.publish(
-            Message(body=data.model_dump_json().encode("utf-8")),
-            routing_key=topic,
+        await get_publisher(connection).publish(
+            exchange_name, topic, data.model_dump_json().encode("utf-8"), persistent
         )
-
+        return True
     except Exception as e:
         logger.error(f"Failed to publish message: {e}")
-    finally:
-        await channel.close()
+        return False
+
+
+def publish_message_nowait(
+    connection: AbstractRobustConnection,
+    exchange_name: str,
+    topic: str,
+    data: BaseModel,
+    persistent: bool = False,
+) -> "asyncio.Future[None]":
+    """
+    Publish without waiting for the broker confirm, for socket handlers.
+    Failures after all retries are logged, the future can be awaited as well.
+    """
+    return get_publisher(connection).submit(
+        exchange_name, topic, data.model_dump_json().encode("utf-8"), persistent
+    )
 
 
 def publish_bloking_message(
@@ -101,57 +311,402 @@ def publish_bloking_message(
         logger.error(f"Failed to publish message: {e}")
 
 
+def body_field(field: str) -> Callable[[AbstractIncomingMessage], Hashable]:
+    """Ordering key reading a top-level field of a JSON message body."""
+
+    def key(message: AbstractIncomingMessage) -> Hashable:
+        return json.loads(message.body).get(field)
+
+    return key
+
+
+class ConsumerWorkers:
+    """
+    Runs a consumer handler on up to `concurrency` messages at once.
+
+    Every message is processed (and acked) in its own task. Once
+    `concurrency` messages are being handled, `submit` waits for one to
+    finish, so at most that many are unacked on top of the prefetched ones.
+
+    With an ordering `key`, messages with the same key are handled one after
+    the other in the order they arrived; messages with different keys still
+    run in parallel.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[None]],
+        topic_name: str,
+        concurrency: int,
+        key: Optional[Callable[[AbstractIncomingMessage], Hashable]] = None,
+    ) -> None:
+        self.handler = handler
+        self.topic_name = topic_name
+        self.key = key
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        # ordering key -> last task submitted with that key
+        self._tails: Dict[Hashable, asyncio.Task] = {}
+
+    async def submit(self, message: AbstractIncomingMessage, *args, **kwargs):
+        await self._slots.acquire()
+
+        key = None
+        if self.key:
+            try:
+                key = self.key(message)
+            except Exception as e:
+                logger.error(f"No ordering key for {self.topic_name} message: {e}")
+
+        previous = self._tails.get(key) if key is not None else None
+        task = asyncio.create_task(self._run(message, previous, args, kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        if key is not None:
+            self._tails[key] = task
+            task.add_done_callback(lambda task: self._forget(key, task))
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(
+        self,
+        message: AbstractIncomingMessage,
+        previous: Optional[asyncio.Task],
+        args: tuple,
+        kwargs: dict,
+    ):
+        try:
+            if previous:
+                # Wait for the earlier message with the same key, however it ends
+                await asyncio.wait([previous])
+
+            # Handler errors are logged and acked; only a handler cancelled by
+            # `drain` leaves the block, and that message goes back on the queue
+            async with message.process(requeue=True):
+                try:
+                    await self.handler(message, *args, **kwargs)
+                except Exception as e:
+                    logger.error(
+                        f"Error processing {self.topic_name} message, {message=} error : {e}"
+                    )
+        finally:
+            self._slots.release()
+
+    async def drain(self, timeout: float):
+        """Wait for the messages being handled, cancel what is left after `timeout`."""
+        if not self._tasks:
+            return
+
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(
+                f"Cancelled {len(pending)} {self.topic_name} messages while draining, "
+                "they are requeued"
+            )
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+ConsumeFunc = Callable[[AbstractQueue, tuple, dict], Awaitable[None]]
+
+
+class Consumer:
+    """
+    A queue consumer declared with `rabbit_consumer` or `rabbit_batch_consumer`.
+
+    Consumers don't connect by themselves, they are added to the
+    ConsumerRegistry, which runs them on the shared broker connection. The
+    undecorated handler stays available as `__wrapped__`.
+    """
+
+    def __init__(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        topic_name: str,
+        exchange_name: str,
+        queue_name: Optional[str],
+        prefetch_count: int,
+        consume: ConsumeFunc,
+        max_retries: int,
+        initial_delay: float,
+    ) -> None:
+        update_wrapper(self, func)
+        self.name: str = func.__name__
+        self.topic_name = topic_name
+        self.exchange_name = exchange_name
+        self.queue_name = queue_name
+        self.prefetch_count = prefetch_count
+        self.consume = consume
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+
+    async def declare(self, channel: AbstractChannel) -> AbstractQueue:
+        """Declare the queue of the consumer on `channel` and bind it."""
+        await channel.set_qos(prefetch_count=self.prefetch_count)
+
+        exchange: AbstractExchange = await channel.get_exchange(name=self.exchange_name)
+
+        if self.queue_name:
+            queue: AbstractQueue = await channel.declare_queue(
+                name=self.queue_name, durable=True
+            )
+        else:
+            queue = await channel.declare_queue(exclusive=True)
+
+        await queue.bind(exchange, routing_key=self.topic_name)
+        return queue
+
+
+class RunningConsumer:
+    def __init__(self, consumer: Consumer, args: tuple, kwargs: dict) -> None:
+        self.consumer = consumer
+        self.args = args
+        self.kwargs = kwargs
+        self.task: Optional[asyncio.Task] = None
+        self.channel: Optional[AbstractChannel] = None
+        self.state = "stopped"
+        self.restarts = 0
+        self.last_error: Optional[str] = None
+
+
+class ConsumerRegistry:
+    """
+    Runs every background consumer on one shared broker connection.
+
+    Each consumer gets its own channel, so prefetch and acks stay
+    independent, but the process keeps a single connection however many
+    topics it consumes. A consumer whose channel fails is restarted on a new
+    channel with backoff, until it fails `max_retries` times in a row without
+    getting its queue bound; the robust connection itself reconnects on its
+    own. `health` reports the state of each one.
+    """
+
+    def __init__(self) -> None:
+        self.consumers: Dict[str, RunningConsumer] = {}
+        self.connection: Optional[AbstractRobustConnection] = None
+
+    def add(self, consumer: Consumer, *args, **kwargs):
+        """Register a consumer with the arguments passed to its handler."""
+        self.consumers[consumer.name] = RunningConsumer(consumer, args, kwargs)
+
+    async def start(self, connection: AbstractRobustConnection):
+        self.connection = connection
+        for running in self.consumers.values():
+            running.task = asyncio.create_task(self._supervise(running))
+
+    async def stop(self):
+        """Cancel the consumers, letting them drain the messages in progress."""
+        tasks = [running.task for running in self.consumers.values() if running.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for running in self.consumers.values():
+            running.task = None
+            running.state = "stopped"
+        self.connection = None
+
+    async def _supervise(self, running: RunningConsumer):
+        consumer = running.consumer
+        attempt = 0
+
+        while self.connection is not None:
+            running.state = "starting"
+            try:
+                running.channel = await self.connection.channel()
+                queue = await consumer.declare(running.channel)
+                running.state = "running"
+                # Only failures in a row count against max_retries
+                attempt = 0
+                await consumer.consume(queue, running.args, running.kwargs)
+                raise RuntimeError("consumer stopped")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                attempt += 1
+                running.restarts += 1
+                running.last_error = f"{type(e).__name__}: {e}"
+                logger.error(f"Consumer {consumer.name} failed : {e}")
+
+                if attempt >= consumer.max_retries:
+                    running.state = "failed"
+                    logger.critical(
+                        f"Consumer {consumer.name}: max retries ({consumer.max_retries}) "
+                        "reached. Giving up."
+                    )
+                    return
+
+                running.state = "restarting"
+                await asyncio.sleep(consumer.initial_delay * attempt)
+            finally:
+                if running.channel is not None and not running.channel.is_closed:
+                    with contextlib.suppress(Exception):
+                        await running.channel.close()
+                running.channel = None
+
+    def health(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                "topic": running.consumer.topic_name,
+                "state": running.state,
+                "restarts": running.restarts,
+                "last_error": running.last_error,
+            }
+            for name, running in self.consumers.items()
+        }
+
+    def healthy(self) -> bool:
+        return all(running.state == "running" for running in self.consumers.values())
+
+
+consumer_registry = ConsumerRegistry()
+
+
 def rabbit_consumer(
     topic_name: str,
     exchange_name: str,
+    queue_name: Optional[str] = None,
     max_retries: int = 10,
     initial_delay: float = 2.0,
+    concurrency: int = 1,
+    ordering_key: Optional[Callable[[AbstractIncomingMessage], Hashable]] = None,
 ):
-    def decorator(func: Callable[..., Awaitable[None]]):
-        @wraps(func)
-        async def wrapper(*args, **kwargs) -> None:
-            attempt = 0
-            while attempt < max_retries:
-                connection = await connect_robust(url=settings.RABBITMQ_URL)
-
-                async with connection:
-                    try:
-                        channel: AbstractChannel = await connection.channel()
-                        await channel.set_qos(prefetch_count=5)
+    """
+    Consume `topic_name` from `exchange_name` with the decorated handler.
 
-                        exchange: AbstractExchange = await channel.get_exchange(
-                            name=exchange_name
-                        )
+    Without `queue_name` every process gets its own exclusive queue and sees
+    every event. With `queue_name` all processes share one durable queue, so
+    each event is handled by exactly one node.
 
-                        queue: AbstractQueue = await channel.declare_queue(
-                            exclusive=True
-                        )
+    Up to `concurrency` messages are handled at once, messages with the same
+    `ordering_key` in the order they arrived (see ConsumerWorkers). When the
+    consumer is cancelled it stops taking messages and gives the ones being
+    handled CONSUMER_DRAIN_TIMEOUT seconds to finish.
+    """
 
-                        await queue.bind(exchange, routing_key=topic_name)
-
-                        async with queue.iterator() as queue_iter:
-                            async for message in queue_iter:
-                                async with message.process():
-                                    try:
-                                        await func(message, *args, **kwargs)
-                                    except Exception as e:
-                                        logger.error(
-                                            f"Error processing {topic_name} message, {message=} error : {e}"
-                                        )
-                    except AMQPConnectionError as e:
-                        logger.error(f"RabbitMQ connection failed : {e}")
-                        attempt += 1
-
-                        if attempt >= max_retries:
-                            logger.critical(
-                                f"Max retries ({max_retries}) reached. Giving up."
-                            )
-                            break
+    def decorator(func: Callable[..., Awaitable[None]]) -> Consumer:
+        async def consume(queue: AbstractQueue, args: tuple, kwargs: dict):
+            workers = ConsumerWorkers(func, topic_name, concurrency, key=ordering_key)
+            try:
+                async with queue.iterator() as queue_iter:
+                    async for message in queue_iter:
+                        await workers.submit(message, *args, **kwargs)
+            finally:
+                # Let the handlers already running finish and ack before the
+                # channel closes
+                await workers.drain(settings.CONSUMER_DRAIN_TIMEOUT)
+
+        return Consumer(
+            func,
+            topic_name,
+            exchange_name,
+            queue_name,
+            prefetch_count=max(5, concurrency),
+            consume=consume,
+            max_retries=max_retries,
+            initial_delay=initial_delay,
+        )
 
-                        sleep_time = initial_delay * attempt
+    return decorator
 
-                        await asyncio.sleep(sleep_time)
 
-        return wrapper
+async def settle_batch(
+    batch: List[AbstractIncomingMessage],
+    failed: Iterable[AbstractIncomingMessage],
+    topic_name: str,
+):
+    """
+    Nack the failed messages of a batch one by one and ack the rest at once.
+
+    Failed messages are requeued once; a message that fails again after being
+    redelivered is dropped so it cannot block the queue.
+    """
+    failed_tags = set()
+    for message in failed:
+        failed_tags.add(message.delivery_tag)
+        await message.nack(requeue=not message.redelivered)
+
+    if failed_tags:
+        logger.error(f"{len(failed_tags)} of {len(batch)} {topic_name} messages failed")
+
+    succeeded = [
+        message for message in batch if message.delivery_tag not in failed_tags
+    ]
+    if succeeded:
+        # Batches are handled one at a time on the channel, so everything up to
+        # the newest succeeded message is either in this batch or already nacked
+        newest = max(succeeded, key=lambda message: message.delivery_tag or 0)
+        await newest.ack(multiple=True)
+
+
+def rabbit_batch_consumer(
+    topic_name: str,
+    exchange_name: str,
+    queue_name: Optional[str] = None,
+    max_batch_size: int = 100,
+    max_wait: float = 0.05,
+    max_retries: int = 10,
+    initial_delay: float = 2.0,
+):
+    """
+    Like `rabbit_consumer`, but the handler gets a list of messages.
+
+    A batch is handed over once `max_batch_size` messages arrived or
+    `max_wait` seconds after its first message. The handler returns the
+    messages it could not handle (or None), those are nacked and the rest is
+    acked together. If the handler raises, the whole batch counts as failed.
+    Batches are handled one at a time.
+    """
+
+    def decorator(
+        func: Callable[..., Awaitable[Optional[Iterable[AbstractIncomingMessage]]]],
+    ) -> Consumer:
+        async def consume(queue: AbstractQueue, args: tuple, kwargs: dict):
+            loop = asyncio.get_running_loop()
+            inbox: asyncio.Queue[AbstractIncomingMessage] = asyncio.Queue()
+            consumer_tag = await queue.consume(inbox.put)
+
+            try:
+                while True:
+                    batch = [await inbox.get()]
+                    deadline = loop.time() + max_wait
+
+                    while len(batch) < max_batch_size:
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        try:
+                            message = await asyncio.wait_for(inbox.get(), timeout)
+                        except TimeoutError:
+                            break
+                        batch.append(message)
+
+                    try:
+                        failed = await func(batch, *args, **kwargs) or []
+                    except Exception as e:
+                        logger.error(
+                            f"Error processing {len(batch)} {topic_name} messages, error : {e}"
+                        )
+                        failed = batch
+                    await settle_batch(batch, failed, topic_name)
+            finally:
+                # Unsettled messages are redelivered once the channel closes
+                with contextlib.suppress(Exception):
+                    await queue.cancel(consumer_tag)
+
+        return Consumer(
+            func,
+            topic_name,
+            exchange_name,
+            queue_name,
+            prefetch_count=max_batch_size,
+            consume=consume,
+            max_retries=max_retries,
+            initial_delay=initial_delay,
+        )
 
     return decorator
@@ -0,0 +1,106 @@
+import time
+from bisect import bisect_left
+from typing import Any, Dict, List
+
+
+class Histogram:
+    """
+    Latency histogram with fixed exponential buckets.
+
+    Recording is a bisect and three additions, cheap enough to leave on in
+    the hot path. Quantiles are the upper bound of the bucket they fall in,
+    capped by the largest value seen.
+    """
+
+    # 100us doubling up to ~13s, anything slower lands in the overflow bucket
+    BUCKETS = tuple(0.0001 * 2**i for i in range(18))
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and bucket < len(self.BUCKETS):
+                return min(self.BUCKETS[bucket], self.max)
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Summary in milliseconds."""
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.50) * 1000, 3),
+            "p95_ms": round(self.quantile(0.95) * 1000, 3),
+            "p99_ms": round(self.quantile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class StageTimer:
+    """Context manager recording the time spent in a block into a histogram."""
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self) -> "StageTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class StageMetrics:
+    """
+    Per-stage latency histograms of the message pipelines, keyed by name.
+
+        with stage_metrics.time("chat.insert"):
+            await db.message.insert_one(...)
+
+    Failed stages are recorded too, so slow errors show up as well.
+    """
+
+    def __init__(self) -> None:
+        self.histograms: Dict[str, Histogram] = {}
+
+    def histogram(self, stage: str) -> Histogram:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        return histogram
+
+    def time(self, stage: str) -> StageTimer:
+        return StageTimer(self.histogram(stage))
+
+    def observe(self, stage: str, seconds: float):
+        self.histogram(stage).observe(seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            stage: histogram.snapshot()
+            for stage, histogram in sorted(self.histograms.items())
+        }
+
+
+stage_metrics = StageMetrics()
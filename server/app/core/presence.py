@@ -0,0 +1,123 @@
+import time
+import logging
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+from bson import ObjectId
+from redis.asyncio import Redis
+
+from app.core.config import settings
+
+if TYPE_CHECKING:
+    from app.core.connections import Session
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceService:
+    """
+    Cluster-wide online status backed by Redis.
+
+    Every user has a sorted set `presence:{user_id}` of their live sessions
+    on any node, scored with the time each session expires. Nodes refresh
+    the sessions that are still heartbeating every PRESENCE_REFRESH_SECONDS
+    in one pipeline, so sessions of a crashed node drop out after
+    PRESENCE_TTL_SECONDS without anyone cleaning up.
+
+    A user is online if any of their sessions has not expired, checked for
+    many users at once with `is_online_many` in a single round trip.
+
+    Until `bind` is called (e.g. in tests) only local sessions are known.
+    """
+
+    def __init__(self, ttl_seconds: int, refresh_seconds: int) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        self.redis: Optional[Redis] = None
+        self.local: Dict[ObjectId, Dict[str, "Session"]] = {}
+
+    def bind(self, redis: Redis):
+        self.redis = redis
+
+    async def unbind(self):
+        """Remove the sessions of this node from Redis."""
+        if self.redis:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id, sessions in self.local.items():
+                    pipe.zrem(self._key(user_id), *sessions)
+                await pipe.execute()
+
+        self.redis = None
+
+    @staticmethod
+    def _key(user_id: ObjectId) -> str:
+        return f"presence:{user_id}"
+
+    async def add(self, session: "Session"):
+        self.local.setdefault(session.user_id, {})[session.id] = session
+        if not self.redis:
+            return
+
+        key = self._key(session.user_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {session.id: time.time() + self.ttl_seconds})
+            pipe.expire(key, self.ttl_seconds)
+            await pipe.execute()
+
+    async def remove(self, session: "Session"):
+        sessions = self.local.get(session.user_id)
+        if sessions is not None:
+            sessions.pop(session.id, None)
+            if not sessions:
+                del self.local[session.user_id]
+
+        if self.redis:
+            await self.redis.zrem(self._key(session.user_id), session.id)
+
+    async def refresh(self):
+        """Extend the sessions of this node that are still heartbeating."""
+        if not self.redis or not self.local:
+            return
+
+        now = time.time()
+        # Sessions that went silent are left to expire (and to the reaper)
+        alive_since = time.monotonic() - self.ttl_seconds
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, sessions in self.local.items():
+                alive = {
+                    session_id: now + self.ttl_seconds
+                    for session_id, session in sessions.items()
+                    if session.last_seen >= alive_since
+                }
+                if not alive:
+                    continue
+
+                key = self._key(user_id)
+                pipe.zadd(key, alive)
+                pipe.zremrangebyscore(key, "-inf", now)
+                pipe.expire(key, self.ttl_seconds)
+            await pipe.execute()
+
+    async def is_online_many(self, user_ids: Iterable[ObjectId]) -> List[ObjectId]:
+        """Return the given users that are online on any node."""
+        user_ids = list(user_ids)
+        if not self.redis:
+            return [user_id for user_id in user_ids if user_id in self.local]
+        if not user_ids:
+            return []
+
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(self._key(user_id), now, "+inf")
+            counts = await pipe.execute()
+
+        return [user_id for user_id, count in zip(user_ids, counts) if count]
+
+    async def is_online(self, user_id: ObjectId) -> bool:
+        return bool(await self.is_online_many([user_id]))
+
+
+presence = PresenceService(
+    ttl_seconds=settings.PRESENCE_TTL_SECONDS,
+    refresh_seconds=settings.PRESENCE_REFRESH_SECONDS,
+)
@@ -2,8 +2,11 @@ from fastapi import Request
 import redis.asyncio as redis
 from app.core.config import settings
 
-redis_pool = redis.ConnectionPool.from_url(
-    settings.REDIS_URL, max_connections=10, decode_responses=True
+redis_pool = redis.BlockingConnectionPool.from_url(
+    settings.REDIS_URL,
+    max_connections=settings.REDIS_MAX_CONNECTIONS,
+    timeout=settings.REDIS_POOL_TIMEOUT,
+    decode_responses=True,
 )
 
 
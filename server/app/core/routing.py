@@ -0,0 +1,188 @@
+import time
+import logging
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+from bson import ObjectId
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from aio_pika.abc import AbstractRobustConnection
+
+from app.core.config import settings
+from app.core.schemas import DeliveryEnvelope
+from app.core.inbox import offline_inbox
+from app.core.message_broker import PublishReturned, get_publisher
+
+if TYPE_CHECKING:
+    from app.core.connections import ConnectionManager
+
+logger = logging.getLogger(__name__)
+
+
+class NodeRouter:
+    """
+    Routing table of which node holds the sockets of a user.
+
+    Each channel ("message", "sync") keeps a Redis sorted set per user with the
+    IDs of the nodes that currently hold at least one session of that user,
+    scored with the time the route expires. Nodes refresh the routes of their
+    connected users with `refresh`, so the routes of a crashed node drop out
+    after ROUTE_TTL_SECONDS. Frames for users connected to another node are
+    published to that node's queue on the `node_delivery` exchange instead of
+    being broadcast to every node.
+
+    Until `bind` is called (e.g. in tests) everything is delivered locally.
+    """
+
+    def __init__(self, node_id: str) -> None:
+        self.node_id = node_id
+        self.managers: Dict[str, "ConnectionManager"] = {}
+        self.connection: Optional[AbstractRobustConnection] = None
+        self.redis: Optional[Redis] = None
+
+    def bind(self, connection: AbstractRobustConnection, redis: Redis):
+        self.connection = connection
+        self.redis = redis
+
+    async def unbind(self):
+        """Remove this node from the routes of every locally connected user."""
+        if self.redis:
+            for channel, manager in self.managers.items():
+                for user_id in list(manager.active_connection):
+                    await self.remove_route(channel, user_id)
+
+        self.connection = None
+        self.redis = None
+
+    def register_manager(self, manager: "ConnectionManager"):
+        self.managers[manager.channel] = manager
+
+    @staticmethod
+    def _key(channel: str, user_id: ObjectId) -> str:
+        return f"route:{channel}:{user_id}"
+
+    async def add_route(self, channel: str, user_id: ObjectId):
+        if not self.redis:
+            return
+
+        key = self._key(channel, user_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {self.node_id: time.time() + settings.ROUTE_TTL_SECONDS})
+            pipe.expire(key, settings.ROUTE_TTL_SECONDS)
+            await pipe.execute()
+
+    async def remove_route(
+        self, channel: str, user_id: ObjectId, node_id: Optional[str] = None
+    ):
+        """Remove the route of `node_id` (this node by default) to a user."""
+        if not self.redis:
+            return
+
+        await self.redis.zrem(self._key(channel, user_id), node_id or self.node_id)
+
+    async def refresh(self):
+        """Extend the routes of every locally connected user."""
+        if not self.redis:
+            return
+
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel, manager in self.managers.items():
+                for user_id in list(manager.active_connection):
+                    key = self._key(channel, user_id)
+                    pipe.zadd(key, {self.node_id: now + settings.ROUTE_TTL_SECONDS})
+                    pipe.zremrangebyscore(key, "-inf", now)
+                    pipe.expire(key, settings.ROUTE_TTL_SECONDS)
+            await pipe.execute()
+
+    async def lookup(
+        self, channel: str, user_ids: Iterable[ObjectId]
+    ) -> Dict[str, List[ObjectId]]:
+        """
+        Group users by the nodes holding their sessions.
+
+        Returns:
+            Dict[str, List[ObjectId]]: node ID -> users connected to that node.
+        """
+        user_ids = list(user_ids)
+        if not self.redis or not user_ids:
+            return {}
+
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zrangebyscore(self._key(channel, user_id), now, "+inf")
+            node_sets = await pipe.execute()
+
+        nodes: Dict[str, List[ObjectId]] = {}
+        for user_id, node_ids in zip(user_ids, node_sets):
+            for node_id in node_ids:
+                nodes.setdefault(node_id, []).append(user_id)
+        return nodes
+
+    async def forward(
+        self,
+        channel: str,
+        node_id: str,
+        user_ids: List[ObjectId],
+        frame: str,
+        store_offline: bool = False,
+    ) -> bool:
+        """
+        Publish a frame to the queue of another node.
+
+        The envelope is mandatory, so when the node is gone (its exclusive
+        queue with it) the broker returns it instead of dropping it. The
+        routes of that node to the users are removed then. With
+        `store_offline` the receiving node inboxes the frame for users that
+        disconnected meanwhile.
+
+        Returns:
+            bool: True if the node's queue took the frame.
+        """
+        if not self.connection:
+            return False
+
+        envelope = DeliveryEnvelope(
+            channel=channel,
+            user_ids=user_ids,
+            frame=frame,
+            store_offline=store_offline,
+        )
+        try:
+            await get_publisher(self.connection).publish(
+                settings.EXCHANGES.node_delivery.value,
+                node_id,
+                envelope.model_dump_json().encode("utf-8"),
+                mandatory=True,
+            )
+            return True
+        except PublishReturned:
+            logger.warning(f"Node {node_id} is gone, dropping its routes")
+            for user_id in user_ids:
+                await self.remove_route(channel, user_id, node_id)
+        except Exception as e:
+            logger.error(f"Error forwarding to node {node_id}: {e}")
+        return False
+
+    async def deliver_envelope(self, envelope: DeliveryEnvelope):
+        """Write a frame forwarded by another node to the local sessions."""
+        manager = self.managers.get(envelope.channel)
+        if not manager:
+            logger.error(f"No connection manager for channel {envelope.channel}")
+            return
+
+        stale = [uid for uid in envelope.user_ids if not manager.is_online(uid)]
+        for user_id in stale:
+            # The route outlived the session, drop it so we stop receiving it
+            await self.remove_route(envelope.channel, user_id)
+
+        await manager.send_text(envelope.user_ids, envelope.frame)
+
+        if envelope.store_offline and stale:
+            # They disconnected after the sender looked up their route
+            try:
+                await offline_inbox.append(envelope.channel, stale, envelope.frame)
+            except RedisError as e:
+                logger.error(f"Error storing forwarded frame for offline users: {e}")
+
+
+node_router = NodeRouter(node_id=settings.NODE_ID)
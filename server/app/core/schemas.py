@@ -1,4 +1,4 @@
-from typing import Optional, List, Any, Callable, Literal, Union
+from typing import Optional, List, Any, Callable, Dict, Literal, Union
 from datetime import datetime, timezone
 from bson import ObjectId
 from typing_extensions import Annotated
@@ -6,6 +6,7 @@ from enum import Enum, unique
 from typing_extensions import Self
 from pydantic import BaseModel, Field, EmailStr, model_validator
 from pydantic_core import core_schema
+from app.core.config import settings
 
 
 class _ObjectIdPydanticAnnotation:
@@ -51,11 +52,14 @@ class PacketType(str, Enum):
     ping = "ping"
     pong = "pong"
     message = "message"
+    message_batch = "message_batch"
 
 
 class SyncMessageType(str, Enum):
     message_status = "message_status"
+    message_watermark = "message_watermark"
     online_status = "online_status"
+    online_status_batch = "online_status_batch"
     friend_update = "friend_update"
     friend_request = "friend_request"
     add_friend = "add_friend"
@@ -199,6 +203,11 @@ class FriendRequestOut(BaseModel):
     created_time: datetime
 
 
+class ReadReceipt(BaseModel):
+    received_seq: int = 0
+    seen_seq: int = 0
+
+
 class Conversation(BaseModel):
     id: Optional[PyObjectId] = Field(
         alias="_id", default=None, serialization_alias="id"
@@ -208,6 +217,9 @@ class Conversation(BaseModel):
     last_message_date: datetime = Field(
         default_factory=lambda: datetime.now(timezone.utc)
     )
+    last_seq: int = 0  # sequence number of the newest message
+    # participant ID -> how far they have received and seen the conversation
+    receipts: Dict[str, ReadReceipt] = {}
 
 
 class FileInfo(BaseModel):
@@ -230,6 +242,9 @@ class Message(BaseModel):
     received_time: Optional[datetime] = None
     seen_time: Optional[datetime] = None
     status: Message_Status = Message_Status.send
+    # per conversation and increasing, a message that fails to store after its
+    # number was reserved leaves a gap
+    seq: Optional[int] = None
 
 
 class MessageNoAlias(Message):
@@ -240,6 +255,14 @@ class ConversationResponse(Conversation):
     messages: List[Message] | None = None
 
 
+class ResumeResponse(BaseModel):
+    conversation_id: PyObjectId
+    last_seq: int
+    receipts: Dict[str, ReadReceipt] = {}
+    messages: List[Message]
+    has_more: bool
+
+
 class FileData(BaseModel):
     temp_file_id: Optional[str] = None
     name: str
@@ -255,7 +278,16 @@ class MessageData(BaseModel):
 
 class MessagePacket(BaseModel):
     type: PacketType
-    data: Optional[Union[Message, MessageData]] = None
+    # `message_batch` packets carry a bounded list of MessageData
+    data: Optional[
+        Union[
+            Message,
+            MessageData,
+            Annotated[
+                List[MessageData], Field(max_length=settings.MESSAGE_BATCH_MAX_SIZE)
+            ],
+        ]
+    ] = None
 
 
 class MessageEvent(BaseModel):
@@ -269,12 +301,42 @@ class OnlineStatusMessage(BaseModel):
     status: Literal["online", "offline"]
 
 
+class OnlineStatusBatch(BaseModel):
+    """Presence changes of several contacts, coalesced into one packet."""
+
+    type: Literal[SyncMessageType.online_status_batch] = (
+        SyncMessageType.online_status_batch
+    )
+    data: List[OnlineStatusMessage]
+
+
 class MessageStatusUpdate(BaseModel):
     type: Literal[SyncMessageType.message_status] = SyncMessageType.message_status
     data: List[MessageEvent]
     status: Message_Status
 
 
+class MessageStatusBatch(BaseModel):
+    """Message status updates of all sync sockets over one flush window."""
+
+    updates: List[MessageStatusUpdate]
+
+
+class MessageWatermark(BaseModel):
+    """
+    Every message of a conversation up to `seq` was received or seen by
+    `user_id`, one event instead of a MessageStatusUpdate per message.
+    """
+
+    type: Literal[SyncMessageType.message_watermark] = SyncMessageType.message_watermark
+    conversation_id: PyObjectId
+    status: Literal[Message_Status.recieved, Message_Status.seen]
+    seq: int = Field(ge=1)
+    # set by the server to the participant that sent the watermark
+    user_id: Optional[PyObjectId] = None
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
 class FriendUpdateMessage(BaseModel):
     type: Literal[SyncMessageType.friend_update] = SyncMessageType.friend_update
     id: PyObjectId
@@ -286,7 +348,8 @@ class FriendUpdateMessage(BaseModel):
 
 
 class BrodcastMessage(BaseModel):
-    ids: list[PyObjectId]
+    # Empty: sent to the contacts of the updated user (data.id)
+    ids: list[PyObjectId] = []
     data: FriendUpdateMessage
 
 
@@ -409,9 +472,11 @@ WebRTCMessage = Union[
 # Combined Message Model for Websocket Handeling
 SyncSocketMessage = Union[
     OnlineStatusMessage,
+    OnlineStatusBatch,
     FriendUpdateMessage,
     FriendRequestMessage,
     MessageStatusUpdate,
+    MessageWatermark,
     AddFriendMessage,
     ProfileMediaUpdate,
     WebRTCOffer,
@@ -424,6 +489,23 @@ class SyncPacket(BaseModel):
     data: Optional[SyncSocketMessage] = Field(default=None, discriminator="type")
 
 
+class MuxPacket(BaseModel):
+    """Packet of the multiplexed socket, a MessagePacket or SyncPacket by channel."""
+
+    channel: Literal["message", "sync"]
+    packet: Dict[str, Any]
+
+
+class DeliveryEnvelope(BaseModel):
+    """Serialized socket frame forwarded to the node holding the recipients."""
+
+    channel: Literal["message", "sync"]
+    user_ids: List[PyObjectId]
+    frame: str
+    # keep the frame for recipients that left the node before it arrived
+    store_offline: bool = False
+
+
 class UserProfileMedia(BaseModel):
     avatar: Optional[str] = None
     banner: Optional[str] = None
@@ -18,9 +18,15 @@ from app.background_tasks.async_ops.tasks import (
     watch_friend_requests,
     profile_media_update_confirmation,
     send_message_to_users,
+    deliver_routed_frames,
 )
 
-from app.core.message_broker import create_rabbit_connection, create_rabbit_exchanges
+from app.core.message_broker import (
+    create_rabbit_connection,
+    create_rabbit_exchanges,
+    consumer_registry,
+    get_publisher,
+)
 
 from app.core.db import (
     AsyncDatabase,
@@ -30,6 +36,20 @@ from app.core.db import (
 )
 from app.core.config import settings
 from app.core.redis import get_redis_client
+from app.core.routing import node_router
+from app.core.connections import reap_idle_sessions, refresh_sessions
+from app.core.inbox import offline_inbox
+from app.core.presence import presence
+from app.core.contacts import contact_index
+from app.api.msg_socket.services import (
+    participant_cache,
+    sequence_counter,
+    submission_dedup,
+)
+from app.api.msg_socket.write_behind import message_buffer
+from app.api.sync_socket.router import connections as sync_connections
+from app.api.sync_socket.status_buffer import status_aggregator
+from app.background_tasks.async_ops.services import online_status_batcher
 from app.core.exceptions import AppException
 from .exception_handler import app_exception_handler
 
@@ -57,14 +77,31 @@ async def lifespan(app: FastAPI) -> AsyncIterator[State]:
     await create_rabbit_exchanges(connection=queue_connection)
 
     async_db = AsyncDatabase(async_cleint, settings.DATABASE_NAME)
+    await async_db.initialize_message_indexes()
+    node_router.bind(connection=queue_connection, redis=redis_client)
+    offline_inbox.bind(redis=redis_client)
+    presence.bind(redis=redis_client)
+    contact_index.bind(redis=redis_client)
+    participant_cache.bind(redis=redis_client)
+    submission_dedup.bind(redis=redis_client)
+    sequence_counter.bind(redis=redis_client)
+    online_status_batcher.bind(redis=redis_client)
+    message_buffer.start(db=async_db)
+    status_aggregator.start(db=async_db, connection=queue_connection)
+
+    # All consumers share queue_connection, one channel each
+    consumer_registry.add(handle_online_status_update, db=async_db)
+    consumer_registry.add(process_message_status_updates, db=async_db)
+    consumer_registry.add(distribute_published_messages, db=async_db)
+    consumer_registry.add(profile_media_update_confirmation)
+    consumer_registry.add(send_message_to_users, db=async_db)
+    consumer_registry.add(deliver_routed_frames)
+    await consumer_registry.start(connection=queue_connection)
 
     app.state.background_tasks = [
         asyncio.create_task(watch_friend_requests()),
-        asyncio.create_task(handle_online_status_update(db=async_db)),
-        asyncio.create_task(process_message_status_updates(db=async_db)),
-        asyncio.create_task(distribute_published_messages(db=async_db)),
-        asyncio.create_task(profile_media_update_confirmation()),
-        asyncio.create_task(send_message_to_users()),
+        asyncio.create_task(reap_idle_sessions()),
+        asyncio.create_task(refresh_sessions()),
     ]
     logger.info("yealding the state")
 
@@ -79,14 +116,26 @@ async def lifespan(app: FastAPI) -> AsyncIterator[State]:
         task.cancel()
 
     await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
+    await consumer_registry.stop()
+    # Announced before the publisher closes, it waits for their confirms
+    await sync_connections.flush_offline(queue_connection)
+    # Changes acked from the queue but not distributed yet
+    await online_status_batcher.stop()
+    await node_router.unbind()
+    await presence.unbind()
+
+    # Store the messages that were delivered but not written yet
+    await message_buffer.stop()
+    await status_aggregator.stop()
 
     async_cleint.close()
     sync_client.close()
+    await get_publisher(queue_connection).close()
     await queue_connection.close()
     await redis_client.close()
 
 
-def create_app() -> FastAPI:
+def create_app(lifespan=lifespan) -> FastAPI:
     app = FastAPI(lifespan=lifespan)
 
     app.include_router(router=router)
@@ -0,0 +1,103 @@
+"""
+Compares per-recipient serialization with serialize-once fan-out.
+
+Run from the server directory:
+
+    uv run python -m benchmarks.fanout --recipients 1000 --rounds 20
+"""
+
+import time
+import asyncio
+import argparse
+from typing import Callable, List
+from bson import ObjectId
+
+from app.core.connections import ConnectionManager
+from app.core.schemas import (
+    SyncPacket,
+    PacketType,
+    OnlineStatusMessage,
+    FriendUpdateMessage,
+    SyncSocketMessage,
+)
+
+
+class NullWebSocket:
+    scope: dict = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        pass
+
+
+async def per_recipient(
+    manager: ConnectionManager, user_ids: List[ObjectId], data: SyncSocketMessage
+):
+    # What sync_socket.send_message used to do: one packet and one dump per user
+    for user_id in user_ids:
+        packet = SyncPacket(type=PacketType.message, data=data)
+        await manager.send_text([user_id], packet.model_dump_json())
+
+
+async def serialize_once(
+    manager: ConnectionManager, user_ids: List[ObjectId], data: SyncSocketMessage
+):
+    await manager.deliver(user_ids, SyncPacket(type=PacketType.message, data=data))
+
+
+async def drain(manager: ConnectionManager):
+    for user_id in list(manager.active_connection):
+        for session in manager.get_sessions(user_id):
+            await session.queue.join()
+
+
+async def measure(
+    fan_out: Callable, manager: ConnectionManager, user_ids, data, rounds: int
+) -> float:
+    elapsed = 0.0
+    for _ in range(rounds):
+        start = time.process_time()
+        await fan_out(manager, user_ids, data)
+        elapsed += time.process_time() - start
+
+        # Keep the session queues below their high-water mark
+        await drain(manager)
+    return elapsed / rounds
+
+
+async def main(recipients: int, rounds: int):
+    manager = ConnectionManager(channel="benchmark")
+    user_ids = [ObjectId() for _ in range(recipients)]
+    for user_id in user_ids:
+        await manager.connect(user_id, NullWebSocket())
+
+    payloads = {
+        "online_status": OnlineStatusMessage(user_id=str(ObjectId()), status="online"),
+        "friend_update": FriendUpdateMessage(
+            id=ObjectId(),
+            full_name="Bridge User",
+            bio="Hello there, I am using bridge.",
+            profile_picture="profile_picture/6650f1a2c9e77c0012345678",
+        ),
+    }
+
+    print(f"{recipients} recipients, {rounds} rounds (CPU ms per broadcast)")
+    for name, data in payloads.items():
+        before = await measure(per_recipient, manager, user_ids, data, rounds)
+        after = await measure(serialize_once, manager, user_ids, data, rounds)
+        print(
+            f"{name:>14}: per-recipient {before * 1000:7.2f}  "
+            f"serialize-once {after * 1000:7.2f}  "
+            f"saved {(1 - after / before) * 100:5.1f}%"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.recipients, args.rounds))
@@ -0,0 +1,473 @@
+"""
+In-process load test of the message and sync sockets.
+
+Runs `create_app()` with local stand-ins for Mongo (mongomock-motor), Redis
+(fakeredis) and RabbitMQ (an in-memory exchange that feeds the real consumer
+handlers), then drives N authenticated clients straight through ASGI. Every
+client chats with a partner, acks received messages with a status update and
+pings both sockets. Reports throughput and p50/p95/p99 latency of chat
+delivery and of the status update round trip back to the sender.
+
+mongomock scans whole collections on every query, so with it the numbers
+mostly compare socket/broker overhead between runs. Pass `--mongo-url` to
+store into a real (throwaway) database instead.
+
+Needs the test stand-ins installed (`uv pip install fakeredis mongomock-motor`).
+Run from the server directory:
+
+    uv run python -m benchmarks.load --clients 200 --messages 50
+    uv run python -m benchmarks.load --mongo-url mongodb://localhost:27017
+"""
+
+import json
+import time
+import asyncio
+import functools
+import argparse
+import logging
+import statistics
+import contextlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from bson import ObjectId
+
+import jwt
+from fakeredis import FakeAsyncRedis  # type: ignore
+from mongomock_motor import AsyncMongoMockClient  # type: ignore
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app.main import create_app
+from app.core.config import settings
+from app.core.db import AsyncDatabase
+from app.core.routing import node_router
+from app.core.inbox import offline_inbox
+from app.core.presence import presence
+from app.core.contacts import contact_index
+from app.api.msg_socket.services import sequence_counter, submission_dedup
+from app.api.msg_socket.write_behind import message_buffer
+from app.api.sync_socket.status_buffer import status_aggregator
+from app.background_tasks.async_ops.tasks import (
+    handle_online_status_update,
+    process_message_status_updates,
+)
+
+
+class LocalMessage:
+    """Stand-in for an incoming aio-pika message."""
+
+    def __init__(self, body: bytes) -> None:
+        self.body = body
+
+    def ack(self):
+        pass
+
+    @contextlib.asynccontextmanager
+    async def process(self):
+        yield
+
+
+class LocalBroker:
+    """
+    Stand-in for the RabbitMQ connection, exchanges route straight to handlers.
+
+    Handlers are the undecorated consumer functions, so published events go
+    through the same code the rabbit consumers run. Batch handlers get every
+    event as a batch of one.
+    """
+
+    def __init__(self) -> None:
+        self.handlers: Dict[Tuple[str, str], Tuple[Callable, Dict[str, Any]]] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    def bind(
+        self,
+        exchange: str,
+        topic: str,
+        handler: Callable,
+        batch: bool = False,
+        **kwargs,
+    ):
+        if batch:
+            handler = functools.partial(self._as_batch, handler)
+        self.handlers[(exchange, topic)] = (handler, kwargs)
+
+    @staticmethod
+    async def _as_batch(handler: Callable, message: "LocalMessage", **kwargs):
+        await handler([message], **kwargs)
+
+    async def channel(self, publisher_confirms: bool = True) -> "LocalChannel":
+        return LocalChannel(self)
+
+    def dispatch(self, exchange: str, topic: str, body: bytes):
+        if (exchange, topic) not in self.handlers:
+            return
+
+        handler, kwargs = self.handlers[(exchange, topic)]
+        task = asyncio.create_task(handler(LocalMessage(body), **kwargs))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+class LocalChannel:
+    is_closed = False
+
+    def __init__(self, broker: LocalBroker) -> None:
+        self.broker = broker
+
+    async def get_exchange(self, name: str) -> "LocalExchange":
+        return LocalExchange(self.broker, name)
+
+    async def close(self):
+        pass
+
+
+class LocalExchange:
+    def __init__(self, broker: LocalBroker, name: str) -> None:
+        self.broker = broker
+        self.name = name
+
+    async def publish(self, message, routing_key: str, mandatory: bool = True):
+        self.broker.dispatch(self.name, routing_key, message.body)
+
+
+def stand_in_lifespan(db: AsyncDatabase, redis: FakeAsyncRedis, broker: LocalBroker):
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        node_router.bind(connection=broker, redis=redis)  # type: ignore
+        offline_inbox.bind(redis=redis)
+        presence.bind(redis=redis)
+        contact_index.bind(redis=redis)
+        sequence_counter.bind(redis=redis)
+        submission_dedup.bind(redis=redis)
+        message_buffer.start(db=db)
+        status_aggregator.start(db=db, connection=broker)  # type: ignore
+
+        yield {
+            "async_db": db,
+            "sync_db": None,
+            "queue_connection": broker,
+            "redis": redis,
+        }
+
+        await node_router.unbind()
+        await presence.unbind()
+        await message_buffer.stop()
+        await status_aggregator.stop()
+
+    return lifespan
+
+
+class SocketClient:
+    """A WebSocket client talking to the ASGI app directly, no network."""
+
+    def __init__(
+        self,
+        app,
+        state: Dict[str, Any],
+        path: str,
+        token: str,
+        on_frame: Callable[[Dict[str, Any]], None],
+    ) -> None:
+        self.app = app
+        self.scope = {
+            "type": "websocket",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "scheme": "ws",
+            "query_string": b"",
+            "headers": [(b"cookie", f"access_t={token}".encode())],
+            "subprotocols": [],
+            "client": ("127.0.0.1", 0),
+            "server": ("testserver", 80),
+            "state": dict(state),
+        }
+        self.on_frame = on_frame
+        self.inbound: asyncio.Queue[Dict[str, Any]] = asyncio.Queue()
+        self.accepted = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        await self.inbound.put({"type": "websocket.connect"})
+        self.task = asyncio.create_task(self.app(self.scope, self._receive, self._send))
+        accepted = asyncio.create_task(self.accepted.wait())
+        await asyncio.wait([accepted, self.task], return_when=asyncio.FIRST_COMPLETED)
+        if self.task.done():
+            accepted.cancel()
+            self.task.result()  # raises what the app raised
+            raise RuntimeError(f"{self.scope['path']} closed the connection")
+
+    def send(self, packet: Dict[str, Any]):
+        self.inbound.put_nowait(
+            {"type": "websocket.receive", "text": json.dumps(packet)}
+        )
+
+    async def close(self):
+        await self.inbound.put({"type": "websocket.disconnect", "code": 1000})
+        if self.task:
+            await self.task
+
+    async def _receive(self) -> Dict[str, Any]:
+        return await self.inbound.get()
+
+    async def _send(self, message: Dict[str, Any]):
+        if message["type"] == "websocket.accept":
+            self.accepted.set()
+        elif message["type"] == "websocket.send":
+            self.on_frame(json.loads(message["text"]))
+        elif message["type"] == "websocket.close":
+            self.accepted.set()
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.sent_at: Dict[str, float] = {}  # temp_id -> send time
+        self.acked_at: Dict[str, float] = {}  # message id -> send time
+        self.delivery: List[float] = []
+        self.status: List[float] = []
+        self.pongs = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    def check_done(self):
+        if len(self.delivery) >= self.expected and len(self.status) >= self.expected:
+            self.done.set()
+
+
+class BenchUser:
+    def __init__(
+        self, user_id: ObjectId, partner_id: ObjectId, conversation_id: ObjectId
+    ) -> None:
+        self.id = user_id
+        self.partner_id = partner_id
+        self.conversation_id = conversation_id
+        self.message: Optional[SocketClient] = None
+        self.sync: Optional[SocketClient] = None
+
+    def on_message_frame(self, recorder: Recorder, packet: Dict[str, Any]):
+        if packet["type"] == "pong":
+            recorder.pongs += 1
+            return
+
+        data = packet.get("data") or {}
+        if packet["type"] != "message" or not data.get("temp_id"):
+            return
+
+        now = time.perf_counter()
+        if data["sender_id"] == str(self.id):
+            # our own message came back stored, wait for its status update
+            recorder.acked_at[data["id"]] = recorder.sent_at[data["temp_id"]]
+            return
+
+        recorder.delivery.append(now - recorder.sent_at[data["temp_id"]])
+        assert self.sync is not None
+        self.sync.send(
+            {
+                "type": "message",
+                "data": {
+                    "type": "message_status",
+                    "status": "received",
+                    "data": [
+                        {
+                            "message_id": data["id"],
+                            "timestamp": datetime.now(timezone.utc).isoformat(),
+                        }
+                    ],
+                },
+            }
+        )
+        recorder.check_done()
+
+    def on_sync_frame(self, recorder: Recorder, packet: Dict[str, Any]):
+        if packet["type"] == "pong":
+            recorder.pongs += 1
+            return
+
+        data = packet.get("data") or {}
+        if data.get("type") != "message_status":
+            return
+
+        now = time.perf_counter()
+        for event in data["data"]:
+            sent_at = recorder.acked_at.get(event["message_id"])
+            if sent_at is not None:
+                recorder.status.append(now - sent_at)
+        recorder.check_done()
+
+
+async def seed(db: AsyncDatabase, clients: int) -> List[BenchUser]:
+    """Verified users in friend pairs, each pair with a conversation."""
+    users: List[BenchUser] = []
+    for _ in range(clients // 2):
+        a, b = ObjectId(), ObjectId()
+        for user_id in (a, b):
+            await db.user_auth.insert_one(
+                {
+                    "_id": user_id,
+                    "username": f"user_{user_id}",
+                    "email": f"{user_id}@example.com",
+                    "email_verified": True,
+                    "created_at": datetime.now(timezone.utc),
+                }
+            )
+        await db.friends.insert_many(
+            [{"user_id": a, "friend_id": b}, {"user_id": b, "friend_id": a}]
+        )
+        conversation = await db.conversation.insert_one(
+            {
+                "participants": [a, b],
+                "start_date": datetime.now(timezone.utc),
+                "last_message_date": datetime.now(timezone.utc),
+                "last_seq": 0,
+            }
+        )
+        users += [
+            BenchUser(a, b, conversation.inserted_id),
+            BenchUser(b, a, conversation.inserted_id),
+        ]
+    return users
+
+
+def access_token(user_id: ObjectId) -> str:
+    return jwt.encode(
+        {"sub": str(user_id), "exp": datetime.now(timezone.utc) + timedelta(hours=1)},
+        key=settings.JWT_ACCESS_SECRET_KEY,
+        algorithm=settings.ALGORITHM,
+    )
+
+
+async def chat(
+    user: BenchUser, recorder: Recorder, messages: int, ping_every: int
+) -> None:
+    assert user.message is not None and user.sync is not None
+    for i in range(messages):
+        temp_id = f"{user.id}-{i}"
+        recorder.sent_at[temp_id] = time.perf_counter()
+        user.message.send(
+            {
+                "type": "message",
+                "data": {
+                    "message": f"benchmark message {i}",
+                    "receiver_id": str(user.partner_id),
+                    "conversation_id": str(user.conversation_id),
+                    "temp_id": temp_id,
+                },
+            }
+        )
+        if ping_every and i % ping_every == 0:
+            user.message.send({"type": "ping"})
+            user.sync.send({"type": "ping"})
+
+        # let the app drain the socket between sends, like a real client
+        await asyncio.sleep(0)
+
+
+def percentiles(samples: List[float]) -> str:
+    if len(samples) < 2:
+        return "n/a"
+    cuts = statistics.quantiles(samples, n=100)
+    return "  ".join(f"p{p} {cuts[p - 1] * 1000:7.2f} ms" for p in (50, 95, 99))
+
+
+async def main(
+    clients: int,
+    messages: int,
+    ping_every: int,
+    timeout: float,
+    mongo_url: Optional[str] = None,
+):
+    # the sockets log every disconnect as an error
+    logging.disable(logging.ERROR)
+    if not settings.JWT_ACCESS_SECRET_KEY:
+        settings.JWT_ACCESS_SECRET_KEY = "benchmark-secret-key-of-32-bytes!"
+
+    db_name = f"bridge_benchmark_{ObjectId()}"
+    client = AsyncIOMotorClient(mongo_url) if mongo_url else AsyncMongoMockClient()
+    db = AsyncDatabase(client, db_name)  # type: ignore
+    redis = FakeAsyncRedis(decode_responses=True)
+    broker = LocalBroker()
+    broker.bind(
+        settings.EXCHANGES.sync_message.value,
+        settings.TOPICS.online_status.value,
+        handle_online_status_update.__wrapped__,  # type: ignore
+        db=db,
+    )
+    broker.bind(
+        settings.EXCHANGES.sync_message.value,
+        settings.TOPICS.message_status_update.value,
+        process_message_status_updates.__wrapped__,  # type: ignore
+        batch=True,
+        db=db,
+    )
+
+    app = create_app(lifespan=stand_in_lifespan(db, redis, broker))
+    users = await seed(db, clients - clients % 2)
+    recorder = Recorder()
+    recorder.expected = len(users) * messages
+
+    async with app.router.lifespan_context(app) as state:
+        for user in users:
+            token = access_token(user.id)
+            user.message = SocketClient(
+                app,
+                state,
+                "/message/scoket/",
+                token,
+                lambda packet, user=user: user.on_message_frame(recorder, packet),
+            )
+            user.sync = SocketClient(
+                app,
+                state,
+                "/sync/",
+                token,
+                lambda packet, user=user: user.on_sync_frame(recorder, packet),
+            )
+            await user.message.connect()
+            await user.sync.connect()
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(chat(user, recorder, messages, ping_every) for user in users)
+        )
+        try:
+            await asyncio.wait_for(recorder.done.wait(), timeout)
+        except TimeoutError:
+            print(f"timed out after {timeout}s, partial results")
+        elapsed = time.perf_counter() - start
+
+        for user in users:
+            await user.message.close()  # type: ignore
+            await user.sync.close()  # type: ignore
+
+    print(
+        f"{len(users)} clients x {messages} messages in {elapsed:.2f}s "
+        f"(expected {recorder.expected} deliveries)"
+    )
+    print(
+        f"  chat delivered {len(recorder.delivery):7d}  "
+        f"{len(recorder.delivery) / elapsed:9.0f} msg/s  "
+        f"{percentiles(recorder.delivery)}"
+    )
+    print(
+        f"  status updates {len(recorder.status):7d}  "
+        f"{len(recorder.status) / elapsed:9.0f} upd/s  "
+        f"{percentiles(recorder.status)}"
+    )
+    print(f"  pongs          {recorder.pongs:7d}")
+
+    if mongo_url:
+        await client.drop_database(db_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--ping-every", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--mongo-url", help="use a real MongoDB instead of mongomock")
+    args = parser.parse_args()
+
+    asyncio.run(
+        main(args.clients, args.messages, args.ping_every, args.timeout, args.mongo_url)
+    )
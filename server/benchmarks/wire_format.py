@@ -0,0 +1,129 @@
+"""
+Compares JSON and MessagePack frames for typical socket packets.
+
+Reports bytes on the wire and the CPU time to encode and decode each packet
+with the same Pydantic schemas the sockets use. Run from the server directory:
+
+    uv run python -m benchmarks.wire_format --rounds 2000
+"""
+
+import time
+import argparse
+from datetime import datetime, timezone
+from typing import Callable, Dict, Type
+from bson import ObjectId
+from pydantic import BaseModel
+
+from app.core.codec import Frame, decode_frame
+from app.core.schemas import (
+    Message,
+    MessageEvent,
+    MessagePacket,
+    MessageStatusUpdate,
+    Message_Status,
+    PacketType,
+    SyncPacket,
+    WebRTCIceCandidate,
+    WebRTCOffer,
+)
+
+SDP = "\r\n".join(
+    ["v=0", "o=- 4611731400430051336 2 IN IP4 127.0.0.1", "s=-", "t=0 0"]
+    + [
+        f"a=candidate:{i} 1 udp 2122260223 192.168.1.{i} {50000 + i} typ host"
+        for i in range(40)
+    ]
+    + [f"a=rtpmap:{96 + i} VP8/90000" for i in range(20)]
+)
+
+
+def sample_packets() -> Dict[str, BaseModel]:
+    sender, receiver = ObjectId(), ObjectId()
+    now = datetime.now(timezone.utc)
+
+    return {
+        "chat message": MessagePacket(
+            type=PacketType.message,
+            data=Message(
+                id=ObjectId(),
+                temp_id="5b0b3c1e-3c4f-4d7a-9f1e-0c8f6f1d2a11",
+                conversation_id=ObjectId(),
+                sender_id=sender,
+                receiver_id=receiver,
+                message="See you at the station in ten minutes!",
+            ),
+        ),
+        "status batch (200)": SyncPacket(
+            type=PacketType.message,
+            data=MessageStatusUpdate(
+                data=[
+                    MessageEvent(message_id=str(ObjectId()), timestamp=now)
+                    for _ in range(200)
+                ],
+                status=Message_Status.seen,
+            ),
+        ),
+        "webrtc offer": SyncPacket(
+            type=PacketType.message,
+            data=WebRTCOffer(
+                sender_id=sender,
+                receiver_id=receiver,
+                call_id=None,
+                type="offer",
+                audio=True,
+                video=True,
+                description={"type": "offer", "sdp": SDP},
+            ),
+        ),
+        "ice candidate": SyncPacket(
+            type=PacketType.message,
+            data=WebRTCIceCandidate(
+                sender_id=sender,
+                receiver_id=receiver,
+                type="ice-candidate",
+                candidate={
+                    "candidate": "candidate:1 1 udp 2122260223 192.168.1.7 50007 typ host",
+                    "sdpMid": "0",
+                    "sdpMLineIndex": 0,
+                },
+            ),
+        ),
+    }
+
+
+def cpu_time(func: Callable[[], object], rounds: int) -> float:
+    start = time.process_time()
+    for _ in range(rounds):
+        func()
+    return (time.process_time() - start) / rounds * 1_000_000
+
+
+def main(rounds: int):
+    print(
+        f"{'packet':>20} {'json B':>8} {'msgpack B':>10} {'json enc/dec us':>17} {'msgpack enc/dec us':>19}"
+    )
+
+    for name, packet in sample_packets().items():
+        model: Type[BaseModel] = type(packet)
+        text = packet.model_dump_json()
+        packed = Frame(text).packed
+
+        json_encode = cpu_time(lambda: packet.model_dump_json(), rounds)
+        json_decode = cpu_time(lambda: decode_frame(model, text), rounds)
+        # A fresh Frame every round so the msgpack encoding is not cached
+        msgpack_encode = cpu_time(lambda: Frame.from_model(packet).packed, rounds)
+        msgpack_decode = cpu_time(lambda: decode_frame(model, packed), rounds)
+
+        print(
+            f"{name:>20} {len(text.encode()):>8} {len(packed):>10} "
+            f"{json_encode:>8.1f}/{json_decode:<8.1f} "
+            f"{msgpack_encode:>9.1f}/{msgpack_decode:<9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    main(args.rounds)
@@ -0,0 +1,16 @@
+from app.core.cache import LRUCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache: LRUCache[str] = LRUCache(maxsize=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("c") == "3"
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import msgpack  # type: ignore
+import pytest
+from bson import ObjectId
+from app.core.codec import HEARTBEATS, MUX_HEARTBEATS, Frame
+from app.core.connections import (
+    ConnectionManager,
+    Session,
+    open_session,
+    reap_idle_sessions,
+)
+from tests.fixtures.websocket import FakeWebSocket, StalledWebSocket
+
+
+@pytest.mark.asyncio
+async def test_message_reaches_every_device_of_user():
+    manager = ConnectionManager(channel="test")
+    user_id = ObjectId()
+    desktop, phone = FakeWebSocket(), FakeWebSocket()
+
+    await manager.connect(user_id, desktop)
+    await manager.connect(user_id, phone)
+    await manager.send_text([user_id], "hello")
+
+    for session in manager.get_sessions(user_id):
+        await session.queue.join()
+
+    assert desktop.sent == ["hello"]
+    assert phone.sent == ["hello"]
+
+
+@pytest.mark.asyncio
+async def test_user_stays_online_until_last_session_disconnects():
+    manager = ConnectionManager(channel="test")
+    user_id = ObjectId()
+
+    first = await manager.connect(user_id, FakeWebSocket())
+    second = await manager.connect(user_id, FakeWebSocket())
+
+    assert await manager.disconnect(first) is False
+    assert manager.is_online(user_id)
+    assert await manager.disconnect(second) is True
+    assert not manager.is_online(user_id)
+
+
+@pytest.mark.asyncio
+async def test_slow_session_drops_oldest_frames():
+    session = Session(
+        ObjectId(), StalledWebSocket(), max_queue_size=2, policy="drop_oldest"
+    )
+    await asyncio.sleep(0)
+
+    for frame in ["1", "2", "3", "4"]:
+        session.send(Frame(frame))
+
+    assert [frame.text for frame in session.queue._queue] == ["3", "4"]
+    assert session.dropped == 2
+    session.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_session_is_evicted():
+    websocket = StalledWebSocket()
+    session = Session(ObjectId(), websocket, max_queue_size=1, policy="disconnect")
+    await asyncio.sleep(0)
+
+    for frame in ["1", "2", "3"]:
+        session.send(Frame(frame))
+    # the close task is held until it is done
+    assert len(session._closing) == 1
+    await asyncio.sleep(0)
+
+    assert session.evicted
+    assert websocket.closed_with == 1013
+    await asyncio.sleep(0)
+    assert not session._closing
+
+
+@pytest.mark.asyncio
+async def test_msgpack_session_receives_binary_frames():
+    manager = ConnectionManager(channel="test")
+    user_id = ObjectId()
+    websocket = FakeWebSocket()
+    websocket.scope = {"subprotocols": ["bridge.msgpack", "bridge.json"]}
+    sent_bytes: list[bytes] = []
+
+    async def send_bytes(data: bytes):
+        sent_bytes.append(data)
+
+    websocket.send_bytes = send_bytes  # type: ignore
+    session = await manager.connect(user_id, websocket)
+    await manager.send_text([user_id], '{"type":"pong"}')
+    await session.queue.join()
+
+    assert sent_bytes == [msgpack.packb({"type": "pong"})]
+    assert websocket.sent == []
+
+
+@pytest.mark.asyncio
+async def test_multiplexed_session_wraps_frames_with_channel():
+    messages, sync = ConnectionManager(channel="message"), ConnectionManager("sync")
+    user_id = ObjectId()
+    websocket = FakeWebSocket()
+    session = await open_session(user_id, websocket, multiplexed=True)
+    await messages.add_session(session)
+    await sync.add_session(session)
+
+    await messages.send_text([user_id], '{"type":"message"}')
+    await sync.send_text([user_id], '{"type":"pong"}')
+    await session.queue.join()
+
+    assert [json.loads(frame) for frame in websocket.sent] == [
+        {"channel": "message", "packet": {"type": "message"}},
+        {"channel": "sync", "packet": {"type": "pong"}},
+    ]
+    session.close()
+
+
+@pytest.mark.asyncio
+async def test_idle_session_is_reaped():
+    manager = ConnectionManager(channel="test")
+    websocket = FakeWebSocket()
+    session = await manager.connect(ObjectId(), websocket)
+    session.last_seen -= 60
+
+    reaper = asyncio.create_task(reap_idle_sessions(timeout=30, interval=0))
+    await asyncio.sleep(0.01)
+    reaper.cancel()
+
+    assert session.expired
+    assert websocket.closed_with == 1001
+
+
+def test_heartbeats_are_recognised_without_parsing():
+    assert '{"type":"ping"}' in HEARTBEATS
+    assert msgpack.packb({"type": "ping"}) in HEARTBEATS
+    assert '{"type":"message"}' not in HEARTBEATS
+    assert MUX_HEARTBEATS['{"channel":"sync","packet":{"type":"ping"}}'] == "sync"
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from app.core.message_broker import ConsumerRegistry, rabbit_consumer
+
+
+class FakeQueue:
+    async def bind(self, exchange, routing_key: str):
+        pass
+
+
+class FakeChannel:
+    def __init__(self) -> None:
+        self.is_closed = False
+
+    async def set_qos(self, prefetch_count: int):
+        pass
+
+    async def get_exchange(self, name: str):
+        return name
+
+    async def declare_queue(self, **kwargs) -> FakeQueue:
+        return FakeQueue()
+
+    async def close(self):
+        self.is_closed = True
+
+
+class FakeConnection:
+    def __init__(self, fail_first: int) -> None:
+        self.fail_first = fail_first
+        self.channels: list = []
+
+    async def channel(self) -> FakeChannel:
+        if self.fail_first:
+            self.fail_first -= 1
+            raise ConnectionError("channel refused")
+        self.channels.append(FakeChannel())
+        return self.channels[-1]
+
+
+@rabbit_consumer(topic_name="test", exchange_name="test", initial_delay=0)
+async def handler(message):
+    pass
+
+
+@pytest.mark.asyncio
+async def test_registry_runs_consumers_on_one_connection_and_restarts_them(
+    monkeypatch,
+):
+    consumed = asyncio.Event()
+
+    async def consume(queue, args, kwargs):
+        consumed.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(handler, "consume", consume)
+    connection = FakeConnection(fail_first=1)
+    registry = ConsumerRegistry()
+    registry.add(handler)
+
+    await registry.start(connection)  # type: ignore
+    await asyncio.wait_for(consumed.wait(), timeout=1)
+
+    health = registry.health()["handler"]
+    assert health["state"] == "running"
+    assert health["restarts"] == 1
+    assert "channel refused" in health["last_error"]
+    assert registry.healthy()
+
+    await registry.stop()
+    assert connection.channels[0].is_closed
+    assert registry.health()["handler"]["state"] == "stopped"
+
+
+@rabbit_consumer(
+    topic_name="test", exchange_name="test", max_retries=2, initial_delay=0
+)
+async def flaky_handler(message):
+    pass
+
+
+@pytest.mark.asyncio
+async def test_only_failures_in_a_row_count_against_max_retries(monkeypatch):
+    failures = 3
+    consumed = asyncio.Event()
+
+    async def consume(queue, args, kwargs):
+        nonlocal failures
+        if failures:
+            # the channel drops after the consumer got going
+            failures -= 1
+            raise ConnectionError("channel closed")
+        consumed.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(flaky_handler, "consume", consume)
+    registry = ConsumerRegistry()
+    registry.add(flaky_handler)
+
+    await registry.start(FakeConnection(fail_first=0))  # type: ignore
+    await asyncio.wait_for(consumed.wait(), timeout=1)
+
+    health = registry.health()["flaky_handler"]
+    assert health["state"] == "running"
+    assert health["restarts"] == 3
+    await registry.stop()
@@ -0,0 +1,87 @@
+import json
+import asyncio
+import contextlib
+import pytest
+from app.core.message_broker import ConsumerWorkers, body_field, settle_batch
+
+
+class FakeMessage:
+    def __init__(self, user_id: str, n: int) -> None:
+        self.body = json.dumps({"user_id": user_id, "n": n}).encode()
+        self.acked = False
+        self.rejected = None
+
+    @contextlib.asynccontextmanager
+    async def process(self, requeue: bool = False):
+        try:
+            yield
+        except BaseException:
+            self.rejected = ("reject", requeue)
+            raise
+        self.acked = True
+
+
+@pytest.mark.asyncio
+async def test_workers_run_in_parallel_but_keep_order_per_key():
+    handled = []
+    running = 0
+    most_running = 0
+
+    async def handler(message: FakeMessage):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        data = json.loads(message.body)
+        # later messages of a user finish sooner unless they are ordered
+        await asyncio.sleep(0.01 * (3 - data["n"]))
+        handled.append((data["user_id"], data["n"]))
+        running -= 1
+
+    workers = ConsumerWorkers(handler, "test", concurrency=4, key=body_field("user_id"))
+    messages = [FakeMessage(user, n) for n in range(3) for user in ("a", "b")]
+    for message in messages:
+        await workers.submit(message)
+    await workers.drain(timeout=1)
+
+    assert [n for user, n in handled if user == "a"] == [0, 1, 2]
+    assert [n for user, n in handled if user == "b"] == [0, 1, 2]
+    assert most_running == 2
+    assert all(message.acked for message in messages)
+
+
+@pytest.mark.asyncio
+async def test_drain_cancels_handlers_that_overrun():
+    async def handler(message: FakeMessage):
+        await asyncio.sleep(10)
+
+    workers = ConsumerWorkers(handler, "test", concurrency=2)
+    message = FakeMessage("a", 0)
+    await workers.submit(message)
+    await workers.drain(timeout=0.01)
+
+    assert not message.acked
+    assert message.rejected == ("reject", True)
+
+
+class TaggedMessage:
+    def __init__(self, delivery_tag: int, redelivered: bool = False) -> None:
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+        self.settled = None
+
+    async def ack(self, multiple: bool = False):
+        self.settled = ("ack", multiple)
+
+    async def nack(self, requeue: bool = True):
+        self.settled = ("nack", requeue)
+
+
+@pytest.mark.asyncio
+async def test_settle_batch_acks_together_and_nacks_failures():
+    batch = [TaggedMessage(1), TaggedMessage(2, redelivered=True), TaggedMessage(3)]
+    await settle_batch(batch, failed=batch[1:2], topic_name="test")  # type: ignore
+
+    # the failure is requeued only once, the rest is acked up to the newest tag
+    assert batch[1].settled == ("nack", False)
+    assert batch[2].settled == ("ack", True)
+    assert batch[0].settled is None
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from bson import ObjectId
+from app.core.connections import ConnectionManager, Session
+from app.core.inbox import OfflineInbox, offline_inbox
+from tests.fixtures.websocket import FakeWebSocket, StalledWebSocket
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def inbox():
+    offline_inbox.bind(redis=fakeredis.FakeAsyncRedis(decode_responses=True))
+    yield offline_inbox
+    offline_inbox.redis = None
+
+
+@pytest.mark.asyncio
+async def test_drain_empties_the_inbox_but_replays_to_other_devices():
+    inbox = OfflineInbox(max_length=100, max_age_seconds=60, replay_grace_seconds=30)
+    inbox.bind(redis=fakeredis.FakeAsyncRedis(decode_responses=True))
+    user_id = ObjectId()
+
+    await inbox.append("sync", [user_id], "1")
+    await inbox.append("sync", [user_id], "2")
+    assert await inbox.drain("sync", user_id) == ["1", "2"]
+
+    # A second device connecting right after gets the same frames, then new ones
+    await inbox.append("sync", [user_id], "3")
+    assert await inbox.drain("sync", user_id) == ["1", "2", "3"]
+
+    await inbox.redis.delete(inbox._replay_key("sync", user_id))  # type: ignore
+    assert await inbox.drain("sync", user_id) == []
+
+
+@pytest.mark.asyncio
+async def test_inbox_is_replayed_on_connect(inbox: OfflineInbox):
+    manager = ConnectionManager(channel="test")
+    user_id = ObjectId()
+    websocket = FakeWebSocket()
+    await inbox.append("test", [user_id], '{"type":"message"}')
+
+    session = await manager.connect(user_id, websocket)
+    await session.queue.join()
+
+    assert websocket.sent == ['{"type":"message"}']
+    session.close()
+
+
+@pytest.mark.asyncio
+async def test_replay_stops_when_the_session_is_evicted(inbox: OfflineInbox):
+    manager = ConnectionManager(channel="test")
+    user_id = ObjectId()
+    for n in range(5):
+        await inbox.append("test", [user_id], str(n))
+
+    session = Session(
+        user_id, StalledWebSocket(), max_queue_size=2, policy="disconnect"
+    )
+    replay = asyncio.create_task(manager.add_session(session))
+    await asyncio.sleep(0.01)
+    # A live frame finds the queue full of replayed frames
+    session.send(session.queue._queue[0])
+
+    await asyncio.wait_for(replay, timeout=1)
+    assert session.evicted
+    assert await manager.remove_session(session)
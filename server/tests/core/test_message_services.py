@@ -0,0 +1,183 @@
+import pytest
+from bson import ObjectId
+from pydantic import ValidationError
+from app.core.config import settings
+from app.core.db import AsyncDatabase
+from app.core.schemas import Message, MessagePacket, PacketType
+from app.api.msg_socket.services import SequenceCounter, SubmissionDedup
+from app.api.msg_socket.write_behind import MessageWriteBuffer
+
+fakeredis = pytest.importorskip("fakeredis")
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+@pytest.fixture
+def db() -> AsyncDatabase:
+    return AsyncDatabase(mongomock_motor.AsyncMongoMockClient(), "test")  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_sequence_counter_continues_from_last_seq(db: AsyncDatabase):
+    conv_id = (await db.conversation.insert_one({"last_seq": 41})).inserted_id
+    counter = SequenceCounter(ttl_seconds=60)
+    counter.bind(redis=fakeredis.FakeAsyncRedis(decode_responses=True))
+
+    assert await counter.allocate(db, conv_id) == 42
+    assert await counter.allocate(db, conv_id, count=3) == 43
+    assert await counter.allocate(db, conv_id) == 46
+    assert await counter.allocate(db, ObjectId()) is None
+    # reserving does not write to Mongo, the write-behind buffer does
+    assert (await db.conversation.find_one({"_id": conv_id}))["last_seq"] == 41
+    assert counter.stats()["seeded"] == 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind_moves_last_seq_of_conversations(db: AsyncDatabase):
+    conv_id = (await db.conversation.insert_one({"last_seq": 3})).inserted_id
+    buffer = MessageWriteBuffer(
+        max_size=10, batch_size=10, flush_interval=0.01, max_retries=0
+    )
+    buffer.db = db
+    messages = [
+        Message(
+            _id=ObjectId(),  # type: ignore
+            sender_id=ObjectId(),
+            receiver_id=ObjectId(),
+            conversation_id=conv_id,
+            message="hi",
+            seq=seq,
+        )
+        for seq in (5, 4)
+    ]
+
+    await buffer._flush(messages)
+
+    conversation = await db.conversation.find_one({"_id": conv_id})
+    assert conversation["last_seq"] == 5
+    assert conversation["last_message_date"] is not None
+    assert await db.message.count_documents({}) == 2
+
+
+@pytest.mark.asyncio
+async def test_write_behind_drops_only_messages_whose_seq_is_taken(
+    db: AsyncDatabase,
+):
+    await db.initialize_message_indexes()
+    conv_id = (await db.conversation.insert_one({"last_seq": 0})).inserted_id
+    buffer = MessageWriteBuffer(
+        max_size=10, batch_size=10, flush_interval=0.01, max_retries=0
+    )
+    buffer.db = db
+    stored, taken, new = (
+        Message(
+            _id=ObjectId(),  # type: ignore
+            sender_id=ObjectId(),
+            conversation_id=conv_id,
+            message="hi",
+            seq=seq,
+        )
+        for seq in (1, 1, 2)
+    )
+    await buffer._flush([stored])
+
+    # the retried message is fine, the one holding a taken seq is lost
+    await buffer._flush([stored, taken, new])
+
+    assert await db.message.count_documents({}) == 2
+    assert buffer.stats()["flushed"] == 3
+    assert buffer.stats()["lost"] == 1
+
+
+def dedup(redis) -> SubmissionDedup:
+    submissions = SubmissionDedup(maxsize=100, window_seconds=60, claim_ttl_seconds=5)
+    submissions.bind(redis=redis)
+    return submissions
+
+
+@pytest.mark.asyncio
+async def test_retried_submission_gets_the_stored_frame_on_any_node():
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    node_a, node_b = dedup(redis), dedup(redis)
+    sender = ObjectId()
+
+    assert await node_a.claim(sender, ["t1"]) == [None]
+    # retried while the first attempt is still being stored
+    assert await node_b.claim(sender, ["t1"]) == [SubmissionDedup.PENDING]
+
+    await node_a.complete(sender, {"t1": "frame-1"})
+    assert await node_a.claim(sender, ["t1"]) == ["frame-1"]
+    assert await node_b.claim(sender, ["t1"]) == ["frame-1"]
+    assert node_b.stats()["duplicates"] == 2
+
+
+@pytest.mark.asyncio
+async def test_released_submission_can_be_claimed_again():
+    submissions = dedup(fakeredis.FakeAsyncRedis(decode_responses=True))
+    sender = ObjectId()
+
+    assert await submissions.claim(sender, ["t1", "t2"]) == [None, None]
+    await submissions.release(sender, ["t1"])
+
+    assert await submissions.claim(sender, ["t1", "t2"]) == [
+        None,
+        SubmissionDedup.PENDING,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_pending_claims_expire_sooner_than_stored_frames():
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    submissions = dedup(redis)
+    sender = ObjectId()
+
+    await submissions.claim(sender, ["t1"])
+    assert 0 < await redis.ttl(submissions._key(sender, "t1")) <= 5
+    await submissions.complete(sender, {"t1": "frame-1"})
+    assert await redis.ttl(submissions._key(sender, "t1")) > 5
+
+
+@pytest.mark.asyncio
+async def test_claim_is_released_when_the_frame_cannot_be_stored(monkeypatch):
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    node_a, node_b = dedup(redis), dedup(redis)
+    sender = ObjectId()
+    await node_a.claim(sender, ["t1"])
+
+    def pipeline(*args, **kwargs):
+        raise ConnectionError("redis is gone")
+
+    monkeypatch.setattr(redis, "pipeline", pipeline)
+    await node_a.complete(sender, {"t1": "frame-1"})
+    monkeypatch.undo()
+
+    # a retry on another node is stored again instead of dropped as pending
+    assert await node_b.claim(sender, ["t1"]) == [None]
+
+
+@pytest.mark.asyncio
+async def test_temp_id_repeated_within_a_batch_is_claimed_once():
+    sender = ObjectId()
+    bound = dedup(fakeredis.FakeAsyncRedis(decode_responses=True))
+    unbound = SubmissionDedup(maxsize=100, window_seconds=60, claim_ttl_seconds=5)
+
+    for submissions in (bound, unbound):
+        assert await submissions.claim(sender, ["t1", "t2", "t1"]) == [
+            None,
+            None,
+            SubmissionDedup.PENDING,
+        ]
+
+
+def test_message_batch_packets_are_bounded():
+    item = {"message": "hi", "receiver_id": None, "conversation_id": None}
+    items = [
+        {**item, "temp_id": str(n)} for n in range(settings.MESSAGE_BATCH_MAX_SIZE)
+    ]
+
+    packet = MessagePacket(type=PacketType.message_batch, data=items)  # type: ignore
+    assert len(packet.data) == settings.MESSAGE_BATCH_MAX_SIZE  # type: ignore
+    with pytest.raises(ValidationError):
+        MessagePacket(
+            type=PacketType.message_batch,
+            data=items + [{**item, "temp_id": "one-too-many"}],  # type: ignore
+        )
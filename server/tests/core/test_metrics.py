@@ -0,0 +1,23 @@
+from app.core.metrics import Histogram, StageMetrics
+
+
+def test_histogram_quantiles_fall_in_the_right_bucket():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.observe(0.001)
+    for _ in range(10):
+        histogram.observe(0.5)
+
+    # Quantiles are bucket upper bounds (1ms -> 1.6ms) capped by the max
+    assert histogram.quantile(0.50) == 0.0016
+    assert histogram.quantile(0.95) == 0.5
+    assert histogram.snapshot()["count"] == 100
+    assert histogram.snapshot()["max_ms"] == 500.0
+
+
+def test_stage_timer_records_the_block():
+    metrics = StageMetrics()
+    with metrics.time("chat.insert"):
+        pass
+
+    assert metrics.snapshot()["chat.insert"]["count"] == 1
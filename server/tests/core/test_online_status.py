@@ -0,0 +1,99 @@
+import asyncio
+import pytest
+from bson import ObjectId
+from app.core.config import settings
+from app.api.sync_socket import router as sync_router
+from app.api.sync_socket.router import SyncConnectionManager
+from app.background_tasks.async_ops import services
+from app.background_tasks.async_ops.services import OnlineStatusBatcher
+from tests.fixtures.websocket import FakeWebSocket
+
+
+@pytest.fixture
+def announced(monkeypatch) -> list:
+    announced: list = []
+
+    async def notify_online_status(connection, user_id, is_online):
+        announced.append((user_id, is_online))
+
+    monkeypatch.setattr(sync_router, "notify_online_status", notify_online_status)
+    monkeypatch.setattr(settings, "PRESENCE_OFFLINE_GRACE_SECONDS", 0.01)
+    return announced
+
+
+@pytest.mark.asyncio
+async def test_reconnect_within_grace_period_announces_nothing(announced: list):
+    manager = SyncConnectionManager(channel="sync")
+    user_id = ObjectId()
+
+    first = await manager.connect(user_id, FakeWebSocket(), None)  # type: ignore
+    await manager.disconnect(first, None)  # type: ignore
+    second = await manager.connect(user_id, FakeWebSocket(), None)  # type: ignore
+    await asyncio.sleep(0.02)
+
+    assert announced == [(user_id, "online")]
+    await manager.disconnect(second, None)  # type: ignore
+    await manager.flush_offline(None)  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_offline_is_announced_after_grace_period(announced: list):
+    manager = SyncConnectionManager(channel="sync")
+    user_id = ObjectId()
+
+    session = await manager.connect(user_id, FakeWebSocket(), None)  # type: ignore
+    await manager.disconnect(session, None)  # type: ignore
+    assert announced == [(user_id, "online")]
+
+    await asyncio.sleep(0.02)
+    assert announced == [(user_id, "online"), (user_id, "offline")]
+    assert not manager.pending_offline
+
+
+@pytest.mark.asyncio
+async def test_pending_offline_is_announced_on_shutdown(announced: list, monkeypatch):
+    monkeypatch.setattr(settings, "PRESENCE_OFFLINE_GRACE_SECONDS", 60)
+    manager = SyncConnectionManager(channel="sync")
+    user_id = ObjectId()
+
+    session = await manager.connect(user_id, FakeWebSocket(), None)  # type: ignore
+    await manager.disconnect(session, None)  # type: ignore
+    await manager.flush_offline(None)  # type: ignore
+
+    assert announced == [(user_id, "online"), (user_id, "offline")]
+    assert not manager.pending_offline
+
+
+@pytest.fixture
+def distributed(monkeypatch) -> list:
+    distributed: list = []
+    recipient = ObjectId()
+
+    async def get_contacts_many(db, user_ids):
+        return {user_id: [recipient] for user_id in user_ids}
+
+    async def send_message(user_ids, message_data):
+        distributed.append((message_data.user_id, message_data.status))
+
+    monkeypatch.setattr(services.contact_index, "get_contacts_many", get_contacts_many)
+    monkeypatch.setattr(services, "send_sync_message", send_message)
+    return distributed
+
+
+@pytest.mark.asyncio
+async def test_newest_change_wins_across_nodes(distributed: list):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    node_a, node_b = OnlineStatusBatcher(60), OnlineStatusBatcher(60)
+    node_a.bind(redis)
+    node_b.bind(redis)
+    db, user_id = object(), str(ObjectId())
+
+    await node_a.add(db, user_id, "online", timestamp=1)  # type: ignore
+    await node_b.add(db, user_id, "offline", timestamp=2)  # type: ignore
+    # an older change consumed late on the same node is ignored too
+    await node_b.add(db, user_id, "online", timestamp=1)  # type: ignore
+
+    await node_b.stop()
+    await node_a.stop()
+    assert distributed == [(user_id, "offline")]
@@ -0,0 +1,23 @@
+import pytest
+from bson import ObjectId
+from app.core.connections import Session
+from app.core.presence import PresenceService
+
+
+class IdleWebSocket:
+    async def send_text(self, data: str):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_unbound_presence_answers_from_local_sessions():
+    presence = PresenceService(ttl_seconds=60, refresh_seconds=20)
+    online, offline = ObjectId(), ObjectId()
+    session = Session(online, IdleWebSocket())  # type: ignore
+
+    await presence.add(session)
+    assert await presence.is_online_many([online, offline]) == [online]
+
+    await presence.remove(session)
+    assert not await presence.is_online(online)
+    session.close()
@@ -0,0 +1,72 @@
+import pytest
+from aiormq.exceptions import ChannelInvalidStateError
+from app.core.message_broker import Publisher
+
+
+class FlakyExchange:
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.published: list = []
+
+    async def publish(self, message, routing_key: str, mandatory: bool = True):
+        if self.failures:
+            self.failures -= 1
+            raise ChannelInvalidStateError("channel closed")
+        self.published.append((routing_key, message.body))
+
+
+class FakeChannel:
+    def __init__(self, exchange: FlakyExchange) -> None:
+        self.exchange = exchange
+        self.is_closed = False
+
+    async def get_exchange(self, name: str) -> FlakyExchange:
+        return self.exchange
+
+    async def close(self):
+        self.is_closed = True
+
+
+class FakeConnection:
+    def __init__(self, exchange: FlakyExchange) -> None:
+        self.exchange = exchange
+        self.opened = 0
+
+    async def channel(self, publisher_confirms: bool = True) -> FakeChannel:
+        self.opened += 1
+        return FakeChannel(self.exchange)
+
+
+def publisher(exchange: FlakyExchange, retries: int = 3) -> Publisher:
+    return Publisher(
+        FakeConnection(exchange),  # type: ignore
+        channels=2,
+        confirms=True,
+        max_in_flight=10,
+        retries=retries,
+    )
+
+
+@pytest.mark.asyncio
+async def test_publisher_reuses_channels_and_retries_lost_publishes():
+    exchange = FlakyExchange(failures=1)
+    pub = publisher(exchange)
+
+    for _ in range(5):
+        await pub.publish("sync_message", "online_status", b"{}")
+
+    assert len(exchange.published) == 5
+    assert pub.connection.opened == 2  # type: ignore
+    assert pub.stats()["retried"] == 1
+    assert pub.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_submitted_publish_fails_after_retries():
+    pub = publisher(FlakyExchange(failures=5), retries=2)
+
+    with pytest.raises(ChannelInvalidStateError):
+        await pub.submit("sync_message", "online_status", b"{}")
+
+    assert pub.stats()["failed"] == 1
+    await pub.close()
@@ -0,0 +1,127 @@
+import time
+import pytest
+from aiormq.abc import DeliveredMessage
+from bson import ObjectId
+from app.core.connections import ConnectionManager
+from app.core.inbox import offline_inbox
+from app.core.routing import NodeRouter, node_router
+from app.core.schemas import DeliveryEnvelope
+from tests.fixtures.websocket import FakeWebSocket
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class NodeExchange:
+    """Node queues exist for the nodes in `live`, frames to others come back."""
+
+    def __init__(self, live: set[str]) -> None:
+        self.live = live
+        self.published: list[str] = []
+
+    async def publish(self, message, routing_key: str, mandatory: bool = True):
+        if routing_key not in self.live:
+            return DeliveredMessage(None, None, message.body, None)  # type: ignore
+        self.published.append(routing_key)
+
+
+class FakeChannel:
+    is_closed = False
+
+    def __init__(self, exchange: NodeExchange) -> None:
+        self.exchange = exchange
+
+    async def get_exchange(self, name: str) -> NodeExchange:
+        return self.exchange
+
+    async def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, live: set[str]) -> None:
+        self.exchange = NodeExchange(live)
+
+    async def channel(self, publisher_confirms: bool = True) -> FakeChannel:
+        return FakeChannel(self.exchange)
+
+
+@pytest.mark.asyncio
+async def test_routes_of_a_node_that_stops_refreshing_expire():
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    router = NodeRouter(node_id="node-a")
+    router.bind(connection=FakeConnection(set()), redis=redis)  # type: ignore
+    user_id = ObjectId()
+
+    await router.add_route("message", user_id)
+    # node-b crashed a while ago and never refreshed its route
+    await redis.zadd(router._key("message", user_id), {"node-b": time.time() - 1})
+
+    assert await router.lookup("message", [user_id]) == {"node-a": [user_id]}
+
+
+@pytest.mark.asyncio
+async def test_frames_returned_by_a_gone_node_go_to_the_inbox():
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    connection = FakeConnection(live={"node-b"})
+    manager = ConnectionManager(channel="message")
+    node_router.bind(connection=connection, redis=redis)  # type: ignore
+    offline_inbox.bind(redis=redis)
+    on_b, on_gone = ObjectId(), ObjectId()
+    try:
+        key = node_router._key("message", on_b)
+        await redis.zadd(key, {"node-b": time.time() + 60})
+        key = node_router._key("message", on_gone)
+        await redis.zadd(key, {"node-c": time.time() + 60})
+
+        await manager.deliver_frame([on_b, on_gone], "hello", store_offline=True)
+
+        assert connection.exchange.published == ["node-b"]
+        assert await offline_inbox.drain("message", on_b) == []
+        assert await offline_inbox.drain("message", on_gone) == ["hello"]
+        assert await node_router.lookup("message", [on_gone]) == {}
+    finally:
+        await node_router.unbind()
+        offline_inbox.redis = None
+
+
+@pytest.mark.asyncio
+async def test_forwarded_frame_for_a_user_who_left_goes_to_the_inbox():
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    ConnectionManager(channel="message")
+    node_router.bind(connection=FakeConnection(set()), redis=redis)  # type: ignore
+    offline_inbox.bind(redis=redis)
+    left = ObjectId()
+    try:
+        envelope = DeliveryEnvelope(
+            channel="message", user_ids=[left], frame="hello", store_offline=True
+        )
+        await node_router.deliver_envelope(envelope)
+
+        assert await offline_inbox.drain("message", left) == ["hello"]
+    finally:
+        await node_router.unbind()
+        offline_inbox.redis = None
+
+
+@pytest.mark.asyncio
+async def test_delivery_falls_back_to_local_sessions_when_redis_fails():
+    server = fakeredis.FakeServer()
+    redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    manager = ConnectionManager(channel="message")
+    node_router.bind(connection=FakeConnection(set()), redis=redis)  # type: ignore
+    offline_inbox.bind(redis=redis)
+    local_user, remote_user = ObjectId(), ObjectId()
+    websocket = FakeWebSocket()
+    try:
+        session = await manager.connect(local_user, websocket)
+        server.connected = False
+
+        await manager.deliver_frame([local_user, remote_user], "hello", True)
+        await session.queue.join()
+
+        assert websocket.sent == ["hello"]
+        assert await manager.disconnect(session)
+    finally:
+        server.connected = True
+        await node_router.unbind()
+        offline_inbox.redis = None
@@ -0,0 +1,122 @@
+import asyncio
+from datetime import datetime, timezone
+import pytest
+from bson import ObjectId
+from app.core.db import AsyncDatabase
+from app.core.schemas import Message_Status, MessageEvent, MessageStatusUpdate
+from app.api.sync_socket import status_buffer
+from app.api.sync_socket.status_buffer import MessageStatusAggregator
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+@pytest.fixture
+def db() -> AsyncDatabase:
+    return AsyncDatabase(mongomock_motor.AsyncMongoMockClient(), "test")  # type: ignore
+
+
+@pytest.fixture
+def published(monkeypatch) -> list:
+    published: list = []
+
+    async def publish_message(connection, exchange_name, topic, data, persistent):
+        published.append(data)
+        return True
+
+    monkeypatch.setattr(status_buffer, "publish_message", publish_message)
+    return published
+
+
+def update(status: Message_Status, *message_ids: ObjectId) -> MessageStatusUpdate:
+    return MessageStatusUpdate(
+        status=status,
+        data=[
+            MessageEvent(message_id=str(id), timestamp=datetime.now(timezone.utc))
+            for id in message_ids
+        ],
+    )
+
+
+def aggregator(
+    db: AsyncDatabase, flush_interval: float = 10, max_events: int = 100
+) -> MessageStatusAggregator:
+    status = MessageStatusAggregator(flush_interval, max_events)
+    status.start(db=db, connection=object())  # type: ignore
+    return status
+
+
+async def insert_message(db: AsyncDatabase) -> ObjectId:
+    response = await db.message.insert_one(
+        {"sender_id": ObjectId(), "received_time": None, "seen_time": None}
+    )
+    return response.inserted_id
+
+
+@pytest.mark.asyncio
+async def test_flushes_once_the_batch_size_is_reached(db, published):
+    status = aggregator(db, max_events=2)
+    reader = ObjectId()
+
+    status.add(reader, update(Message_Status.recieved, ObjectId()))
+    assert status.stats()["buffered"] == 1
+    status.add(reader, update(Message_Status.recieved, ObjectId()))
+    await asyncio.gather(*status._flushes)
+
+    assert len(published) == 1
+    assert len(published[0].updates[0].data) == 2
+    assert status.stats()["buffered"] == 0
+
+
+@pytest.mark.asyncio
+async def test_flushes_after_the_interval(db, published):
+    status = aggregator(db, flush_interval=0.01)
+
+    status.add(ObjectId(), update(Message_Status.recieved, ObjectId()))
+    assert published == []
+    await asyncio.sleep(0.03)
+
+    assert len(published) == 1
+    assert status.stats()["flushes"] == 1
+
+
+@pytest.mark.asyncio
+async def test_repeated_acks_are_written_once_and_seen_wins(db, published):
+    status = aggregator(db)
+    reader = ObjectId()
+    message_id = await insert_message(db)
+
+    # seen arrives first, received is still applied before it
+    status.add(reader, update(Message_Status.seen, message_id))
+    status.add(reader, update(Message_Status.recieved, message_id))
+    status.add(reader, update(Message_Status.recieved, message_id))
+    await status.stop()
+
+    message = await db.message.find_one({"_id": message_id})
+    assert message["status"] == Message_Status.seen.value
+    assert message["received_time"] is not None
+    assert message["seen_time"] is not None
+    assert [batch.status for batch in published[0].updates] == [
+        Message_Status.recieved,
+        Message_Status.seen,
+    ]
+    assert [len(batch.data) for batch in published[0].updates] == [1, 1]
+
+
+@pytest.mark.asyncio
+async def test_stats_count_the_round_trips_saved(db, published):
+    status = aggregator(db)
+    reader = ObjectId()
+
+    status.add(reader, update(Message_Status.recieved, ObjectId(), ObjectId()))
+    status.add(reader, update(Message_Status.seen, ObjectId()))
+    status.add(reader, update(Message_Status.seen, ObjectId()))
+    await status.stop()
+
+    stats = status.stats()
+    assert stats["packets"] == 3
+    assert stats["events"] == 4
+    assert stats["flushes"] == 1
+    assert stats["mean_batch"] == 4.0
+    assert stats["max_batch"] == 4
+    # one bulk_write and one publish per packet without batching
+    assert stats["round_trips_saved"] == 4
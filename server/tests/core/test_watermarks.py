@@ -0,0 +1,87 @@
+import pytest
+from bson import ObjectId
+from app.core.config import settings
+from app.core.db import AsyncDatabase
+from app.core.schemas import Message_Status, MessageWatermark
+from app.api.msg_socket.services import sequence_counter
+from app.api.sync_socket.services import advance_watermark
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+@pytest.fixture
+def db() -> AsyncDatabase:
+    return AsyncDatabase(mongomock_motor.AsyncMongoMockClient(), "test")  # type: ignore
+
+
+def watermark(conv_id: ObjectId, status: Message_Status, seq: int):
+    return MessageWatermark(conversation_id=conv_id, status=status, seq=seq)
+
+
+async def receipt(db: AsyncDatabase, conv_id: ObjectId, user_id: ObjectId) -> dict:
+    conversation = await db.conversation.find_one({"_id": conv_id})
+    return conversation.get("receipts", {}).get(str(user_id), {})
+
+
+@pytest.mark.asyncio
+async def test_watermarks_only_move_forward(db: AsyncDatabase):
+    reader, sender = ObjectId(), ObjectId()
+    conv_id = (
+        await db.conversation.insert_one(
+            {"participants": [reader, sender], "last_seq": 10}
+        )
+    ).inserted_id
+
+    received = watermark(conv_id, Message_Status.recieved, 5)
+    assert await advance_watermark(reader, received, db) == [sender]
+    # repeated or older watermarks notify nobody and change nothing
+    assert await advance_watermark(reader, received, db) is None
+    older = watermark(conv_id, Message_Status.recieved, 3)
+    assert await advance_watermark(reader, older, db) is None
+    assert await receipt(db, conv_id, reader) == {"received_seq": 5}
+
+    # seeing implies receiving
+    seen = watermark(conv_id, Message_Status.seen, 7)
+    assert await advance_watermark(reader, seen, db) == [sender]
+    assert await receipt(db, conv_id, reader) == {"received_seq": 7, "seen_seq": 7}
+
+
+@pytest.mark.asyncio
+async def test_watermark_past_the_newest_message_is_ignored(db: AsyncDatabase):
+    reader, sender = ObjectId(), ObjectId()
+    conv_id = (
+        await db.conversation.insert_one(
+            {"participants": [reader, sender], "last_seq": 10}
+        )
+    ).inserted_id
+
+    ahead = watermark(conv_id, Message_Status.seen, 11)
+    assert await advance_watermark(reader, ahead, db) is None
+    # nor can an outsider move a receipt
+    outsider = watermark(conv_id, Message_Status.seen, 2)
+    assert await advance_watermark(ObjectId(), outsider, db) is None
+    assert (await db.conversation.find_one({"_id": conv_id})).get("receipts") is None
+
+
+@pytest.mark.asyncio
+async def test_deliver_first_watermarks_follow_the_sequence_counter(
+    db: AsyncDatabase, monkeypatch
+):
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(settings, "MESSAGE_DELIVERY_MODE", "deliver_first")
+    monkeypatch.setattr(
+        sequence_counter, "redis", fakeredis.FakeAsyncRedis(decode_responses=True)
+    )
+    reader, sender = ObjectId(), ObjectId()
+    conv_id = (
+        await db.conversation.insert_one(
+            {"participants": [reader, sender], "last_seq": 10}
+        )
+    ).inserted_id
+
+    # delivered, but last_seq only moves once the messages are stored
+    assert await sequence_counter.allocate(db, conv_id, count=2) == 11
+    delivered = watermark(conv_id, Message_Status.seen, 12)
+    assert await advance_watermark(reader, delivered, db) == [sender]
+    ahead = watermark(conv_id, Message_Status.seen, 13)
+    assert await advance_watermark(reader, ahead, db) is None
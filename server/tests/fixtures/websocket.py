@@ -0,0 +1,26 @@
+import asyncio
+
+
+class FakeWebSocket:
+    """Records the frames written to a socket and the code it was closed with."""
+
+    def __init__(self) -> None:
+        self.sent: list[str] = []
+        self.closed_with: int | None = None
+        self.scope: dict = {}
+
+    async def accept(self, subprotocol: str | None = None):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(data)
+
+    async def close(self, code: int):
+        self.closed_with = code
+
+
+class StalledWebSocket(FakeWebSocket):
+    """A client that stopped reading, writes never complete."""
+
+    async def send_text(self, data: str):
+        await asyncio.Event().wait()